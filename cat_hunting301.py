@@ -7,6 +7,7 @@ from astropy.coordinates import SkyCoord
 from astropy.wcs import WCS
 from astropy.wcs import utils
 from astropy import units as u
+from magic_star import RefcatReader, refcat_atlas
 
 plt.rcParams.update({'figure.max_open_warning': 0})
 
@@ -75,19 +76,12 @@ print(d_ra, d_dec)
 # d_dec = 1
 
 # args = ['./refcat', f'{f_center.ra.deg}', f'{f_center.dec.deg}', '-rect', f'{d_ra},{d_dec}', '-dir 00_m_16/']
-args_str = f'./refcat {f_center.ra.deg} {f_center.dec.deg} -rect {d_ra},{d_dec} -dir 00_m_16/'
+# args_str = f'./refcat {f_center.ra.deg} {f_center.dec.deg} -rect {d_ra},{d_dec} -dir 00_m_16/'
 # args_str = f'./refcat {f_center.ra.deg} {f_center.dec.deg} -rad 1.0 -dir 00_m_16/'
 
-print(args_str)
-
 # RA, Dec, g, r, i, z, J, cyan, orange.
-stars = np.array(os.popen(args_str).read().split('\n')[:-1])
+refcat = refcat_atlas(RefcatReader('00_m_16/').query_rect(f_center.ra.deg, f_center.dec.deg, d_ra, d_dec))
 print()
-
-refcat = []
-for i in stars:
-	refcat.append(np.array(i.split(), dtype=float))
-refcat = np.array(refcat)
 # print(refcat.shape)
 
 my_cat = np.loadtxt('catalog.cat')
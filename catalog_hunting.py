@@ -8,7 +8,7 @@ from astropy.wcs import WCS
 from astropy.wcs import utils
 from astropy import units as u
 from scipy.ndimage import rotate
-from magic_star import point_rotation
+from magic_star import point_rotation, is_fits_frame, Frame, observations, RefcatReader, refcat_atlas
 
 star_params = np.loadtxt('star_parameters.csv', delimiter=',', dtype=object, skiprows=1)
 
@@ -32,10 +32,11 @@ dir_names = [directory+f+'/' for f in os.listdir(directory) if isdir(join(direct
 
 # output = open('output_rates.csv', 'w+')
 
-input_file = np.loadtxt('input.csv', dtype=object, skiprows=1, usecols=(i for i in range(25)), delimiter=',')
 
 mins = {'g':100, 'r': 150, 'i': 250}
 
+refcat_reader = RefcatReader('00_m_16/')
+
 for d in dir_names:
 	file_names = [d+f for f in os.listdir(d) if isfile(join(d,f))]
 	# stars      = file_names[]
@@ -50,14 +51,15 @@ for d in dir_names:
 
 		if '66' not in f: continue
 
+		if not is_fits_frame(f): continue
 		try:
-			file = fits.open(f)
+			frame = Frame(f)
 		except Exception as e:
 			# print(f)
 			continue
 		print(f)
-		hdr = file[0].header
-		img = file[0].data
+		hdr = frame.header
+		img = frame.data
 
 		img_star_rotated = rotate(img, a)
 
@@ -74,17 +76,13 @@ for d in dir_names:
 		plt.figure()
 		plt.title(f)
 
-		obj_rows = input_file[np.where(input_file[:,1]==obj_id),:][0]
-
-		try:
-			obj = obj_rows[np.where(obj_rows[:,0]==f.split('/')[-1])][0]
-			trail_start = np.array(obj[-4:-2], dtype=int)
-			trail_end	= np.array(obj[-2:], dtype=int)
-			c = SkyCoord(f'{obj[7]} {obj[8]}', unit=(u.deg, u.deg))
-		except Exception as e:
-			# print(f,obj[-4:-2],obj[-2:])
+		obj = observations.lookup(f.split('/')[-1], obj_id)
+		if obj is None or not obj['has_trail']:
 			plt.close()
 			continue
+		trail_start = obj['trail_start']
+		trail_end	= obj['trail_end']
+		c = SkyCoord(f'{obj["ra"]} {obj["dec"]}', unit=(u.deg, u.deg))
 
 		angle = -1*np.arctan2(trail_end[0]-trail_start[0], trail_end[1]-trail_start[1]) * 180/np.pi
 		img_rotated = rotate(img, angle)
@@ -114,20 +112,10 @@ for d in dir_names:
 
 		# args = ['./refcat', f'{f_center.ra.deg}', f'{f_center.dec.deg}', '-rect', f'{d_ra},{d_dec}', '-dir 00_m_16/']
 		# args_str = f'./refcat {f_center.ra.deg} {f_center.dec.deg} -rect {d_ra},{d_dec} -dir 00_m_16/'
-		args_str = f'./refcat {c.ra.deg} {c.dec.deg} -rad 0.5 -dir 00_m_16/'
-
-		print(args_str)
+		# args_str = f'./refcat {c.ra.deg} {c.dec.deg} -rad 0.5 -dir 00_m_16/'
 
 		# RA, Dec, g, r, i, z, J, cyan, orange.
-		ref_stars = np.array(os.popen(args_str).read().split('\n')[:-1])
-
-		# print(stars)
-		# print(stars.stderr)
-		# print(stars)
-		refcat = []
-		for i in ref_stars:
-			refcat.append(np.array(i.split(), dtype=float))
-		refcat = np.array(refcat)
+		refcat = refcat_atlas(refcat_reader.query_radius(c.ra.deg, c.dec.deg, 0.5))
 
 		refcat_ra_dec      = SkyCoord(ra=refcat[:,0]*u.degree, dec=refcat[:,1]*u.degree, frame='fk5')
 		refcat_x, refcat_y = np.round(utils.skycoord_to_pixel(refcat_ra_dec, w))
@@ -63,4 +63,182 @@ def display_streak(img, s, L, a, b, x_0, y_0, width=1, height=1):
 	obj_width  = width * s * 2.355
 	obj_height = L * height
 	obj_rect   = img[int(y_0 - obj_height/2 + .5) : int(y_0 + obj_height/2 + .5), int(x_0 - obj_width + .5) : int(x_0 + obj_width + .5) ]
-	return obj_rect
\ No newline at end of file
+	return obj_rect
+
+"""
+gradient check of magic_star.trail_model_jac against five point central finite differences of magic_star.trail_model
+	usage:  > check_trail_jacobian(img_star_rotated, str_param)
+
+PARAMETERS
+-----------
+img   : array
+	2d numpy array the trail lives in, stands in for img_rot
+param : array
+	[ s , L , a , b , x_0 , y_0 ] to check the derivatives at
+steps : array
+	(optional) finite difference step for each parameter ; default = 3e-5 * max(|param|, 1)
+pad   : float
+	(optional) padding in units of s around the trail for the pixels compared ; default = 10
+
+RETURNS
+---------
+rel_err : array
+	max |analytic - numeric| / max |numeric| for each of the 6 parameters -- should be ~1e-9 or better
+"""
+def check_trail_jacobian(img, param, steps=None, pad=10):
+	import magic_star
+	magic_star.img_rot = img
+
+	param = np.array(param, dtype=float)
+	if steps is None: steps = 3e-5 * np.maximum(np.abs(param), 1)
+
+	rows, cols = magic_star.trail_window(img.shape, param[0], param[1], param[2], param[4], param[5], pad=pad)
+	yy, xx = np.mgrid[rows, cols]
+
+	analytic = magic_star.trail_model_jac(xx, yy, *param)
+	flux     = magic_star.flux
+
+	# hold the flux normalization where the analytic jacobian had it
+	def model(p):
+		m = magic_star.trail_model(xx, yy, *p).ravel()
+		return (m - p[3]) * flux/magic_star.flux + p[3]
+
+	# model with parameter i moved by k steps
+	def shifted(i, k):
+		p = param.copy()
+		p[i] += k * steps[i]
+		return model(p)
+
+	rel_err = []
+	for i in range(len(param)):
+		numeric = (shifted(i, -2) - 8*shifted(i, -1) + 8*shifted(i, 1) - shifted(i, 2)) / (12*steps[i])
+		rel_err.append(np.max(np.abs(analytic[:,i] - numeric)) / max(np.max(np.abs(numeric)), 1e-300))
+
+	return np.array(rel_err)
+
+'''
+trail_model_jac() agrees with finite differences of trail_model() to ~1e-9, for trails along and across the columns
+'''
+def test_trail_jacobian():
+	img = np.random.default_rng(0).normal(200, 5, (300, 200))
+	for param in ([3., 80., 90., 200., 100.3, 150.7], [2.7, 60., 75., 200., 90.3, 140.7], [2., 40., 89.5, 150., 60., 120.], [1.5, 120., 30., 50., 100., 150.]):
+		rel_err = check_trail_jacobian(img, param)
+		assert np.all(rel_err < 1e-9), (param, rel_err)
+
+"""
+round trip check of magic_star.point_rotation_batch / reverse_rotation_batch
+	usage:  > check_rotation_roundtrip(img, a)
+
+PARAMETERS
+-----------
+img : array
+	original (unrotated) 2d numpy image
+a   : float
+	rotation angle [degrees]
+n   : int
+	(optional) number of random points in the image to send through the round trip ; default = 1000
+
+RETURNS
+---------
+max_err : float
+	max |reverse(point(xy)) - xy| in px over the points -- should be ~1e-10 or better
+"""
+def check_rotation_roundtrip(img, a, n=1000):
+	import magic_star
+
+	rng    = np.random.default_rng(0)
+	coords = rng.uniform(0, 1, (n, 2)) * [img.shape[1], img.shape[0]]
+
+	rotated = magic_star.point_rotation_batch(coords, a, img, dtype=float, clip=False)
+	back    = magic_star.reverse_rotation_batch(rotated, a, img)
+
+	return np.max(np.abs(back - coords))
+
+'''
+point -> reverse rotation round trips to ~1e-10 px, and point_rotation_batch / reverse_rotation_batch give what
+point_rotation / reverse_rotation give one point at a time, for both directions of rotation
+'''
+def test_rotation_roundtrip():
+	import magic_star
+
+	img    = np.zeros((4000, 4100))
+	coords = np.random.default_rng(1).uniform(-50, 4150, (200, 2))
+	for a in (0., 12.5, -33.3, 60., -89.):
+		assert check_rotation_roundtrip(img, a) < 1e-10, a
+
+		batch   = magic_star.point_rotation_batch(coords, a, img)
+		single  = np.array([magic_star.point_rotation(x, y, a, img, None) for x, y in coords])
+		assert np.max(np.abs(batch - single)) < 1e-10, a
+
+		batch   = magic_star.reverse_rotation_batch(coords, a, img)
+		single  = np.array([magic_star.reverse_rotation(x, y, a, img) for x, y in coords])
+		assert np.max(np.abs(batch - single)) < 1e-10, a
+
+"""
+check of magic_star.parse_observations against pandas on input.csv, with one extra row that has a cross-track FWHM
+and notes (input.csv has no FWHM filled in yet)
+	usage:  > check_observations('input.csv')
+
+PARAMETERS
+-----------
+path : str
+	(optional) csv file ; default = 'input.csv'
+
+RETURNS
+---------
+mismatches : list
+	(filename, column, parsed, pandas) for every fwhm / notes value that differs -- should be empty
+"""
+def check_observations(path='input.csv'):
+	import csv, os, tempfile
+	import pandas as pd
+	import magic_star
+
+	with open(path, newline='') as fh:
+		rows = list(csv.reader(fh))
+	extra = (rows[1] + [''] * 27)[:27]
+	extra[0], extra[25], extra[26] = 'check_row.flt', '4.25', 'faint, next to a star'
+	rows.append(extra)
+
+	fd, tmp = tempfile.mkstemp(suffix='.csv')
+	try:
+		with os.fdopen(fd, 'w', newline='') as fh:
+			csv.writer(fh).writerows(rows)
+		parsed = magic_star.parse_observations(tmp)
+		frame  = pd.read_csv(tmp, keep_default_na=False)
+	finally:
+		os.remove(tmp)
+
+	mismatches = []
+	for i in range(len(parsed)):
+		fwhm  = frame.iloc[i, 25]
+		fwhm  = float(fwhm) if str(fwhm).strip() else np.nan
+		notes = str(frame.iloc[i, 26]).strip()
+		if not (np.isnan(fwhm) and np.isnan(parsed['fwhm'][i]) or fwhm == parsed['fwhm'][i]):
+			mismatches.append((parsed['filename'][i], 'fwhm', parsed['fwhm'][i], fwhm))
+		if notes != parsed['notes'][i]:
+			mismatches.append((parsed['filename'][i], 'notes', parsed['notes'][i], notes))
+	if parsed['fwhm'][-1] != 4.25 or parsed['notes'][-1] != 'faint, next to a star':
+		mismatches.append(('check_row.flt', 'extra row', (parsed['fwhm'][-1], parsed['notes'][-1]), (4.25, 'faint, next to a star')))
+
+	return mismatches
+
+'''
+take_lightcurves() on a frame where no star fit succeeded -- no trails, angles given -- comes back empty instead of raising
+'''
+def test_take_lightcurves_no_trails():
+	import magic_star
+
+	img = np.random.default_rng(0).normal(200, 5, (300, 200))
+	for binning in (None, 40):
+		fluxes, sigmas, sky_avg = magic_star.take_lightcurves(img, np.zeros((0, 2)), np.zeros((0, 2)), [], angles=[], binning=binning)
+		assert fluxes.shape[0] == sigmas.shape[0] == sky_avg.shape[0] == 0
+
+	assert magic_star.oblique_sample_batch(img, []) == []
+
+# python debugging.py -- runs every test_ check above
+if __name__ == '__main__':
+	for name, check in list(globals().items()):
+		if name.startswith('test_') and callable(check):
+			check()
+			print(f'{name} ok')
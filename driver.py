@@ -1,26 +1,76 @@
-import subprocess, sys
+import argparse, csv, sys
+from collections import Counter
 import numpy as np
+import magic_star
+from magic_star import run_batch, FrameManifest
 
+# usage: python driver.py [object ...] [-j workers] [--star-workers n] [--summary batch_summary.csv] [--verbose]
+#                         [--manifest batch_manifest.json] [--retries n] [--backoff seconds] [--retry-failed] [--fit-cache fit_cache/]
+#                         [--warm-start] [--text-output]
+# runs every frame of the objects in star_parameters.csv (all of them unless some are named, e.g. GE1 TG24)
+# in this one process and a pool of workers, instead of a python3 magic_star.py per object.
+# frames the manifest has as finished with unchanged inputs are not rerun, ones whose worker crashed are retried.
+# failed frames (the pipeline gave up, or an exception) are final unless --retry-failed
 
-f = np.loadtxt('star_parameters.csv', delimiter=',', dtype=object, skiprows=1)
+def load_star_parameters(path='star_parameters.csv'):
+	f = np.loadtxt(path, delimiter=',', dtype=object, skiprows=1)
 
-L = np.array(f[:,1], dtype=float)
-a = np.array(f[:,2], dtype=float)
+	L = np.array(f[:,1], dtype=float)
+	a = np.array(f[:,2], dtype=float)
 
-f = f[np.where(L>0)]
-L = np.array(f[:,1], dtype=float)
-a = np.array(f[:,2], dtype=float)
-print(f)
+	f = f[np.where(L>0)]
+	L = np.array(f[:,1], dtype=float)
+	a = np.array(f[:,2], dtype=float)
 
+	# object 'YYYY DESIG' -> directory match 'DESIG', as magic_star.py takes it
+	return [(f[i, 0].split(' ')[1], L[i], a[i]) for i in range(len(f))]
+
+parser = argparse.ArgumentParser(description='run the lightcurve pipeline on every frame of many objects')
+parser.add_argument('objects', nargs='*', help='object designations to run (default: all in star_parameters.csv)')
+parser.add_argument('-j', '--workers', type=int, default=None, help='frames processed at once (default: all cores)')
+parser.add_argument('--star-workers', type=int, default=1, help='processes for the star fits within a frame')
+parser.add_argument('--params', default='star_parameters.csv', help='object, star trail length and angle table')
+parser.add_argument('--summary', default='batch_summary.csv', help='per frame results table')
+parser.add_argument('--verbose', action='store_true', help="keep the pipeline's printing")
+parser.add_argument('--manifest', default='batch_manifest.json', help='frame job manifest, empty to run everything without one')
+parser.add_argument('--retries', type=int, default=2, help='extra attempts for frames whose worker crashed')
+parser.add_argument('--backoff', type=float, default=5, help='wait before the first retry [s], doubles every retry')
+parser.add_argument('--retry-failed', action='store_true', help='retry failed and error frames too, including ones the manifest has')
+parser.add_argument('--fit-cache', default=None, help='directory to cache trail fits in (default: no cache)')
+parser.add_argument('--warm-start', action='store_true', help="start each frame's fits from the object's previous frame")
+parser.add_argument('--text-output', action='store_true', help='also write the .dat text files next to each lightcurves.npz')
+args = parser.parse_args()
+
+objects = load_star_parameters(args.params)
+if args.objects:
+	objects = [o for o in objects if any(name in o[0] for name in args.objects)]
+	if not objects: sys.exit(f'none of {args.objects} in {args.params}')
+
+for obj, l, a in objects:
+	print(obj, l, a)
 print()
 
-# print(f)
-# index = sys.argv[1]
-#for index in range(len(f)-1, -1, -1):
-for index in range(4 , len(f)):
-	#if  ('EV84' in f[index][0]) or ('GE1' in f[index][0]) or ('FF14' in f[index][0]): continue
-	#if index == 8: break
-	print(f[index])
-	print([ 'python3' , 'magic_star.py' , f[index, 0].split(' ')[1] , str(L[index]) , str(a[index]) , str(True) ])
-	subprocess.run([ 'python3' , 'magic_star.py' , f[index, 0].split(' ')[1] , str(L[index]) , str(a[index]) , str(True) ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+def report(result):
+	message = result.message.strip().split('\n')[-1] if result.message else ''
+	print(f'{result.status:8s} {result.elapsed:7.1f}s  {result.frame}  {message}')
+
+# run_batch hands these on to its workers (pool initializer), however they are started
+magic_star.fit_cache_dir = args.fit_cache
+magic_star.warm_start    = args.warm_start
+magic_star.text_output   = args.text_output
 
+manifest = FrameManifest(args.manifest) if args.manifest else None
+results  = run_batch(objects, workers=args.workers, star_workers=args.star_workers, quiet=not args.verbose, callback=report,
+                     manifest=manifest, retries=args.retries, backoff=args.backoff, retry_failed=args.retry_failed)
+
+with open(args.summary, 'w', newline='') as fh:
+	writer = csv.writer(fh)
+	writer.writerow(['frame', 'object', 'status', 'n_stars', 's', 'L', 'a', 'b', 'x_0', 'y_0',
+	                 's_err', 'L_err', 'a_err', 'b_err', 'x_0_err', 'y_0_err', 'elapsed', 'message'])
+	for r in results:
+		param = list(r.ast_param) + list(r.ast_param_err) if r.ast_param is not None else [''] * 12
+		writer.writerow([r.frame, r.obj_id or '', r.status, r.n_stars] + param + [f'{r.elapsed:.2f}', r.message.strip().split('\n')[-1] if r.message else ''])
+
+print()
+print(', '.join(f'{n} {status}' for status, n in Counter(r.status for r in results).items()), f'-- {args.summary}')
+if manifest is not None: print(manifest)
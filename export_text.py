@@ -0,0 +1,18 @@
+import os, sys
+from os.path import isdir, isfile, join
+from magic_star import FrameLightcurves, lightcurve_file
+
+# usage: python export_text.py [object directory substring]
+# writes star_params.dat, lightcurve_star_<i>.dat and lightcurve_asteroid.dat from every <frame>/lightcurves.npz
+
+directory  = './'
+dir_names = [directory+f+'/' for f in os.listdir(directory) if isdir(join(directory,f))]
+obj_match = sys.argv[1] if len(sys.argv) > 1 else ''
+
+for d in sorted(dir_names):
+	if obj_match not in d: continue
+	for frame_id in sorted(os.listdir(d)):
+		if not isfile(join(d, frame_id, lightcurve_file)): continue
+		with FrameLightcurves(join(d, frame_id)) as lcs:
+			lcs.export_text()
+			print(lcs)
@@ -8,6 +8,7 @@ from scipy.ndimage import rotate
 from scipy.optimize import curve_fit
 from scipy.optimize import OptimizeWarning
 from scipy.stats import norm
+from magic_star import observations, detect_sources
 # from astropy.io.ascii import sextractor
 from astropy.wcs import WCS
 from astropy.wcs import utils
@@ -56,7 +57,6 @@ from os.path import isdir, isfile, join
 directory = './'	
 dir_names = [directory+f+'/' for f in os.listdir(directory) if isdir(join(directory,f))] 
 
-input_file = np.loadtxt('input.csv', dtype=object, skiprows=1, usecols=(i for i in range(25)), delimiter=',')
 
 mins = {'g':100, 'r': 150, 'i': 250}
 
@@ -87,16 +87,13 @@ for d in dir_names:
 		ax[0].set_title(f)
 		# plt.imshow(img, cmap='gray', norm=colors.LogNorm(vmin=mins[hdr['FILTER'][0]]))
 
-		obj_rows = input_file[np.where(input_file[:,1]==obj_id),:][0]
-
-		try:
-			obj = obj_rows[np.where(obj_rows[:,0]==f.split('/')[-1])][0]
-			trail_start = np.array(obj[-4:-2], dtype=int)
-			trail_end	= np.array(obj[-2:], dtype=int)
-		except Exception as e:
-			print(f,obj[-4:-2],obj[-2:])
+		obj = observations.lookup(f.split('/')[-1], obj_id)
+		if obj is None or not obj['has_trail']:
+			print(f, 'no trail in input.csv')
 			plt.close()
 			continue
+		trail_start = obj['trail_start']
+		trail_end	= obj['trail_end']
 		
 		angle = -1*np.arctan2(trail_end[0]-trail_start[0], trail_end[1]-trail_start[1]) * 180/np.pi
 		# absolutely love commenting out approximations :)
@@ -180,23 +177,22 @@ for d in dir_names:
 
 		# WCS stuff
 		w = WCS(hdr)
-		c = SkyCoord(f'{obj[7]} {obj[8]}', unit=(u.deg, u.deg))
+		c = SkyCoord(f'{obj["ra"]} {obj["dec"]}', unit=(u.deg, u.deg))
 		target_x, target_y = np.round(utils.skycoord_to_pixel(c, w))
 		target_x, target_y = point_rotation(trail_start[0], trail_start[1], angle, img, img_rotated)
 
 
-		# star stuff - SExtractor for detecting star trails
-		sex = subprocess.run(['sex', f, '-DETECT_MINAREA', str(trail_length*fwhm)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-		# sex = subprocess.run(['sex', f, '-DETECT_MINAREA', str(trail_length*fwhm)])
-		sex_output = np.loadtxt('test.cat', skiprows=9)
+		# star stuff - detecting star trails in-process (same columns SExtractor wrote to test.cat)
+		# sex = subprocess.run(['sex', f, '-DETECT_MINAREA', str(trail_length*fwhm)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		sex_output = detect_sources(img, minarea=trail_length*fwhm)
 		print(sex_output.shape)
-		star_x = sex_output[:,5]
-		star_y = sex_output[:,6]
+		star_x = sex_output['X_IMAGE']
+		star_y = sex_output['Y_IMAGE']
 
-		star_x_min = sex_output[:,1]
-		star_y_min = sex_output[:,2]
-		star_x_max = sex_output[:,3]
-		star_y_max = sex_output[:,4]
+		star_x_min = sex_output['XMIN_IMAGE']
+		star_y_min = sex_output['YMIN_IMAGE']
+		star_x_max = sex_output['XMAX_IMAGE']
+		star_y_max = sex_output['YMAX_IMAGE']
 
 		dist_to_asteroid = []
 
@@ -1,6 +1,8 @@
-import warnings, subprocess, sys
+import warnings, subprocess, sys, tracemalloc, csv, math, time, traceback, contextlib, json, hashlib
 import numpy as np
 import astropy as ap
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
 #import exoplanet as xo
 
 # import matplotlib.pyplot as plt
@@ -10,8 +12,14 @@ from astropy.timeseries import LombScargle
 from astropy.timeseries import TimeSeries
 # from matplotlib import colors
 from astropy.io import fits
-from scipy.ndimage import rotate
-from scipy.special import erf
+from scipy.ndimage import rotate, map_coordinates, spline_filter, label, find_objects, median_filter
+from scipy.interpolate import RectBivariateSpline
+from scipy.special import erf, cosdg, sindg
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 from astropy.wcs import WCS
 from astropy.wcs import utils
 from astropy.coordinates import SkyCoord
@@ -19,13 +27,49 @@ from astropy import units as u
 
 from astropy.utils.exceptions import AstropyWarning
 
-try:
-	f_name 		 = sys.argv[1]
-	l_from_input = sys.argv[2]
-	a_from_input = sys.argv[3]
-	write_output = sys.argv[4]
-except Exception as e:
-	print(e)
+# rotated frames are shared between angles within rotation_tol [degrees], at most rotation_cache_size kept per frame
+rotation_tol        = 0.01
+rotation_cache_size = 4
+
+# float32 images, rotations, models and extraction instead of float64 -- about half the memory per frame
+use_float32 = False
+
+# print peak memory per stage for every frame (tracemalloc, slows things down a little)
+memory_report = False
+
+# fit all comparison stars on a frame at once with shared s, L, a (fit_stars_joint) instead of one by one
+joint_star_fit = False
+
+# keep fitted trail parameters in fit_cache_dir (FitCache) and reuse them when the same pixels are fit again -- None = off.
+# at most fit_cache_size entries are kept, least recently used go first
+fit_cache_dir  = None
+fit_cache_size = 200000
+
+# start each frame's fits from the previous frame of the same object -- its converged s, L, a, b and its star list
+# (mapped through the WCS). the usual starting point is used instead when L is off by more than warm_start_tol, when
+# fewer than warm_start_min_stars carried stars are usable, and for warm started fits that fail
+warm_start           = False
+warm_start_tol       = 0.25
+warm_start_min_stars = 10
+
+# every frame's lightcurves and fit parameters go in one <frame>/lightcurves.npz (save_frame_lightcurves, read back
+# with FrameLightcurves). with text_output the old star_params.dat, lightcurve_star_<i>.dat and lightcurve_asteroid.dat
+# are written next to it as well
+text_output = False
+
+# find stars with detect_sources() on the frame itself instead of reading the SEoutput/ catalogs
+native_detection = False
+
+# comparison star selection (select_stars) : no other detection within star_isolation * asteroid FWHM (0 = off),
+# no peak pixel at or above saturation_level [ADU] (None = off)
+star_isolation   = 0
+saturation_level = None
+
+# the settings above -- run_batch() hands them to its workers (pipeline_settings, apply_settings), so they hold whether
+# the workers are forked or spawned
+setting_names = ['rotation_tol', 'rotation_cache_size', 'use_float32', 'memory_report', 'joint_star_fit', 'fit_cache_dir',
+                 'fit_cache_size', 'warm_start', 'warm_start_tol', 'warm_start_min_stars', 'text_output', 'native_detection',
+                 'star_isolation', 'saturation_level']
 
 # plt.rcParams.update({'figure.max_open_warning': 0})
 warnings.simplefilter('ignore', AstropyWarning)
@@ -34,12 +78,8 @@ warnings.simplefilter('ignore', AstropyWarning)
 import os
 from os.path import isdir, isfile, join
 directory = './'	
-dir_names = [directory+f+'/' for f in os.listdir(directory) if isdir(join(directory,f))] 
-
-input_file = np.loadtxt('input.csv', dtype=object, skiprows=1, usecols=(i for i in range(25)), delimiter=',')
 
 se_dir   = './SEoutput/'
-se_files = [se_dir+f for f in os.listdir(se_dir) if isfile(join(se_dir,f))]
 
 mins = {'g':100, 'r': 150, 'i': 250}
 
@@ -71,17 +111,7 @@ y_ : float
 	rotated CCD row pixel coordinate
 """
 def point_rotation( x , y , a , img , img_rot ):
-	a = -a * np.pi/180
-	x_0, y_0 = 0, 0
-	x_0_, y_0_ = img.shape[0]*np.abs(np.sin(a)), img.shape[1]*np.abs(np.sin(a))
-	x_, y_ = np.array((x-x_0)*np.cos(a) - (y-y_0)*np.sin(a), dtype=int), np.array((x-x_0)*np.sin(a) + (y-y_0)*np.cos(a), dtype=int)
-	# to account for direction of rotation
-	if   a>0: x_+= int(x_0_)
-	elif a<0: y_+= int(y_0_)
-
-	if x_<0: x_=0
-	if y_<0: y_=0
-
+	x_, y_ = point_rotation_batch([[x, y]], a, img)[0]
 	return x_, y_
 
 """
@@ -105,19 +135,1441 @@ star_y_rot : float
 	un-rotated CCD row pixel coordinate
 """
 def reverse_rotation( star_x , star_y , a , img ):
-	a *= -np.pi/180
-	if a>0: 
-		m = img.shape[0] * np.abs(np.sin(a))
-		star_x_rot =  (star_x -m) * np.cos(a) + star_y * np.sin(a) 
-		star_y_rot = -(star_x -m) * np.sin(a) + star_y * np.cos(a)
-
-	elif a<0:
-		# a *= -np.pi/180
-		m = img.shape[1] * np.abs(np.sin(a))
-		star_x_rot =  (star_x) * np.cos(a) + (star_y -m) * np.sin(a)
-		star_y_rot = -(star_x) * np.sin(a) + (star_y -m) * np.cos(a)
+	star_x_rot, star_y_rot = reverse_rotation_batch([[star_x, star_y]], a, img)[0]
 	return star_x_rot, star_y_rot
 
+"""
+offset of the rotated frame's origin -- scipy.ndimage.rotate(reshape=True) grows the frame by img.shape * |sin(a)|
+	along x for one direction of rotation and along y for the other
+
+PARAMETERS
+-----------
+a   : float
+	angle [radians], already negated like in point_rotation()
+img : array
+	original image rotated from
+
+RETURNS
+--------
+x_off : float
+	column offset of the rotated frame
+y_off : float
+	row offset of the rotated frame
+"""
+def rotation_offset( a , img ):
+	x_off, y_off = 0., 0.
+	if   a>0: x_off = img.shape[0]*np.abs(np.sin(a))
+	elif a<0: y_off = img.shape[1]*np.abs(np.sin(a))
+	return x_off, y_off
+
+"""
+point_rotation() for many points at once
+
+PARAMETERS
+-----------
+coords : array
+	Nx2 array of [ x , y ] ccd pixel coordinates
+a      : float
+	angle [degrees] the image was rotated by
+img    : array
+	original image rotated from
+dtype  : type
+	(optional) int truncates like point_rotation() does, float keeps the exact rotated coordinates ; default = int
+clip   : bool
+	(optional) clamp negative coordinates to 0 like point_rotation() does ; default = True
+
+RETURNS
+--------
+coords_ : array
+	Nx2 array of rotated [ x , y ] ccd pixel coordinates, dtype = dtype
+"""
+def point_rotation_batch( coords , a , img , dtype=int , clip=True ):
+	coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+	a = -a * np.pi/180
+	x_off, y_off = rotation_offset(a, img)
+
+	x_ = coords[:,0]*np.cos(a) - coords[:,1]*np.sin(a)
+	y_ = coords[:,0]*np.sin(a) + coords[:,1]*np.cos(a)
+
+	if np.issubdtype(dtype, np.integer):
+		# truncate before adding the (truncated) offset, same as point_rotation() always has
+		x_ = np.trunc(x_) + int(x_off)
+		y_ = np.trunc(y_) + int(y_off)
+	else:
+		x_ = x_ + x_off
+		y_ = y_ + y_off
+
+	coords_ = np.column_stack((x_, y_))
+	if clip: coords_ = np.maximum(coords_, 0)
+
+	return coords_.astype(dtype)
+
+"""
+reverse_rotation() for many points at once -- exact inverse of point_rotation_batch(dtype=float, clip=False)
+
+PARAMETERS
+-----------
+coords : array
+	Nx2 array of [ x , y ] ccd pixel coordinates in rotated frame
+a      : float
+	angle [degrees] the image was rotated by
+img    : array
+	original image rotated from -- trying to rotate back to this frame
+dtype  : type
+	(optional) float, or int to truncate ; default = float
+
+RETURNS
+--------
+coords_rot : array
+	Nx2 array of un-rotated [ x , y ] ccd pixel coordinates, dtype = dtype
+"""
+def reverse_rotation_batch( coords , a , img , dtype=float ):
+	coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+	a = -a * np.pi/180
+	x_off, y_off = rotation_offset(a, img)
+
+	star_x = coords[:,0] - x_off
+	star_y = coords[:,1] - y_off
+
+	star_x_rot =  star_x * np.cos(a) + star_y * np.sin(a)
+	star_y_rot = -star_x * np.sin(a) + star_y * np.cos(a)
+
+	coords_rot = np.column_stack((star_x_rot, star_y_rot))
+	if np.issubdtype(dtype, np.integer): coords_rot = np.trunc(coords_rot)
+
+	return coords_rot.astype(dtype)
+
+"""
+per frame cache of scipy.ndimage.rotate(img, angle)
+	angles are snapped to a multiple of tol before rotating, so star trails whose fitted angles agree to within tol
+	share one rotated frame. the snapped angle is handed back with the frame -- use it for point_rotation() etc,
+	not the angle asked for. only the maxsize most recently used frames are kept
+
+	usage:  > rotations = RotationCache(img)
+	        > angle, img_rotated = rotations.rotate(angle)
+
+PARAMETERS
+-----------
+img     : array
+	original (unrotated) 2d numpy image
+tol     : float
+	(optional) angle quantization [degrees], 0 to only reuse identical angles ; default = 0.01
+maxsize : int
+	(optional) number of rotated frames kept ; default = 4
+"""
+class RotationCache:
+
+	def __init__(self, img, tol=0.01, maxsize=4):
+		self.img     = img
+		self.tol     = tol
+		self.maxsize = maxsize
+		self.frames  = OrderedDict()	# snapped angle -> rotated frame, least recently used first
+		self.hits    = 0
+		self.misses  = 0
+
+	'''
+	angle snapped to the cache's grid
+	'''
+	def quantize(self, angle):
+		if self.tol <= 0: return float(angle)
+		return float(np.round(angle / self.tol) * self.tol)
+
+	'''
+	( snapped angle , img rotated by the snapped angle )
+	'''
+	def rotate(self, angle):
+		angle = self.quantize(angle)
+
+		if angle in self.frames:
+			self.hits += 1
+			self.frames.move_to_end(angle)
+			return angle, self.frames[angle]
+
+		self.misses += 1
+		img_rot = rotate(self.img, angle)
+		self.frames[angle] = img_rot
+		while len(self.frames) > self.maxsize:
+			self.frames.popitem(last=False)
+
+		return angle, img_rot
+
+	def __str__(self):
+		return f'rotation cache: {self.hits} hits, {self.misses} misses, {len(self.frames)}/{self.maxsize} frames'
+
+"""
+peak traced memory per pipeline stage, via tracemalloc (numpy reports its array buffers to it)
+	call mark(stage) at the end of every stage -- the peak since the previous mark is booked to that stage.
+	only sees this process, the fit_stars() workers aren't counted. does nothing unless enabled
+
+	usage:  > memory = MemoryReport()
+	        > img_rotated = rotate(img, angle)
+	        > memory.mark('rotation')
+	        > print(memory)
+
+PARAMETERS
+-----------
+enabled : bool
+	(optional) turn tracemalloc on and record ; default = True
+"""
+class MemoryReport:
+
+	def __init__(self, enabled=True):
+		self.enabled = enabled
+		self.peaks   = OrderedDict()	# stage -> peak bytes
+		if enabled and not tracemalloc.is_tracing():
+			tracemalloc.start()
+
+	'''
+	start over, e.g. for a new frame
+	'''
+	def reset(self):
+		self.peaks.clear()
+		if self.enabled: tracemalloc.reset_peak()
+
+	'''
+	book the peak since the last mark to stage
+	'''
+	def mark(self, stage):
+		if not self.enabled: return
+		current, peak = tracemalloc.get_traced_memory()
+		self.peaks[stage] = max(self.peaks.get(stage, 0), peak)
+		tracemalloc.reset_peak()
+
+	def __str__(self):
+		lines = [f'{stage:>20} : {peak/2**20:9.1f} MB' for stage, peak in self.peaks.items()]
+		if self.peaks: lines.append(f'{"peak":>20} : {max(self.peaks.values())/2**20:9.1f} MB')
+		return '\n'.join(lines)
+
+"""
+cheap check for whether path is a FITS frame -- by extension, else by the 'SIMPLE  =' card every FITS file starts with
+	reads at most 9 bytes, so directories full of .txt/.dat outputs are skipped without fits.open()
+
+PARAMETERS
+-----------
+path       : str
+	file path
+extensions : tuple
+	(optional) extensions taken as FITS without looking inside ; default = ('.flt', '.fits', '.fit', '.fts')
+
+RETURNS
+--------
+is_fits : bool
+"""
+def is_fits_frame( path , extensions=('.flt', '.fits', '.fit', '.fts') ):
+	if path.lower().endswith(extensions): return True
+	try:
+		with open(path, 'rb') as fh:
+			return fh.read(9) == b'SIMPLE  ='
+	except OSError:
+		return False
+
+"""
+lazily loaded FITS frame
+	the primary header is read on construction (EXPMEAS, GAIN, RDNOISE, FILTER etc) without touching the pixels.
+	pixel data is only opened -- memory mapped -- on first use of data or cutout(), and only the pages a slice
+	actually reads get loaded. scaled integer images (BZERO/BSCALE) are still read whole by astropy on data
+
+	usage:  > frame = Frame(f)
+	        > exp_time = frame.exp_time
+	        > img = frame.data
+	        > frame.close()
+
+PARAMETERS
+-----------
+path : str
+	path to the FITS file
+"""
+class Frame:
+
+	def __init__(self, path):
+		self.path   = path
+		self.header = fits.getheader(path, 0)
+		self.hdul   = None
+
+	@property
+	def hdu(self):
+		if self.hdul is None:
+			self.hdul = fits.open(self.path, memmap=True, lazy_load_hdus=True)
+		return self.hdul[0]
+
+	'''
+	memory mapped 2d image, nothing is read until it's indexed
+	'''
+	@property
+	def data(self):
+		return self.hdu.data
+
+	@property
+	def shape(self):
+		return (int(self.header['NAXIS2']), int(self.header['NAXIS1']))
+
+	@property
+	def exp_time(self):
+		return float(self.header['EXPMEAS'])
+
+	@property
+	def gain(self):
+		return float(self.header['GAIN'])
+
+	@property
+	def rd_noise(self):
+		return float(self.header['RDNOISE'])
+
+	@property
+	def obs_filter(self):
+		return str(self.header['FILTER'])
+
+	'''
+	img[rows, cols] read straight from the file (slices), without mapping or scaling the whole image
+	'''
+	def cutout(self, rows, cols):
+		return self.hdu.section[rows, cols]
+
+	def close(self):
+		if self.hdul is not None:
+			self.hdul.close()
+			self.hdul = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+# columns of input.csv, in order. missing numbers are nan (floats) or -1 (ints)
+observation_dtype = np.dtype([
+	('filename', 'U32'), ('object', 'U32'), ('H', 'f8'), ('a_au', 'f8'), ('e', 'f8'), ('inc', 'f8'),
+	('jd', 'f8'), ('ra', 'f8'), ('dec', 'f8'), ('image_id', 'i8'), ('chip_id', 'i4'),
+	('exp_time', 'f8'), ('dt_last', 'f8'), ('filter', 'U16'),
+	('g_obs', 'i4'), ('r_obs', 'i4'), ('i_obs', 'i4'),
+	('rate_ra', 'f8'), ('rate_dec', 'f8'), ('track_ra', 'f8'), ('track_dec', 'f8'),
+	('trail_start', 'i8', (2,)), ('trail_end', 'i8', (2,)), ('fwhm', 'f8'), ('notes', 'U128'),
+	('has_trail', '?'),
+])
+
+# bump when parse_observations() changes what it reads, so old input.csv sidecars are rebuilt
+observation_parser_version = 2
+
+"""
+parse input.csv into a structured array with observation_dtype, one row per frame
+
+PARAMETERS
+-----------
+path : str
+	(optional) csv file ; default = 'input.csv'
+
+RETURNS
+--------
+table : array
+	structured numpy array
+"""
+def parse_observations( path='input.csv' ):
+	names = observation_dtype.names
+	with open(path, newline='') as fh:
+		rows = list(csv.reader(fh))[1:]
+
+	table = np.zeros(len(rows), dtype=observation_dtype)
+	for i, row in enumerate(rows):
+		row = (row + [''] * 27)[:27]
+		fields = row[:21] + [row[21:23], row[23:25]] + row[25:]
+		for name, value in zip(names, fields):
+			kind = observation_dtype[name].base.kind
+			if kind == 'U':
+				table[name][i] = value.strip()
+			elif kind == 'f':
+				table[name][i] = float(value) if value.strip() else np.nan
+			elif isinstance(value, str):
+				table[name][i] = int(float(value)) if value.strip() else -1
+			else:
+				table[name][i] = [int(float(v)) if v.strip() else -1 for v in value]
+		table['has_trail'][i] = all(v.strip() for v in row[21:25])
+
+	return table
+
+"""
+input.csv indexed by filename and by object -- replaces np.where() scans over np.loadtxt(dtype=object)
+	rows are records of observation_dtype, so trail_start/trail_end come back as int arrays and jd / exp_time as floats
+
+	usage:  > observations = load_observations('input.csv')
+	        > obs = observations.lookup('1917066o13.flt', '2016 GE1')
+	        > if obs is None or not obs['has_trail']: continue
+	        > trail_start, trail_end = obs['trail_start'], obs['trail_end']
+
+PARAMETERS
+-----------
+table : array
+	structured array from parse_observations()
+"""
+class ObservationCatalog:
+
+	def __init__(self, table):
+		self.table     = table
+		self.by_file   = {name: i for i, name in enumerate(table['filename'])}
+		self.by_object = {}
+		for i, obj_id in enumerate(table['object']):
+			self.by_object.setdefault(obj_id, []).append(i)
+		self.by_object = {obj_id: np.array(idx) for obj_id, idx in self.by_object.items()}
+
+	'''
+	row for filename (basename, as in input.csv), None if it's not there -- or belongs to another object than obj_id
+		a copy, so shifting trail_start/trail_end in place doesn't touch the catalog
+	'''
+	def lookup(self, filename, obj_id=None):
+		i = self.by_file.get(filename)
+		if i is None: return None
+		if obj_id is not None and self.table['object'][i] != obj_id: return None
+		return self.table[i].copy()
+
+	'''
+	all rows of one object
+	'''
+	def rows(self, obj_id):
+		return self.table[self.by_object.get(obj_id, np.array([], dtype=int))]
+
+	def __len__(self):
+		return len(self.table)
+
+	def __contains__(self, filename):
+		return filename in self.by_file
+
+"""
+load input.csv as an ObservationCatalog, through a binary sidecar (path + '.v<observation_parser_version>.npy') that is
+	rebuilt when the csv is newer. sidecars of other parser versions are never read
+
+PARAMETERS
+-----------
+path  : str
+	(optional) csv file ; default = 'input.csv'
+cache : bool
+	(optional) read / write the .npy sidecar ; default = True
+
+RETURNS
+--------
+observations : ObservationCatalog
+"""
+def load_observations( path='input.csv' , cache=True ):
+	sidecar = f'{path}.v{observation_parser_version}.npy'
+
+	if cache and isfile(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+		try:
+			table = np.load(sidecar, allow_pickle=False)
+			if table.dtype == observation_dtype: return ObservationCatalog(table)
+		except (OSError, ValueError):
+			pass
+
+	table = parse_observations(path)
+	if cache:
+		try:
+			np.save(sidecar, table)
+		except OSError:
+			pass
+
+	return ObservationCatalog(table)
+
+"""
+read a SExtractor ASCII_HEAD catalog into a structured array, columns named from the '#' header (X_IMAGE, Y_IMAGE, ...)
+	vector columns (e.g. FLUX_APER with 3 apertures) get NAME, NAME_2, NAME_3 ... the parsed array is kept in a
+	path + '.npy' sidecar that is only reused while it is newer than the catalog
+
+PARAMETERS
+-----------
+path  : str
+	.cat file
+cache : bool
+	(optional) read / write the .npy sidecar ; default = True
+
+RETURNS
+--------
+catalog : array
+	structured numpy array, one row per detection, all columns float
+"""
+def read_se_catalog( path , cache=True ):
+	sidecar = path + '.npy'
+	if cache and isfile(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+		try:
+			return np.load(sidecar, allow_pickle=False)
+		except (OSError, ValueError):
+			pass
+
+	header = []
+	with open(path) as fh:
+		for line in fh:
+			if not line.startswith('#'): break
+			header.append(line.split())
+
+	data = np.loadtxt(path, comments='#', ndmin=2)
+
+	# '#   6 X_IMAGE   ...' -> column 6 is X_IMAGE ; a gap before the next number means a vector column
+	starts = [int(h[1]) - 1 for h in header] + [data.shape[1]]
+	names  = []
+	for i, h in enumerate(header):
+		width = starts[i+1] - starts[i]
+		names += [h[2]] + [f'{h[2]}_{j+1}' for j in range(1, width)]
+
+	catalog = np.zeros(data.shape[0], dtype=[(name, 'f8') for name in names])
+	for j, name in enumerate(names):
+		catalog[name] = data[:,j]
+
+	if cache:
+		try:
+			np.save(sidecar, catalog)
+		except OSError:
+			pass
+
+	return catalog
+
+"""
+SExtractor catalogs of se_dir indexed by (object directory, frame id) -- catalogs are named <directory>_<frame id>.cat
+	so a frame's catalog is a dict hit instead of substring tests over every file. parsed catalogs are kept in memory
+	and on disk (read_se_catalog())
+
+	usage:  > se_catalogs = SECatalogIndex('./SEoutput/')
+	        > catalog = se_catalogs.lookup('./2016_GE1_2016_04_04_UTC/1917066o13.flt')
+	        > star_x, star_y = catalog['X_IMAGE'], catalog['Y_IMAGE']
+
+PARAMETERS
+-----------
+se_dir : str
+	(optional) directory of .cat files ; default = './SEoutput/'
+cache  : bool
+	(optional) keep .npy sidecars of the parsed catalogs ; default = True
+"""
+class SECatalogIndex:
+
+	def __init__(self, se_dir='./SEoutput/', cache=True):
+		self.se_dir   = se_dir
+		self.cache    = cache
+		self.paths    = {}	# (directory, frame id) -> .cat path
+		self.catalogs = {}	# .cat path -> parsed catalog
+		for name in sorted(os.listdir(se_dir)):
+			if not name.endswith('.cat'): continue
+			directory, _, frame_id = name[:-4].rpartition('_')
+			self.paths[(directory, frame_id)] = join(se_dir, name)
+
+	'''
+	(object directory, frame id) of a frame path like './<directory>/<frame id>.flt'
+	'''
+	def key(self, f):
+		parts = f.split('/')
+		return parts[-2], parts[-1].split('.')[0]
+
+	'''
+	path to the catalog of frame f, None if SExtractor wasn't run on it
+	'''
+	def path(self, f):
+		return self.paths.get(self.key(f))
+
+	'''
+	parsed catalog of frame f, None if there is none
+	'''
+	def lookup(self, f):
+		path = self.path(f)
+		if path is None: return None
+		if path not in self.catalogs:
+			self.catalogs[path] = read_se_catalog(path, cache=self.cache)
+		return self.catalogs[path]
+
+	def __len__(self):
+		return len(self.paths)
+
+	def __contains__(self, f):
+		return self.key(f) in self.paths
+
+"""
+the k usable detections nearest to centre, nearest first -- one KD-tree over the catalog instead of argsort + np.delete
+	a detection is usable when it is at least edge from the image border, farther than trail_width from the
+	trail segment (the asteroid itself and stars crossing it), below saturation and has no other detection
+	within isolation. the tree is walked outwards from centre until k usable ones are found
+
+PARAMETERS
+-----------
+star_xy     : array
+	(n, 2) 0-based detection (x, y) pixel positions, like shape, centre and trail -- SExtractor X_IMAGE, Y_IMAGE
+	(and detect_sources()) are 1-based, subtract 1 first
+centre      : array
+	(x, y) to measure distance from
+k           : int
+	(optional) max number of stars returned ; default = 50
+shape       : tuple
+	(optional) (rows, columns) of the image, needed for the edge cut ; default = None
+edge        : float
+	(optional) min distance from the image border [pixels] ; default = 0
+trail       : tuple
+	(optional) ( (x, y) start , (x, y) end ) of a trail to keep clear of ; default = None
+trail_width : float
+	(optional) min distance from the trail segment [pixels] ; default = 0
+isolation   : float
+	(optional) min distance to the nearest other detection [pixels], 0 to skip ; default = 0
+peaks       : array
+	(optional) peak pixel value of every detection, for the saturation cut ; default = None
+saturation  : float
+	(optional) detections with peaks >= saturation are dropped ; default = None
+
+RETURNS
+--------
+selected : array
+	indices into star_xy of the selected stars, nearest to centre first
+"""
+def select_stars( star_xy , centre , k=50 , shape=None , edge=0 , trail=None , trail_width=0 , isolation=0 , peaks=None , saturation=None ):
+	star_xy = np.asarray(star_xy, dtype=float).reshape(-1, 2)
+	n = len(star_xy)
+	if n == 0 or k <= 0: return np.array([], dtype=int)
+
+	x, y   = star_xy[:,0], star_xy[:,1]
+	usable = np.ones(n, dtype=bool)
+
+	if shape is not None:
+		usable &= (x >= edge) & (x <= shape[1] - edge) & (y >= edge) & (y <= shape[0] - edge)
+
+	if trail is not None and trail_width > 0:
+		start, end = np.asarray(trail[0], dtype=float), np.asarray(trail[1], dtype=float)
+		seg = end - start
+		t   = np.clip(((star_xy - start) @ seg) / max(seg @ seg, 1e-12), 0, 1)
+		usable &= np.hypot(*(star_xy - start - t[:,None] * seg).T) > trail_width
+
+	if saturation is not None and peaks is not None:
+		usable &= np.asarray(peaks) < saturation
+
+	tree = cKDTree(star_xy)
+
+	if isolation > 0 and n > 1:
+		nearest, _ = tree.query(star_xy, k=2)
+		usable &= nearest[:,1] >= isolation
+
+	# walk outwards from centre, doubling the neighbourhood until k usable stars turn up
+	m = min(n, 2 * k)
+	while True:
+		_, order = tree.query(centre, k=m)
+		order    = np.atleast_1d(order)
+		selected = order[usable[order]]
+		if len(selected) >= k or m == n: return selected[:k]
+		m = min(n, 2 * m)
+
+"""
+SExtractor style background and background rms maps
+	sigma clipped (3 sigma, 3 passes) mode of every back_size x back_size mesh -- 2.5 median - 1.5 mean, or the median
+	if the mesh is crowded -- median filtered over filter_size meshes and bicubic spline interpolated to full resolution
+
+PARAMETERS
+-----------
+img         : array
+	2d numpy image
+back_size   : int
+	(optional) mesh size [pixels] ; default = 20 (BACK_SIZE in default.sex)
+filter_size : int
+	(optional) median filter size [meshes] ; default = 3 (BACK_FILTERSIZE in default.sex)
+
+RETURNS
+--------
+background : array
+	background map, img.shape, float32
+rms        : array
+	background noise map, img.shape, float32
+"""
+def background_mesh( img , back_size=20 , filter_size=3 ):
+	rows, cols = img.shape
+	ny, nx     = -(-rows // back_size), -(-cols // back_size)
+
+	# meshes as (ny, nx, back_size**2), the ragged last row / column padded with nan
+	padded = np.full((ny * back_size, nx * back_size), np.nan, dtype=np.float32)
+	padded[:rows, :cols] = img
+	meshes = padded.reshape(ny, back_size, nx, back_size).swapaxes(1, 2).reshape(ny, nx, -1)
+
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)
+		for _ in range(3):
+			med    = np.nanmedian(meshes, axis=2)
+			std    = np.nanstd(meshes, axis=2)
+			meshes = np.where(np.abs(meshes - med[:,:,None]) <= 3 * std[:,:,None], meshes, np.nan)
+
+		med  = np.nanmedian(meshes, axis=2)
+		mean = np.nanmean(meshes, axis=2)
+		std  = np.nanstd(meshes, axis=2)
+
+	mode = np.where(np.abs(mean - med) < 0.3 * std, 2.5 * med - 1.5 * mean, med)
+	mode = np.where(np.isfinite(mode), mode, np.nanmedian(mode))
+	std  = np.where(np.isfinite(std), std, np.nanmedian(std))
+
+	if filter_size > 1:
+		mode = median_filter(mode, size=filter_size, mode='nearest')
+		std  = median_filter(std, size=filter_size, mode='nearest')
+
+	# spline through the mesh centres, evaluated on every pixel
+	mesh_rows = (np.arange(ny) + .5) * back_size - .5
+	mesh_cols = (np.arange(nx) + .5) * back_size - .5
+	maps = []
+	for grid in (mode, std):
+		if ny < 2 or nx < 2:
+			maps.append(np.full(img.shape, np.mean(grid), dtype=np.float32))
+			continue
+		spline = RectBivariateSpline(mesh_rows, mesh_cols, grid, kx=min(3, ny-1), ky=min(3, nx-1), bbox=[min(0, mesh_rows[0]), max(rows-1, mesh_rows[-1]), min(0, mesh_cols[0]), max(cols-1, mesh_cols[-1])])
+		maps.append(spline(np.arange(rows), np.arange(cols)).astype(np.float32))
+
+	return maps[0], maps[1]
+
+# columns detect_sources() returns, as in default.param
+se_columns = ('NUMBER', 'XMIN_IMAGE', 'YMIN_IMAGE', 'XMAX_IMAGE', 'YMAX_IMAGE', 'X_IMAGE', 'Y_IMAGE', 'X2_IMAGE', 'Y2_IMAGE')
+
+"""
+in-process stand-in for the SExtractor run -- background mesh, threshold, 8-connected labelling, moments
+	returns the default.param columns with SExtractor's conventions (1-based pixel coordinates, background subtracted
+	first and second moments over the pixels above threshold), so it drops in for read_se_catalog() output.
+	no deblending and no detection filter (FILTER N in default.sex)
+
+PARAMETERS
+-----------
+img         : array
+	2d numpy image
+thresh      : float
+	(optional) detection threshold [background rms] ; default = 5 (DETECT_THRESH)
+minarea     : int
+	(optional) min number of pixels above threshold ; default = 5 (DETECT_MINAREA)
+back_size   : int
+	(optional) background mesh size [pixels] ; default = 20
+filter_size : int
+	(optional) background median filter size [meshes] ; default = 3
+
+RETURNS
+--------
+catalog : array
+	structured numpy array with se_columns, one row per detection, all columns float
+"""
+def detect_sources( img , thresh=5 , minarea=5 , back_size=20 , filter_size=3 ):
+	background, rms = background_mesh(img, back_size=back_size, filter_size=filter_size)
+
+	signal  = np.asarray(img, dtype=np.float32) - background
+	objects, n = label(signal > thresh * rms, structure=np.ones((3, 3)))
+	del background, rms
+
+	catalog = np.zeros(0, dtype=[(name, 'f8') for name in se_columns])
+	if n == 0: return catalog
+
+	# per object sums over its pixels, weights are the background subtracted pixel values
+	pixels = np.flatnonzero(objects)
+	ids    = objects.ravel()[pixels]
+	w      = signal.ravel()[pixels].astype(np.float64)
+	y, x   = np.divmod(pixels, img.shape[1])
+	del signal
+
+	area = np.bincount(ids, minlength=n+1)[1:]
+	sw   = np.bincount(ids, w, minlength=n+1)[1:]
+	sx   = np.bincount(ids, w * x, minlength=n+1)[1:]
+	sy   = np.bincount(ids, w * y, minlength=n+1)[1:]
+	sxx  = np.bincount(ids, w * x * x, minlength=n+1)[1:]
+	syy  = np.bincount(ids, w * y * y, minlength=n+1)[1:]
+
+	keep  = np.flatnonzero((area >= minarea) & (sw > 0))
+	boxes = find_objects(objects)
+	sw    = sw[keep]
+
+	catalog = np.zeros(len(keep), dtype=catalog.dtype)
+	catalog['NUMBER']     = np.arange(1, len(keep) + 1)
+	catalog['XMIN_IMAGE'] = [boxes[i][1].start + 1 for i in keep]
+	catalog['YMIN_IMAGE'] = [boxes[i][0].start + 1 for i in keep]
+	catalog['XMAX_IMAGE'] = [boxes[i][1].stop      for i in keep]
+	catalog['YMAX_IMAGE'] = [boxes[i][0].stop      for i in keep]
+	catalog['X_IMAGE']    = sx[keep] / sw + 1
+	catalog['Y_IMAGE']    = sy[keep] / sw + 1
+	catalog['X2_IMAGE']   = sxx[keep] / sw - (sx[keep] / sw) ** 2
+	catalog['Y2_IMAGE']   = syy[keep] / sw - (sy[keep] / sw) ** 2
+
+	return catalog
+
+# refcat.c STARDAT -- one star of a binary refcat2 tile, 72 bytes, byte order from the tile's header
+refcat_stardat = [
+	('ra', 'u4'), ('cdec', 'u4'), ('plx', 'i4'), ('pmra', 'i4'), ('pmdec', 'i4'),
+	('Teff', 'i2'), ('AG', 'u2'), ('Ag', 'u2'), ('G', 'i2'), ('B', 'i2'), ('R', 'i2'), ('g', 'i2'), ('r', 'i2'),
+	('i', 'i2'), ('z', 'i2'), ('J', 'i2'), ('H', 'i2'), ('K', 'i2'),
+	('rp1', 'u1'), ('r1', 'u1'), ('r10', 'u1'), ('dplx', 'u1'), ('dpmra', 'u1'), ('dpmdec', 'u1'),
+	('dG', 'u1'), ('dB', 'u1'), ('dR', 'u1'), ('dg', 'u1'), ('dr', 'u1'), ('di', 'u1'), ('dz', 'u1'),
+	('dJ', 'u1'), ('dH', 'u1'), ('dK', 'u1'), ('nstat', 'u1'), ('dupvar', 'u1'),
+	('gchi', 'u1'), ('gcontrib', 'u1'), ('rchi', 'u1'), ('rcontrib', 'u1'),
+	('ichi', 'u1'), ('icontrib', 'u1'), ('zchi', 'u1'), ('zcontrib', 'u1'),
+]
+refcat_magic = 3141592653
+
+# refcat.c STAR -- [deg] [deg/yr] [mag], field order of the CSV tiles
+# name : (binary field, binary scale, csv scale, divisor) -- value = scale * raw / divisor, as read_bin() / read_csv()
+refcat_fields = OrderedDict([
+	('ra',     ('ra',     1e-7, 1e-8, None)),   ('dec',    ('cdec',  1e-7, 1e-8, None)),
+	('plx',    ('plx',    1e-5, 1e-5, 3600.0)), ('dplx',   ('dplx',  1e-5, 1e-5, 3600.0)),
+	('pmra',   ('pmra',   1e-5, 1e-5, 3600.0)), ('dpmra',  ('dpmra', 1e-5, 1e-5, 3600.0)),
+	('pmdec',  ('pmdec',  1e-5, 1e-5, 3600.0)), ('dpmdec', ('dpmdec',1e-5, 1e-5, 3600.0)),
+	('G',      ('G',      1e-3, 1e-3, None)),   ('dG',     ('dG',    2e-3, 1e-3, None)),
+	('B',      ('B',      1e-3, 1e-3, None)),   ('dB',     ('dB',    2e-3, 1e-3, None)),
+	('R',      ('R',      1e-3, 1e-3, None)),   ('dR',     ('dR',    2e-3, 1e-3, None)),
+	('Teff',   ('Teff',   None, None, None)),   ('AG',     ('AG',    1e-3, 1e-3, None)),
+	('dupvar', ('dupvar', None, None, None)),   ('Ag',     ('Ag',    1e-3, 1e-3, None)),
+	('rp1',    ('rp1',    2e-1, 1e-1, 3600.0)), ('r1',     ('r1',    2e-1, 1e-1, 3600.0)),
+	('r10',    ('r10',    2e-1, 1e-1, 3600.0)),
+	('g',      ('g',      1e-3, 1e-3, None)),   ('dg',     ('dg',    2e-3, 1e-3, None)),
+	('gchi',   ('gchi',   1e-1, 1e-2, None)),   ('gcontrib', ('gcontrib', None, None, None)),
+	('r',      ('r',      1e-3, 1e-3, None)),   ('dr',     ('dr',    2e-3, 1e-3, None)),
+	('rchi',   ('rchi',   1e-1, 1e-2, None)),   ('rcontrib', ('rcontrib', None, None, None)),
+	('i',      ('i',      1e-3, 1e-3, None)),   ('di',     ('di',    2e-3, 1e-3, None)),
+	('ichi',   ('ichi',   1e-1, 1e-2, None)),   ('icontrib', ('icontrib', None, None, None)),
+	('z',      ('z',      1e-3, 1e-3, None)),   ('dz',     ('dz',    2e-3, 1e-3, None)),
+	('zchi',   ('zchi',   1e-1, 1e-2, None)),   ('zcontrib', ('zcontrib', None, None, None)),
+	('nstat',  ('nstat',  None, None, None)),
+	('J',      ('J',      1e-3, 1e-3, None)),   ('dJ',     ('dJ',    2e-3, 1e-3, None)),
+	('H',      ('H',      1e-3, 1e-3, None)),   ('dH',     ('dH',    2e-3, 1e-3, None)),
+	('K',      ('K',      1e-3, 1e-3, None)),   ('dK',     ('dK',    2e-3, 1e-3, None)),
+])
+refcat_ints = ('dupvar', 'gcontrib', 'rcontrib', 'icontrib', 'zcontrib', 'nstat')
+refcat_star = np.dtype([(name, 'i4' if name in refcat_ints else 'f8') for name in refcat_fields])
+
+'''
+refcat.c adoffset() -- sky unit vector offset by da, dd [rad] from the great circles with poles a, d
+'''
+def refcat_adoffset( a , d , da , dd ):
+	if abs(da) + abs(dd) >= math.pi/2: return (0., 0., 0.)
+
+	y = math.sin(da)
+	z = math.sin(dd)
+	x = math.sqrt(1 - y*y - z*z)
+
+	sa, ca = -a[0], a[1]
+	sd = -d[0]/ca if abs(ca) > 0.7 else -d[1]/sa
+	cd = d[2]
+
+	x, z = x * cd - z * sd, x * sd + z * cd
+	x, y = x * ca - y * sa, x * sa + y * ca
+	return (x, y, z)
+
+def refcat_dot( a , b ):
+	return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
+
+"""
+reads ATLAS refcat2 square degree tiles in-process, answering the same queries as ./refcat
+	binary tiles are memory mapped and only the rows that pass the cuts are converted, csv tiles are parsed once.
+	the tiles touched, and the selection on each star, follow refcat.c step by step so the same stars come back in the
+	same order. the most recently used maxsize tiles stay open
+
+	usage:  > refcat_reader = RefcatReader('00_m_16/')
+	        > stars  = refcat_reader.query_rect(ra, dec, 0.25, 0.25)     # ./refcat ra dec -rect 0.25,0.25 -dir 00_m_16/
+	        > refcat = refcat_atlas(stars)                                # RA, Dec, g, r, i, z, J, cyan, orange
+
+PARAMETERS
+-----------
+root    : str
+	tile directory, or several separated by commas (-dir)
+exten   : str
+	(optional) tile file extension (-exten) ; default = 'rc2'
+maxsize : int
+	(optional) number of tiles kept open ; default = 16
+"""
+class RefcatReader:
+
+	def __init__(self, root, exten='rc2', maxsize=16):
+		self.roots   = [r.rstrip('/') for r in root.split(',') if r]
+		self.exten   = exten
+		self.maxsize = maxsize
+		self.tiles   = OrderedDict()	# path -> (raw rows, 'bin' or 'csv'), least recently used first
+		self.hits    = 0
+		self.misses  = 0
+
+	'''
+	raw rows of one tile -- a memmap of refcat_stardat for binary tiles, int64 columns for csv ones. None if missing
+	'''
+	def tile(self, path):
+		if path in self.tiles:
+			self.hits += 1
+			self.tiles.move_to_end(path)
+			return self.tiles[path]
+
+		self.misses += 1
+		if not isfile(path): return None
+
+		with open(path, 'rb') as fh:
+			preamble = fh.read(12)
+
+		entry = None
+		if len(preamble) == 12:
+			nrc, magic, lowendian = np.frombuffer(preamble, dtype='<i4')
+			order = '<' if lowendian else '>'
+			nrc, magic = np.frombuffer(preamble[:8], dtype=order + 'u4')
+			if magic == refcat_magic:
+				dtype = np.dtype(refcat_stardat).newbyteorder(order)
+				rows  = np.memmap(path, dtype=dtype, mode='r', offset=12, shape=(int(nrc),)) if nrc > 0 else np.zeros(0, dtype=dtype)
+				entry = (rows, 'bin')
+
+		if entry is None:
+			hexes = {24: lambda s: int(s, 16), 28: lambda s: int(s, 16), 32: lambda s: int(s, 16), 36: lambda s: int(s, 16)}
+			rows  = np.loadtxt(path, delimiter=',', dtype=np.int64, converters=hexes, ndmin=2)
+			entry = (rows, 'csv')
+
+		self.tiles[path] = entry
+		while len(self.tiles) > self.maxsize:
+			self.tiles.popitem(last=False)
+		return entry
+
+	'''
+	refcat.c main() -- (i, j + 90) of every square degree tile the rectangle / circle reaches, in file read order
+		plus the great circle poles and limits the stars are cut on
+	'''
+	def region(self, ra0, dec0, dra, ddec=None):
+		rect = ddec is not None
+		dr   = math.atan(1.0)/45
+		pi   = 4*math.atan(1.0)
+
+		ra0, dec0, dra = ra0 * dr, dec0 * dr, dra * dr
+		ddec = ddec * dr if rect else dra
+
+		pointing = (math.cos(dec0) * math.cos(ra0), math.cos(dec0) * math.sin(ra0), math.sin(dec0))
+		rapole   = (math.cos(ra0+pi/2), math.sin(ra0+pi/2), 0)
+		decpole  = (-math.sin(dec0) * math.cos(ra0), -math.sin(dec0) * math.sin(ra0), math.cos(dec0))
+
+		degin = set()
+		if rect:
+			corners = [refcat_adoffset(rapole, decpole, sa*dra, sd*ddec) for sa, sd in ((1, 1), (-1, 1), (-1, -1), (1, -1))]
+			decmin  = math.asin(min(c[2] for c in corners))
+			decmax  = math.asin(max(c[2] for c in corners))
+			for c in corners:
+				i = int(math.floor(math.fmod(math.atan2(c[1], c[0])/dr + 360, 360) + 1e-8))
+				j = int(math.floor(math.asin(c[2])/dr + 1e-8)) + 90
+				degin.add((i, j))
+		else:
+			decmin, decmax = dec0 - ddec, dec0 + ddec
+			i = int(math.floor(math.fmod(ra0/dr + 360, 360) + 1e-8))
+			j = int(math.floor(dec0/dr + 1e-8)) + 90
+			degin.add((i, j))
+		if dec0 + ddec >= pi/2:  decmax =  pi/2
+		if dec0 - ddec <= -pi/2: decmin = -pi/2
+
+		sina, sind, cosa = math.sin(dra), math.sin(ddec), math.cos(dra)
+
+		# every square degree with a corner inside the area
+		for j in range(int(math.floor(decmin/dr + 1e-8)) + 90, int(math.floor(decmax/dr - 1e-8)) + 91):
+			dec = (j - 90) * dr
+			for i in range(360):
+				ra = i * dr
+				for k in range(4):
+					P = (math.cos(dec + (k//2)*dr) * math.cos(ra + (k%2)*dr), math.cos(dec + (k//2)*dr) * math.sin(ra + (k%2)*dr), math.sin(dec + (k//2)*dr))
+					if rect:
+						if refcat_dot(P, pointing) < 0 or abs(refcat_dot(P, rapole)) > sina or abs(refcat_dot(P, decpole)) > sind: continue
+					elif refcat_dot(P, pointing) < cosa: continue
+					degin.add((i, j))
+					break
+
+		tiles = sorted(degin, key=lambda t: t[0] + t[1] * 360)
+		if rect: return tiles, True, rapole, sina, decpole, sind
+		return tiles, False, pointing, cosa, decpole, sind
+
+	'''
+	stars of one tile's raw rows passing the magnitude, isolation and area cuts, as refcat_star
+	'''
+	def select(self, rows, kind, mlim, rlim, rect, p1, t1, p2, t2):
+		names = list(refcat_fields)
+		dr    = math.atan(1.0)/45
+
+		def column(name):
+			field, bin_scale, csv_scale, div = refcat_fields[name]
+			raw   = rows[field] if kind == 'bin' else rows[:, names.index(name)]
+			scale = bin_scale if kind == 'bin' else csv_scale
+			value = raw.astype(np.float64) if scale is None else scale * raw.astype(np.float64)
+			if div is not None: value = value / div
+			if kind == 'bin' and name == 'dec': value = value - 90.0
+			return value
+
+		m    = np.minimum(np.minimum(column('g'), column('r')), column('i'))
+		rp1  = (2e-1 * rows['rp1'].astype(np.float64)) if kind == 'bin' else (1e-1 * rows[:, names.index('rp1')])
+		keep = (m <= mlim) & (rp1 >= rlim)
+
+		ra, dec = column('ra'), column('dec')
+		P = (np.cos(dec*dr) * np.cos(ra*dr), np.cos(dec*dr) * np.sin(ra*dr), np.sin(dec*dr))
+		if rect:
+			d1, d2 = refcat_dot(P, p1), refcat_dot(P, p2)
+			keep  &= (d1 <= t1) & (d1 >= -t1) & (d2 <= t2) & (d2 >= -t2)
+		else:
+			keep  &= refcat_dot(P, p1) >= t1
+
+		idx   = np.flatnonzero(keep)
+		rows  = rows[idx]
+		stars = np.zeros(len(idx), dtype=refcat_star)
+		for name in names:
+			stars[name] = column(name)
+		return stars
+
+	def query(self, ra, dec, dra, ddec=None, mlim=18.0, rlim=0.0):
+		tiles, rect, p1, t1, p2, t2 = self.region(ra, dec, dra, ddec)
+		found = []
+		for root in self.roots:
+			for i, j in tiles:
+				entry = self.tile(f'{root}/{i:03d}{j-90:+03d}.{self.exten}')
+				if entry is None: continue
+				found.append(self.select(*entry, mlim, rlim, rect, p1, t1, p2, t2))
+		return np.concatenate(found) if found else np.zeros(0, dtype=refcat_star)
+
+	'''
+	./refcat ra dec -rect dra,ddec -- stars within +/- dra, ddec [deg] of the great circles through ra, dec
+	'''
+	def query_rect(self, ra, dec, dra, ddec, mlim=18.0, rlim=0.0):
+		return self.query(ra, dec, dra, ddec, mlim=mlim, rlim=rlim)
+
+	'''
+	./refcat ra dec -rad rad -- stars within rad [deg] of ra, dec
+	'''
+	def query_radius(self, ra, dec, rad, mlim=18.0, rlim=0.0):
+		return self.query(ra, dec, rad, None, mlim=mlim, rlim=rlim)
+
+	def __str__(self):
+		return f'refcat tiles: {self.hits} hits, {self.misses} misses, {len(self.tiles)}/{self.maxsize} open'
+
+"""
+the default ./refcat output columns -- RA, Dec, g, r, i, z, J, ATLAS cyan, ATLAS orange -- of refcat_star rows
+
+PARAMETERS
+-----------
+stars : array
+	structured array from RefcatReader.query()
+
+RETURNS
+--------
+refcat : array
+	(n, 9) array, same columns the drivers used to parse out of the ./refcat text
+"""
+def refcat_atlas( stars ):
+	gr     = stars['g'] - stars['r']
+	cyan   = stars['g'] - 0.467*gr - 0.048*gr*gr
+	ri     = stars['r'] - stars['i']
+	orange = stars['r'] - 0.443*ri - 0.090*ri*ri
+	return np.column_stack((stars['ra'], stars['dec'], stars['g'], stars['r'], stars['i'], stars['z'], stars['J'], cyan, orange))
+
+"""
+cross-matches fitted stars to refcat in pixel space -- replaces pixel_to_skycoord / skycoord_to_pixel /
+match_to_catalog_sky, which builds a 3-D tree on every call
+	refcat around a frame is queried and projected through its WCS once, the projected catalog and its 2-D tree are
+	kept keyed on the WCS header and frame shape. the most recently used maxsize projections stay around
+
+	usage:  > matcher = PixelMatcher(RefcatReader('00_m_16/'))
+	        > stars, idx, sep = matcher.match(WCS(hdr), img.shape, x, y, max_sep=75)
+	        > ref = stars[idx[idx >= 0]]
+	        > print(matcher.last)                 # match statistics of the call
+
+PARAMETERS
+-----------
+refcat_reader : RefcatReader
+	reference catalog
+mlim          : float
+	(optional) refcat magnitude limit ; default = 18
+margin        : float
+	(optional) refcat stars this far outside the frame are kept [pix] ; default = 20
+maxsize       : int
+	(optional) number of projected catalogs kept ; default = 16
+"""
+class PixelMatcher:
+
+	def __init__(self, refcat_reader, mlim=18.0, margin=20, maxsize=16):
+		self.reader    = refcat_reader
+		self.mlim      = mlim
+		self.margin    = margin
+		self.maxsize   = maxsize
+		self.projected = OrderedDict()	# (wcs header, shape) -> (stars, x, y, tree), least recently used first
+		self.hits      = 0
+		self.misses    = 0
+		self.n_stars   = 0
+		self.n_matched = 0
+		self.last      = None
+
+	'''
+	cache key of a frame -- its full WCS header (SIP included) and shape
+	'''
+	def key(self, w, shape):
+		return (w.to_header_string(relax=True), tuple(int(s) for s in shape[:2]))
+
+	'''
+	refcat stars on (or within margin of) the frame, their 0-based pixel positions and a tree over them
+	'''
+	def project(self, w, shape):
+		key = self.key(w, shape)
+		if key in self.projected:
+			self.hits += 1
+			self.projected.move_to_end(key)
+			return self.projected[key]
+		self.misses += 1
+
+		ny, nx = shape[:2]
+		m  = self.margin
+		px = np.array([(nx-1)/2, -m, nx-1+m, -m, nx-1+m])
+		py = np.array([(ny-1)/2, -m, -m, ny-1+m, ny-1+m])
+		ra, dec = w.all_pix2world(px, py, 0)
+		sky     = SkyCoord(ra=ra*u.deg, dec=dec*u.deg)
+		stars   = self.reader.query_radius(ra[0], dec[0], sky[0].separation(sky[1:]).deg.max(), mlim=self.mlim)
+
+		x, y = w.all_world2pix(stars['ra'], stars['dec'], 0) if len(stars) else (np.zeros(0), np.zeros(0))
+		on   = (x >= -m) & (x <= nx-1+m) & (y >= -m) & (y <= ny-1+m)
+		entry = (stars[on], x[on], y[on], cKDTree(np.column_stack((x[on], y[on]))))
+
+		self.projected[key] = entry
+		if len(self.projected) > self.maxsize: self.projected.popitem(last=False)
+		return entry
+
+	'''
+	nearest projected refcat star of each (x, y), within max_sep [arcsec]. idx is -1 and sep inf where nothing is close
+	'''
+	def match(self, w, shape, x, y, max_sep=75):
+		stars, ref_x, ref_y, tree = self.project(w, shape)
+		x, y  = np.atleast_1d(x), np.atleast_1d(y)
+		scale = np.mean(utils.proj_plane_pixel_scales(w)) * 3600	# arcsec / pix
+
+		if len(stars) == 0:
+			sep, idx = np.full(len(x), np.inf), np.full(len(x), len(stars))
+		else:
+			sep, idx = tree.query(np.column_stack((x, y)), distance_upper_bound=max_sep / scale)
+		good = idx < len(stars)
+		idx  = np.where(good, idx, -1)
+		sep  = sep * scale
+
+		dx, dy = x[good] - ref_x[idx[good]], y[good] - ref_y[idx[good]]
+		self.n_stars   += len(x)
+		self.n_matched += int(good.sum())
+		self.last = {
+			'n'          : len(x),
+			'refcat'     : len(stars),
+			'matched'    : int(good.sum()),
+			'fraction'   : good.mean() if len(x) else 0.,
+			'duplicates' : int(good.sum() - len(np.unique(idx[good]))),
+			'median_sep' : np.median(sep[good]) if good.any() else np.nan,	# arcsec
+			'rms_sep'    : np.sqrt(np.mean(sep[good]**2)) if good.any() else np.nan,
+			'offset'     : (np.median(dx), np.median(dy)) if good.any() else (np.nan, np.nan),	# pix, fitted - refcat
+		}
+		return stars, idx, sep
+
+	def __str__(self):
+		return (f'pixel matcher: {self.n_matched}/{self.n_stars} stars matched, '
+		        f'{self.hits} hits, {self.misses} misses, {len(self.projected)}/{self.maxsize} projections kept')
+
+# refcat colour each filter's colour term is solved against
+zeropoint_colors = {'g': ('g', 'r'), 'r': ('r', 'i'), 'i': ('r', 'i')}
+
+"""
+zeropoints of many frames in one filter, plus one shared colour term, in closed form with sigma clipping
+	ref - inst = zp[frame] + k * color. k comes from the within-frame deviations (frame means removed), zp[frame] is the
+	mean of ref - inst - k * color over the frame's stars. stars beyond clip * 1.4826 MAD of the residuals are dropped and
+	the solve repeated until the kept set stops changing
+
+PARAMETERS
+-----------
+dm         : array
+	ref_mag - inst_mag of every matched star
+color      : array
+	refcat colour of every matched star
+frame      : array
+	frame index (0 ... n_frames-1) of every matched star
+n_frames   : int
+	number of frames
+color_term : bool
+	(optional) solve k, else k = 0 ; default = True
+clip       : float
+	(optional) clipping threshold [robust sigma] ; default = 3
+iters      : int
+	(optional) max clipping passes ; default = 10
+
+RETURNS
+--------
+zp     : array
+	zeropoint per frame (nan for frames without stars) [mag]
+zp_err : array
+	standard error of each zeropoint [mag]
+n      : array
+	stars kept per frame
+k      : float
+	colour term
+k_err  : float
+	its standard error
+keep   : array
+	bool, stars that survived clipping
+"""
+def solve_zeropoints( dm , color , frame , n_frames , color_term=True , clip=3 , iters=10 ):
+	dm, color, frame = np.asarray(dm, dtype=float), np.asarray(color, dtype=float), np.asarray(frame, dtype=int)
+	keep = np.ones(len(dm), dtype=bool)
+	k, k_err = 0., 0.
+
+	for _ in range(iters):
+		w = keep.astype(float)
+		n = np.bincount(frame, w, minlength=n_frames)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			if color_term:
+				dc  = color - (np.bincount(frame, w * color, minlength=n_frames) / n)[frame]
+				ddm = dm    - (np.bincount(frame, w * dm,    minlength=n_frames) / n)[frame]
+				scc = np.sum(w * dc * dc)
+				k   = np.sum(w * dc * ddm) / scc if scc > 0 else 0.
+			zp = np.bincount(frame, w * (dm - k * color), minlength=n_frames) / n
+
+		resid = dm - zp[frame] - k * color
+		sigma = 1.4826 * np.median(np.abs(resid[keep] - np.median(resid[keep]))) if keep.any() else 0.
+		new   = np.abs(resid) <= clip * sigma if sigma > 0 else keep
+		if np.array_equal(new, keep): break
+		keep  = new
+
+	w   = keep.astype(float)
+	n   = np.bincount(frame, w, minlength=n_frames)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		var    = np.bincount(frame, w * resid**2, minlength=n_frames) / np.maximum(n - 1, 1)
+		zp_err = np.sqrt(var / n)
+		if color_term and scc > 0: k_err = np.sqrt(np.sum(w * resid**2) / max(w.sum() - n_frames - 1, 1) / scc)
+	zp[n == 0] = np.nan
+
+	return zp, zp_err, n.astype(int), k, k_err, keep
+
+"""
+photometric zeropoints for every frame of one object directory in one pass -- replaces the per frame
+curve_fit(line_slope_one, ...) in visualize_stars.py
+	reads the fitted stars (ra, dec, flux, see load_star_params()) of all frames, matches them to refcat, solves
+	zeropoints and a colour term per filter with solve_zeropoints() and writes <frame>_zeropoint.txt (zeropoint and
+	its error, colour term in the header). filters come from input.csv.
+	the zeropoint written (and returned) is the one at the mean colour of the filter's stars used, zp + k * mean colour,
+	so applying it with no colour correction, as visualize_lightcurves.py does, is right for a target of that colour
+	rather than biased by k * colour. a target of another colour still needs k * (its colour - mean colour). where <frame>.flt sits next to its output the
+	match is done in pixel space with a PixelMatcher (only the header is read), otherwise on the sky
+
+PARAMETERS
+-----------
+directory     : str
+	object directory, e.g. './2016_GE1_2016_04_04_UTC/'
+refcat_reader : RefcatReader
+	reference catalog
+max_sep       : float
+	(optional) max fitted star - refcat separation [arcsec] ; default = 75
+radius        : float
+	(optional) refcat query radius around each frame's stars [deg] ; default = 0.25
+color_term    : bool
+	(optional) solve colour terms ; default = True
+matcher       : PixelMatcher
+	(optional) pixel matcher to reuse, one over refcat_reader is made otherwise ; default = None
+write         : bool
+	(optional) write the _zeropoint.txt files ; default = True
+
+RETURNS
+--------
+results : dict
+	frame id -> (filter, zeropoint at the mean colour, error, stars used, colour term, colour term error)
+"""
+def calibrate_night( directory , refcat_reader , max_sep=75 , radius=0.25 , color_term=True , matcher=None , write=True ):
+	observations, _ = load_inputs()
+	frames  = sorted(d for d in os.listdir(directory) if isfile(join(directory, d, lightcurve_file)) or isfile(join(directory, d, 'star_params.dat')))
+	matcher = PixelMatcher(refcat_reader) if matcher is None else matcher
+
+	matched = {}	# filter -> lists of dm, color, frame id
+	for frame_id in frames:
+		obs = observations.lookup(frame_id + '.flt')
+		if obs is None: continue
+		band = str(obs['filter'])[0]
+		if band not in zeropoint_colors: continue
+
+		stars = load_star_params(join(directory, frame_id))
+		stars = stars[stars[:,-1] > 0]
+		if len(stars) == 0: continue
+		ra, dec, inst_mag = stars[:,1], stars[:,2], -2.5 * np.log10(stars[:,-1])
+
+		fits_file = join(directory, frame_id + '.flt')
+		if isfile(fits_file):
+			hdr  = fits.getheader(fits_file)
+			w    = WCS(hdr)
+			x, y = w.all_world2pix(ra, dec, 0)
+			ref, idx, _ = matcher.match(w, (hdr['NAXIS2'], hdr['NAXIS1']), x, y, max_sep=max_sep)
+			good = idx >= 0
+		else:
+			ref = refcat_reader.query_radius(np.median(ra), np.median(dec), radius)
+			if len(ref) == 0: continue
+			idx, sep, _ = SkyCoord(ra=ra*u.deg, dec=dec*u.deg).match_to_catalog_sky(SkyCoord(ra=ref['ra']*u.deg, dec=ref['dec']*u.deg))
+			good = sep.arcsec < max_sep
+
+		c1, c2 = zeropoint_colors[band]
+		ref    = ref[idx[good]]
+		usable = (ref[band] > 0) & (ref[c1] > 0) & (ref[c2] > 0)
+		ref, inst_mag = ref[usable], inst_mag[good][usable]
+
+		dm, color, ids = matched.setdefault(band, ([], [], []))
+		dm   .append(ref[band] - inst_mag)
+		color.append(ref[c1] - ref[c2])
+		ids  .append([frame_id] * len(ref))
+
+	results = {}
+	for band, (dm, color, ids) in matched.items():
+		ids    = np.concatenate(ids)
+		names  = sorted(set(ids))
+		frame  = np.searchsorted(names, ids)
+		color  = np.concatenate(color)
+		zp, zp_err, n, k, k_err, keep = solve_zeropoints(np.concatenate(dm), color, frame, len(names), color_term=color_term)
+		mean_color = np.mean(color[keep]) if keep.any() else 0.
+		zp = zp + k * mean_color
+
+		c1, c2 = zeropoint_colors[band]
+		for j, frame_id in enumerate(names):
+			results[frame_id] = (band, zp[j], zp_err[j], n[j], k, k_err)
+			if write and n[j] > 0:
+				np.savetxt(join(directory, f'{frame_id}_zeropoint.txt'), np.array([zp[j], zp_err[j]]),
+				           header=f'zeropoint zp_err ; zeropoint at {c1}-{c2} = {mean_color:.4f} (mean of the stars used), '
+				                  f'{band} colour term {k:.4f} +/- {k_err:.4f} on {c1}-{c2}, {n[j]} stars')
+
+	return results
+
+"""
+the affine map scipy.ndimage.rotate(img, angle) uses -- rotated frame pixel (row, col) samples img at matrix @ (row, col) + offset
+	same arithmetic as scipy so oblique_sample() lands on exactly the points rotate() interpolates
+
+PARAMETERS
+-----------
+shape : tuple
+	(rows, columns) of the original image
+angle : float
+	rotation angle [degrees]
+
+RETURNS
+--------
+matrix    : array
+	2x2 rotation matrix
+offset    : array
+	(row, col) offset into the original image
+out_shape : array
+	(rows, columns) of the rotated frame
+"""
+def rotation_transform( shape , angle ):
+	c, s   = cosdg(angle), sindg(angle)
+	matrix = np.array([[c, s], [-s, c]])
+
+	in_shape  = np.asarray(shape[:2])
+	iy, ix    = in_shape
+	bounds    = matrix @ [[0, 0, iy, iy], [0, ix, 0, ix]]
+	out_shape = (np.ptp(bounds, axis=1) + 0.5).astype(int)
+
+	offset = (in_shape - 1)/2 - matrix @ ((out_shape - 1)/2)
+	return matrix, offset, out_shape
+
+"""
+the pixels img[rows, cols] of rotate(img, angle) without rotating img
+	the box is mapped back onto the original image and interpolated there with the same cubic spline,
+	prefiltering only a small cutout around it (margin px either side) instead of the whole frame
+
+PARAMETERS
+-----------
+img    : array
+	original (unrotated) 2d numpy image
+angle  : float
+	rotation angle [degrees] of the frame rows, cols are in
+rows   : slice
+	row slice in the rotated frame
+cols   : slice
+	column slice in the rotated frame
+margin : int
+	(optional) cutout padding in px, the spline prefilter dies off as 0.27**margin ; default = 16
+
+RETURNS
+--------
+box : array
+	2d numpy array, same values and dtype as rotate(img, angle)[rows, cols]
+"""
+def oblique_sample( img , angle , rows , cols , margin=16 ):
+	matrix, offset, out_shape = rotation_transform(img.shape, angle)
+
+	rr, cc = np.meshgrid(np.arange(*rows.indices(out_shape[0])), np.arange(*cols.indices(out_shape[1])), indexing='ij')
+	box    = np.zeros(rr.shape, dtype=img.dtype.name)
+	if box.size == 0: return box
+
+	in_r = matrix[0,0]*rr + matrix[0,1]*cc + offset[0]
+	in_c = matrix[1,0]*rr + matrix[1,1]*cc + offset[1]
+
+	r_0 = int(np.clip(np.floor(in_r.min()) - margin    , 0, img.shape[0]))
+	r_1 = int(np.clip(np.ceil (in_r.max()) + margin + 1, 0, img.shape[0]))
+	c_0 = int(np.clip(np.floor(in_c.min()) - margin    , 0, img.shape[1]))
+	c_1 = int(np.clip(np.ceil (in_c.max()) + margin + 1, 0, img.shape[1]))
+	if r_0 >= r_1 or c_0 >= c_1: return box 	# box is entirely off the image
+
+	map_coordinates(img[r_0:r_1, c_0:c_1], [in_r - r_0, in_c - c_0], output=box, order=3, mode='constant', cval=0.0, prefilter=True)
+	return box
+
+"""
+oblique_sample() for many boxes in one map_coordinates call
+	every group of boxes (e.g. one trail's object and sky boxes) gets one cutout around it (margin px either side),
+	prefiltered on its own as oblique_sample() does. the prefiltered cutouts are stacked into one mosaic,
+	each edged with its mirror image the way map_coordinates(mode='constant') extends an image, and every box of
+	every group is then interpolated off the mosaic in a single call. points off their cutout come back 0
+
+PARAMETERS
+-----------
+img    : array
+	original (unrotated) 2d numpy image
+groups : list
+	(angle, [(rows, cols), ...]) -- rotated frame of the group and the row, column slices of its boxes in it
+margin : int
+	(optional) cutout padding in px ; default = 16
+
+RETURNS
+--------
+samples : list
+	for every group the list of its boxes, 2d numpy arrays with the values of oblique_sample(img, angle, rows, cols)
+	(to the prefilter's 0.27**margin)
+"""
+def oblique_sample_batch( img , groups , margin=16 ):
+	if len(groups) == 0: return []
+
+	edge       = 2	# half width of the cubic spline, mirrored around every cutout
+	transforms = {}
+	cutouts, points, shapes = [], [], []
+	for angle, boxes in groups:
+		if angle not in transforms: transforms[angle] = rotation_transform(img.shape, angle)
+		matrix, offset, out_shape = transforms[angle]
+
+		in_r, in_c, box_shapes = [], [], []
+		for rows, cols in boxes:
+			rr, cc = np.meshgrid(np.arange(*rows.indices(out_shape[0])), np.arange(*cols.indices(out_shape[1])), indexing='ij')
+			in_r      .append((matrix[0,0]*rr + matrix[0,1]*cc + offset[0]).ravel())
+			in_c      .append((matrix[1,0]*rr + matrix[1,1]*cc + offset[1]).ravel())
+			box_shapes.append(rr.shape)
+		in_r = np.concatenate(in_r) if boxes else np.zeros(0)
+		in_c = np.concatenate(in_c) if boxes else np.zeros(0)
+		shapes.append(box_shapes)
+
+		cutout = None
+		if in_r.size > 0:
+			r_0 = int(np.clip(np.floor(in_r.min()) - margin    , 0, img.shape[0]))
+			r_1 = int(np.clip(np.ceil (in_r.max()) + margin + 1, 0, img.shape[0]))
+			c_0 = int(np.clip(np.floor(in_c.min()) - margin    , 0, img.shape[1]))
+			c_1 = int(np.clip(np.ceil (in_c.max()) + margin + 1, 0, img.shape[1]))
+			if r_0 < r_1 and c_0 < c_1:
+				cutout = np.pad(spline_filter(img[r_0:r_1, c_0:c_1], 3, output=np.float64, mode='constant'), edge, mode='reflect')
+				in_r, in_c = in_r - r_0, in_c - c_0
+		cutouts.append(cutout)
+		points .append((in_r, in_c))
+
+	# cutouts stacked one under the other (each stays contiguous in memory), every point shifted onto its own
+	width   = max([c.shape[1] for c in cutouts if c is not None], default=0)
+	heights = [0 if c is None else c.shape[0] for c in cutouts]
+	starts  = np.concatenate(([0], np.cumsum(heights))).astype(int)
+	mosaic  = np.zeros((starts[-1], width))
+	for c, start in zip(cutouts, starts):
+		if c is not None: mosaic[start:start + c.shape[0], :c.shape[1]] = c
+
+	mosaic_r, mosaic_c, inside = [], [], []
+	for c, start, (in_r, in_c) in zip(cutouts, starts, points):
+		if c is None: inside.append(np.zeros(in_r.size, dtype=bool))
+		else:         inside.append((in_r >= 0) & (in_r <= c.shape[0] - 2*edge - 1) & (in_c >= 0) & (in_c <= c.shape[1] - 2*edge - 1))
+		mosaic_r.append(in_r + edge + start)
+		mosaic_c.append(in_c + edge)
+
+	inside  = np.concatenate(inside) if groups else np.zeros(0, dtype=bool)
+	sampled = np.zeros(inside.size)
+	if inside.any():
+		sampled[inside] = map_coordinates(mosaic, [np.concatenate(mosaic_r)[inside], np.concatenate(mosaic_c)[inside]], order=3, mode='constant', cval=0.0, prefilter=False)
+
+	samples, first = [], 0
+	for box_shapes in shapes:
+		group = []
+		for shape in box_shapes:
+			size = shape[0] * shape[1]
+			group.append(sampled[first:first + size].reshape(shape).astype(img.dtype.name))
+			first += size
+		samples.append(group)
+	return samples
+
+"""
+img[rows, cols], or the same box of rotate(img, angle) sampled straight off the unrotated img if angle is given
+"""
+def trail_box( img , rows , cols , angle=None ):
+	if angle is None: return img[rows, cols]
+	return oblique_sample(img, angle, rows, cols)
+
 
 '''
 taking a lightcurve of streaked artifact in CCD image
@@ -152,6 +1604,9 @@ sky_width 			: float
 	(optional) width (in FWHM) either side of object box to sum for sky flux ; default = 4
 autotrim 			: bool 
 	(optional) if True, will run obj_row_sums through curve_fit with another_box() !! doesnt do anything yet !!
+angle 				: float
+	(optional) if given, img is the unrotated frame and trail_start/trail_end are in rotate(img, angle) -- the boxes are
+	sampled along the trail with oblique_sample() instead of rotating the whole image ; default = None
 
 RETURNS
 --------
@@ -161,7 +1616,33 @@ r : list
 		returns [fluxes[array(dtype=float)], uncertainties[array(dtype=float)], average sky measurement[float]]
 	without uncertainties, returns: [ fluxes : array(dtype=float) ]
 '''
-def take_lightcurve(img, trail_start, trail_end, fwhm=4, b=None, height_correction=0, display=False, err=False, binning=None, gain=1.6, rd_noise=3, obj_width=1, sky_width=4, autotrim=False):
+def take_lightcurve(img, trail_start, trail_end, fwhm=4, b=None, height_correction=0, display=False, err=False, binning=None, gain=1.6, rd_noise=3, obj_width=1, sky_width=4, autotrim=False, angle=None):
+	rows, obj_cols, left_cols, right_cols = lightcurve_boxes(trail_start, trail_end, fwhm, height_correction, obj_width, sky_width)
+
+	obj_rect  = trail_box(img, rows, obj_cols  , angle)
+	sky_left  = trail_box(img, rows, left_cols , angle)
+	sky_right = trail_box(img, rows, right_cols, angle)
+
+	obj_minus_sky, sigma_row, sky_row_avg = box_photometry(obj_rect, sky_left, sky_right, b=b, binning=binning, gain=gain, rd_noise=rd_noise)
+
+	if display:
+		plt.figure()
+		t = np.arange(len(obj_minus_sky))
+		plt.scatter(t, obj_minus_sky)
+
+	r = []
+
+	r.append(obj_minus_sky)
+	
+	if err: 
+		r.append(sigma_row)
+		r.append(sky_row_avg)
+	return r
+
+'''
+rows and object / sky column slices take_lightcurve() sums over, parameters as take_lightcurve()
+'''
+def lightcurve_boxes(trail_start, trail_end, fwhm=4, height_correction=0, obj_width=1, sky_width=4):
 	obj_width = obj_width*fwhm
 	sky_width = sky_width*fwhm
 
@@ -172,14 +1653,19 @@ def take_lightcurve(img, trail_start, trail_end, fwhm=4, b=None, height_correcti
 		trail_start_y -= height_correction
 		trail_end_y   += height_correction
 
-	obj_rect  = img[int(trail_start_y + .5 ):int(trail_end_y + .5 ), int(trail_start[0] - obj_width + .5):int(trail_end[0]+obj_width + .5)]
+	rows       = slice(int(trail_start_y + .5 ), int(trail_end_y + .5 ))
+	obj_cols   = slice(int(trail_start[0] - obj_width + .5), int(trail_end[0]+obj_width + .5))
+	left_cols  = slice(int(trail_start[0] - obj_width - sky_width + .5) , int(trail_start[0] - obj_width + .5))
+	right_cols = slice(int(trail_start[0] + obj_width + .5) , int(trail_start[0] + obj_width + sky_width + .5))
+	return rows, obj_cols, left_cols, right_cols
 
-	sky_left  = img[int(trail_start_y + .5 ):int(trail_end_y + .5 ), int(trail_start[0] - obj_width - sky_width + .5) : int(trail_start[0] - obj_width + .5)]
-	sky_right = img[int(trail_start_y + .5 ):int(trail_end_y + .5 ), int(trail_start[0] + obj_width + .5) : int(trail_start[0] + obj_width + sky_width + .5)]
-
-	obj_row_sums      = np.array([np.sum(i) for i in obj_rect ])
-	sky_left_row_sum  = np.array([np.sum(i) for i in sky_left ])
-	sky_right_row_sum = np.array([np.sum(i) for i in sky_right])
+'''
+sky subtracted row sums, their uncertainties and the average sky from take_lightcurve()'s object and sky boxes
+'''
+def box_photometry(obj_rect, sky_left, sky_right, b=None, binning=None, gain=1.6, rd_noise=3):
+	obj_row_sums      = np.sum(obj_rect , axis=1)
+	sky_left_row_sum  = np.sum(sky_left , axis=1)
+	sky_right_row_sum = np.sum(sky_right, axis=1)
 	sky_row_sum       = sky_right_row_sum+sky_left_row_sum  # total sky counts
 
 	if binning is not None:
@@ -197,54 +1683,131 @@ def take_lightcurve(img, trail_start, trail_end, fwhm=4, b=None, height_correcti
 	sigma_row = obj_minus_sky/gain + (obj_rect.shape[1]) * (sky_row_avg/gain + rd_noise**2) + (obj_rect.shape[1])**2 * (sky_row_sum**.5 / sky_n_pixels)**2 # from magnier
 	sigma_row = sigma_row ** .5
 
-	if display:
-		plt.figure()
-		t = np.arange(len(obj_minus_sky))
-		plt.scatter(t, obj_minus_sky)
+	return obj_minus_sky, sigma_row, sky_row_avg
 
-	r = []
+'''
+take_lightcurve() for every trail on a frame in one call -- with angles, the object and sky boxes of all trails
+	are sampled off the unrotated img together, in one oblique_sample_batch() call
 
-	r.append(obj_minus_sky)
-	
-	if err: 
-		r.append(sigma_row)
-		r.append(sky_row_avg)
+PARAMETERS
+----------
+img 				: array, dtype=float 
+	numpy nxm array representing CCD image (unrotated if angles is given)
+trail_starts 		: array, dtype=float
+	Nx2 array of x, y CCD pixel coordinates of trail starts (~top)
+trail_ends 			: array, dtype=float 
+	Nx2 array of x, y CCD pixel coordinates of trail ends (~bottom)
+fwhms 				: array or float
+	FWHM of each trailed Gaussian in CCD pixels
+height_corrections 	: array or float
+	(optional) pixels to extend each lightcurve above/below trail start/stop ; default = 0
+angles 				: array or float
+	(optional) rotated frame of each trail, see take_lightcurve(angle=) ; default = None
+binning 			: int
+	(optional) bin every lightcurve to this length, see take_lightcurve()
+kwargs 				:
+	b, gain, rd_noise, obj_width, sky_width -- as take_lightcurve() takes them, the same for every trail
+
+RETURNS
+--------
+fluxes  : array
+	N x length sky subtracted row sums, one trail per row
+sigmas  : array
+	N x length uncertainties on fluxes
+sky_avg : array
+	N x length average sky per pixel
+	trails of different lengths (binning=None) are padded at the end with np.nan
+'''
+def take_lightcurves(img, trail_starts, trail_ends, fwhms, height_corrections=0, angles=None, binning=None, b=None, gain=1.6, rd_noise=3, obj_width=1, sky_width=4):
+	trail_starts = np.asarray(trail_starts, dtype=float).reshape(-1, 2)
+	trail_ends   = np.asarray(trail_ends  , dtype=float).reshape(-1, 2)
+	n_trails     = len(trail_starts)
+
+	fwhms              = np.broadcast_to(fwhms, n_trails)
+	height_corrections = np.broadcast_to(height_corrections, n_trails)
+
+	# object, left sky, right sky box of every trail, in that order
+	boxes = []
+	for i in range(n_trails):
+		rows, obj_cols, left_cols, right_cols = lightcurve_boxes(trail_starts[i], trail_ends[i], fwhms[i], height_corrections[i], obj_width, sky_width)
+		boxes += [(rows, obj_cols), (rows, left_cols), (rows, right_cols)]
+
+	if angles is None:
+		samples = [img[rows, cols] for rows, cols in boxes]
+	else:
+		angles  = np.broadcast_to(angles, n_trails)
+		samples = oblique_sample_batch(img, [(float(angles[i]), boxes[3*i:3*i+3]) for i in range(n_trails)])
+		samples = [box for group in samples for box in group]
+
+	lcs = [box_photometry(*samples[3*i:3*i+3], b=b, binning=binning, gain=gain, rd_noise=rd_noise) for i in range(n_trails)]
+
+	length = max([len(lc[0]) for lc in lcs], default=0)
+	r = []
+	for k in range(3):
+		stacked = np.full((n_trails, length), np.nan)
+		for i in range(n_trails):
+			row = np.broadcast_to(lcs[i][k], lcs[i][0].shape) 	# sky_avg is a scalar when b is given
+			stacked[i, :len(row)] = row
+		r.append(stacked)
 	return r
 
 '''
 another attempt at binning - this time extracting fractional pixel fluxes.
+	every output bin is a window len(lc)/trail_length pixels wide, pixels straddling two windows are split by overlap,
+	so the total flux is conserved. done as one matmul with a banded weight matrix, see rebin_matrix()
+	same as the old per bin loop when downsampling (len(lc) >= trail_length, all the pipeline does). upsampling differs
+	on purpose : a bin inside one pixel gets r = len(lc)/trail_length of it, the old loop took 1 - (i*r)%1 of its first
+	and ((i+1)*r)%1 of its last pixel even when those were the same pixel -- up to (1 + r) of it, flux not conserved
 
 PARAMETERS
 ----------
-lc 			 [array(dtype=float)]: original lightcurve to be rebinneddisplay
+lc 			 [array(dtype=float)]: original lightcurve to be rebinneddisplay -- or a 2d array of lightcurves, one per row, all the same length
 trail_length [int]				 : length we want our output lightcurve
 
 
 RETURNS 
 ---------
 array: 
-	(shape 1xtrail_length) of same dtype as lc. 
+	(shape 1xtrail_length) of same dtype as lc. (Nxtrail_length for N lightcurves)
 	reorganizes bins and takes fractional pixel fluxes across adjacent pixels according to ratio between len(lc) and trail_length
 '''
 def bin_lightcurve(lc, trail_length):
-	L = len(lc)
+	lc = np.asarray(lc)
+	W  = rebin_matrix(lc.shape[-1], trail_length)
+	if lc.ndim == 1: return W @ lc
+	return (W @ lc.T).T
+
+'''
+sparse weight matrix for bin_lightcurve -- W[i, k] is the overlap of binned pixel i, [i*r, (i+1)*r) with r = L/trail_length,
+	with pixel [k, k+1) of the original lightcurve. every column sums to 1 when the bins cover the whole lightcurve.
+	cached, since every trail on a frame gets rebinned to the same length
+
+PARAMETERS
+----------
+L 			 [int]: length of the original lightcurve
+trail_length [int]: length we want our output lightcurve
+
+RETURNS 
+---------
+W : scipy.sparse.csr_matrix
+	shape (int(trail_length), L)
+'''
+@lru_cache(maxsize=64)
+def rebin_matrix(L, trail_length):
 	length_ratio = L/trail_length
+	n_bins = int(trail_length)
+
+	i       = np.arange(n_bins)
+	b_start = i * length_ratio
+	b_end   = (i+1) * length_ratio
 
-	binned = []
-	for i in range(0, int(trail_length)):
-		first = lc[ int( i * length_ratio ) ] * ( 1 - (i * length_ratio)%1  )
-		j = (i+1) * length_ratio 
-		secon = 0
-		if not int(j) == len(lc): 
-			# print(j)
-			secon = lc[ int(j) ] * ( j % 1)
-		third = np.sum( lc[ int( i * length_ratio + 1 ) : int(j) ] )
-		s = first + secon + third
-		# print(int(c+1), int(j), s, lc[int(c)] * (1-c%1), lc[int(j+1)] * (j%1))
-		# c = j 
-		binned.append(s)
+	# every bin touches at most ceil(length_ratio) + 1 original pixels
+	k = np.floor(b_start).astype(int)[:,None] + np.arange(int(np.ceil(length_ratio)) + 1)[None,:]
+	w = np.minimum(b_end[:,None], k+1) - np.maximum(b_start[:,None], k)
 
-	return np.array(binned)
+	keep = (w > 0) & (k < L)
+	rows = np.broadcast_to(i[:,None], k.shape)
+	return csr_matrix((w[keep], (rows[keep], k[keep])), shape=(n_bins, L))
 
 
 '''
@@ -353,6 +1916,8 @@ obj_width 	: float
 	(optional) CCD pixel columns to sample over ; default=25
 display 	: bool
 	(optional) !! doesn't do anything yet !!
+angle 		: float
+	(optional) if given, img is unrotated and the trail coordinates are in rotate(img, angle), see take_lightcurve() ; default = None
 
 RETURNS
 ----------
@@ -363,9 +1928,9 @@ param_covs : array
 obj_width  : tuple
 	returns the same param?  forgot why i needed this lol
 '''
-def trail_spread_function(img, trail_start, trail_end, obj_width=25, display = False):
+def trail_spread_function(img, trail_start, trail_end, obj_width=25, display = False, angle=None):
 		
-	obj_rect = img[int(trail_start[1] + .5):int(trail_end[1] + .5), int(trail_start[0]-obj_width + .5):int(trail_start[0]+obj_width + .5)]
+	obj_rect = trail_box(img, slice(int(trail_start[1] + .5), int(trail_end[1] + .5)), slice(int(trail_start[0]-obj_width + .5), int(trail_start[0]+obj_width + .5)), angle)
 
 	col_sums = np.sum(obj_rect, axis=0)
 		
@@ -378,6 +1943,38 @@ def trail_spread_function(img, trail_start, trail_end, obj_width=25, display = F
 	# ax[2].legend()
 	return param_vals, param_covs, obj_width
 
+'''
+trail_spread_function() without the hard coded p0 -- for faint targets that curve_fit wanders off on
+	starts from gaussian_1D_guess() and runs the bounded fit_gaussian_1D(), a failed fit comes back in the status, it doesn't raise
+
+PARAMETERS
+-----------
+img 		: array, dtype=float 
+	numpy nxm array representing CCD image
+trail_start : array, dtype=float
+	x, y CCD pixel coordinates of trail start (~top)
+trail_end 	: array, dtype=float 
+	x, y CCD pixel coordinates of trail end (~bottom)
+obj_width 	: float
+	(optional) CCD pixel columns to sample over ; default=25
+angle 		: float
+	(optional) if given, img is unrotated and the trail coordinates are in rotate(img, angle), see take_lightcurve() ; default = None
+
+RETURNS
+----------
+fit 	   : ProfileFit
+	params [ s , m , a , c , b , d ] (same as trail_spread_function() param_vals), cov, success, message, nfev
+obj_width  : float
+	same as trail_spread_function()
+'''
+def trail_spread_fast(img, trail_start, trail_end, obj_width=25, angle=None):
+
+	obj_rect = trail_box(img, slice(int(trail_start[1] + .5), int(trail_end[1] + .5)), slice(int(trail_start[0]-obj_width + .5), int(trail_start[0]+obj_width + .5)), angle)
+
+	col_sums   = np.sum(obj_rect, axis=0, dtype=float)
+	rect_width = np.arange(len(col_sums))
+	return fit_gaussian_1D(rect_width, col_sums), obj_width
+
 '''
 one dimensional Gaussian function - used for curve_fit in trail_spread_function
 
@@ -406,6 +2003,109 @@ returns Gaussian model used for curve_fit
 def gaussian_1D(x, s, m, a, c, b, d):
 	return c*np.exp(-.5* ((x-m)/s)**2) + a*x + b + d*x**2
 
+'''
+partial derivatives of gaussian_1D() with respect to [ s , m , a , c , b , d ], shape (x.size, 6)
+'''
+def gaussian_1D_jac(x, s, m, a, c, b, d):
+	g = np.exp(-.5* ((x-m)/s)**2)
+	return np.array([c*g*(x-m)**2/s**3, c*g*(x-m)/s**2, x, g, np.ones(x.shape), x**2]).T
+
+'''
+closed form starting point for gaussian_1D() -- quadratic background from the outer thirds of the profile,
+	then centroid, spread and amplitude from the moments of what sticks up above it within +- a third of the profile of the peak
+
+PARAMETERS
+----------
+x : array
+	independent axis
+y : array
+	profile (column sums)
+
+RETURNS
+----------
+p0 : array
+	[ s , m , a , c , b , d ]
+'''
+def gaussian_1D_guess(x, y):
+	n     = len(x)
+	wings = (x <= x[n//3]) | (x >= x[-(n//3) - 1])
+	d, a, b = np.polyfit(x[wings], y[wings], 2) if np.sum(wings) > 3 else (0., 0., np.median(y))
+
+	signal = y - (a*x + b + d*x**2)
+	peak   = np.argmax(signal)
+	near   = (np.abs(x - x[peak]) <= n/3) & (signal > 0)
+	w      = signal[near]
+
+	if np.sum(w) <= 0:
+		return np.array([1., x[peak], a, 0., b, d])
+
+	m = np.sum(x[near]*w) / np.sum(w)
+	s = max((np.sum((x[near]-m)**2 * w) / np.sum(w))**.5, .5)
+	c = max(np.sum(w) / (s * (2*np.pi)**.5), signal[peak] * .5)
+	return np.array([s, m, a, c, b, d])
+
+'''
+result of fit_gaussian_1D() -- success is False (and params the starting guess) instead of an exception when the fit fails
+'''
+ProfileFit = namedtuple('ProfileFit', ['params', 'cov', 'success', 'message', 'nfev'])
+
+'''
+bounded least squares fit of gaussian_1D() with its analytic jacobian, started from gaussian_1D_guess()
+	s is kept between .3 px and the profile width, m on the profile and c >= 0.
+	solved on x scaled to [-1, 1] and y scaled to unit spread (so a, b, d and c are all order 1), then mapped back
+
+PARAMETERS
+----------
+x  : array
+	independent axis
+y  : array
+	profile (column sums)
+p0 : array
+	(optional) starting [ s , m , a , c , b , d ] ; default = gaussian_1D_guess(x, y)
+
+RETURNS
+----------
+fit : ProfileFit
+	params [ s , m , a , c , b , d ], cov (same normalization as curve_fit), success, message, nfev
+'''
+def fit_gaussian_1D(x, y, p0=None):
+	x = np.asarray(x, dtype=float)
+	y = np.asarray(y, dtype=float)
+
+	if len(x) < 7 or not np.all(np.isfinite(y)):
+		return ProfileFit(p0, None, False, 'profile too short or not finite', 0)
+
+	if p0 is None: p0 = gaussian_1D_guess(x, y)
+
+	# p = K @ q + k_0 takes the scaled parameters q back to [ s , m , a , c , b , d ]
+	x_c = np.mean(x)
+	h   = np.ptp(x)/2
+	y_s = np.std(y) if np.std(y) > 0 else 1.
+	K   = np.array([[h, 0, 0         , 0  , 0  , 0              ],
+	                [0, h, 0         , 0  , 0  , 0              ],
+	                [0, 0, y_s/h     , 0  , 0  , -2*y_s*x_c/h**2],
+	                [0, 0, 0         , y_s, 0  , 0              ],
+	                [0, 0, -y_s*x_c/h, 0  , y_s, y_s*x_c**2/h**2],
+	                [0, 0, 0         , 0  , 0  , y_s/h**2       ]])
+	k_0 = np.array([0, x_c, 0, 0, 0, 0])
+
+	u     = (x - x_c)/h
+	y_n   = y/y_s
+	lower = np.array([.3/h, -1,  -np.inf, 0     , -np.inf, -np.inf])
+	upper = np.array([2   ,  1,   np.inf, np.inf,  np.inf,  np.inf])
+	q0    = np.clip(np.linalg.solve(K, np.asarray(p0, dtype=float) - k_0), lower, upper)
+
+	try:
+		result = least_squares(lambda q: gaussian_1D(u, *q) - y_n, q0, jac=lambda q: gaussian_1D_jac(u, *q), bounds=(lower, upper), method='dogbox')
+	except Exception as e:
+		return ProfileFit(p0, None, False, str(e), 0)
+
+	J     = result.jac
+	dof   = max(len(x) - len(q0), 1)
+	cov_q = np.linalg.pinv(J.T @ J) * np.sum(result.fun**2) / dof
+
+	return ProfileFit(K @ result.x + k_0, K @ cov_q @ K.T, bool(result.success), result.message, result.nfev)
+
 
 '''
 one dimensional box function - used for nothing (hopefully) 
@@ -549,35 +2249,162 @@ s   : float
 	Gaussian spread 
 L   : float
 	trail length
-a   : float
-	angle from positive horizontal
-b   : float
-	constant estimate of background flux
+a   : float
+	angle from positive horizontal
+b   : float
+	constant estimate of background flux
+x_0 : float
+	CCD pixel column number of trail centroid 
+y_0 : float
+	CCD pixel row number of trail centroid
+
+RETURNS
+-------- 
+	trail spread function for curve_fit's pleasure, this is flattened
+
+	parameters will be an array of 6 floats
+
+	covariance matrix will be 5x5 matrix of cross correlation of parameters square root of diagonals gives uncertainties on fit parameters
+
+'''
+def trail_model_2d( coord , s , L , a , b , x_0 , y_0 ):
+
+	global flux, img_rot
+
+	model  = draw_model ( s , L , a, b , x_0 , y_0 )
+	return model.flatten()
+
+
+'''
+actually doing the Veres 2012 eq 3 calculations for every x, y given
+	in usage, have to explicitely define img_rot and flux, so these are the variables you expect!!
+	thin wrapper around trail_profile() -- use TrailFitter for anything that shouldn't touch the globals
+
+PARAMETERS
+-----------
+x 	: array, dtype=int
+	array of CCD column coordinates in px
+y 	: array, dtype=int
+	array of CCD row coordinates in px
+s   : float 
+	Gaussian spread 
+L   : float
+	trail length
+a   : float
+	angle from positive horizontal
+b_1 : float
+	constant estimate of background flux
+x_0 : float
+	CCD pixel column number of trail centroid 
+y_0 : float
+	CCD pixel row number of trail centroid
+
+RETURNS
+-------- 
+	2d numpy array -- same shape as img_rot. scalar background estimate is b_1, with trail drawn vertically at x_0, y_0
+'''
+def trail_model(x, y, s, L, a, b_1, x_0, y_0):
+
+	global img_rot, flux
+	
+	flux = trail_flux(img_rot, s, L, x_0, y_0)
+	return trail_profile(x, y, s, L, a, b_1, x_0, y_0, flux)
+
+
+'''
+Veres 2012 eq 3 with the flux normalization passed in -- no globals, safe to call from anywhere
+
+PARAMETERS
+-----------
+x, y, s, L, a, b_1, x_0, y_0 :
+	same as trail_model()
+flux : float
+	total counts the trail is normalized to, see trail_flux()
+
+RETURNS
+-------- 
+	array of model values, same shape as x and y
+'''
+def trail_profile(x, y, s, L, a, b_1, x_0, y_0, flux):
+
+	a      = (a) * np.pi/180
+	cosine = np.cos(a)
+	sine   = np.sin(a)
+
+	flux_term   = flux/(L * 2 * s * (2 * np.pi)**.5)
+	exponential = np.exp( -(( (x-x_0)*sine + (y-y_0)*cosine )**2 ) / (2*s**2) )
+	erf1 = erf(( (x-x_0) * cosine + (y-y_0) * sine + L/2) / (s*2**.5)) 
+	erf2 = erf(( (x-x_0) * cosine + (y-y_0) * sine - L/2) / (s*2**.5))
+	background = b_1 
+
+	return flux_term * exponential * (erf1-erf2) + background
+
+
+'''
+flux normalization of trail_model() -- total counts in a box 1.2 L tall and 1.2 FWHM either side of the centroid
+
+PARAMETERS
+-----------
+img : array
+	2d numpy array the trail lives in (img_rot)
+s   : float
+	Gaussian spread
+L   : float
+	trail length
 x_0 : float
-	CCD pixel column number of trail centroid 
+	CCD pixel column number of trail centroid
 y_0 : float
 	CCD pixel row number of trail centroid
 
 RETURNS
--------- 
-	trail spread function for curve_fit's pleasure, this is flattened
+--------
+flux : float
+'''
+def trail_flux(img, s, L, x_0, y_0):
+	r_0, r_1, c_0, c_1 = trail_flux_box(s, L, x_0, y_0)
+	return np.sum(img[r_0:r_1, c_0:c_1])
 
-	parameters will be an array of 6 floats
+'''
+pixel bounds of the box trail_flux() sums over
 
-	covariance matrix will be 5x5 matrix of cross correlation of parameters square root of diagonals gives uncertainties on fit parameters
+RETURNS
+--------
+r_0, r_1, c_0, c_1 : int
+	the box is img[r_0:r_1, c_0:c_1]
+'''
+def trail_flux_box(s, L, x_0, y_0):
+	# ok i think this needs to be > 1
+	L_but_longer = L*1.2
+	s_but_wider  = s*1.2
+
+	return int(y_0 - L_but_longer/2), int(y_0 + L_but_longer/2+1), int(x_0 - s_but_wider*2.355 + .5), int(x_0 + s_but_wider*2.355 + .5)
 
 '''
-def trail_model_2d( coord , s , L , a , b , x_0 , y_0 ):
+closed form partial derivatives of trail_model() with respect to [ s , L , a , b_1 , x_0 , y_0 ]
+	for the jac= argument of curve_fit. uses (and sets) the globals img_rot and flux like trail_model()
 
-	global flux, img_rot
+PARAMETERS
+-----------
+x, y, s, L, a, b_1, x_0, y_0 :
+	same as trail_model()
 
-	model  = draw_model ( s , L , a, b , x_0 , y_0 )
-	return model.flatten()
+RETURNS
+--------
+jac : array
+	shape (x.size, 6), column i is d trail_model / d param_i for every (flattened) pixel
+'''
+def trail_model_jac(x, y, s, L, a, b_1, x_0, y_0):
+
+	global img_rot, flux
 
+	flux = trail_flux(img_rot, s, L, x_0, y_0)
+	return trail_profile_jac(x, y, s, L, a, b_1, x_0, y_0, flux)
 
 '''
-actually doing the Veres 2012 eq 3 calculations for every x, y given
-	in usage, have to explicitely define img_rot and flux, so these are the variables you expect!!
+closed form partial derivatives of trail_profile() with respect to [ s , L , a , b_1 , x_0 , y_0 ]
+	the flux normalization is a sum over whole pixels of img_rot, so it is piecewise constant in the parameters and
+	is held fixed here -- same as it is between finite difference steps, so curve_fit lands on the same solution
+	as before, just with fewer model evaluations
 
 PARAMETERS
 -----------
@@ -585,45 +2412,60 @@ x 	: array, dtype=int
 	array of CCD column coordinates in px
 y 	: array, dtype=int
 	array of CCD row coordinates in px
-s   : float 
-	Gaussian spread 
+s   : float
+	Gaussian spread
 L   : float
 	trail length
 a   : float
-	angle from positive horizontal
+	angle from positive horizontal [degrees]
 b_1 : float
 	constant estimate of background flux
 x_0 : float
-	CCD pixel column number of trail centroid 
+	CCD pixel column number of trail centroid
 y_0 : float
 	CCD pixel row number of trail centroid
+flux : float
+	total counts the trail is normalized to, see trail_flux()
 
 RETURNS
--------- 
-	2d numpy array -- same shape as img_rot. scalar background estimate is b_1, with trail drawn vertically at x_0, y_0
+--------
+jac : array
+	shape (x.size, 6), column i is d trail_profile / d param_i for every (flattened) pixel
 '''
-def trail_model(x, y, s, L, a, b_1, x_0, y_0):
-
-	global img_rot, flux
-	
-	# ok i think this needs to be > 1
-	L_but_longer = L*1.2
-	s_but_wider  = s*1.2
-
-	trail = img_rot[int(y_0 - L_but_longer/2):int(y_0 + L_but_longer/2+1) , int(x_0 - s_but_wider*2.355 + .5):int(x_0 + s_but_wider*2.355 + .5)]
+def trail_profile_jac(x, y, s, L, a, b_1, x_0, y_0, flux):
 
-	flux   = np.sum(trail)
 	a      = (a) * np.pi/180
 	cosine = np.cos(a)
 	sine   = np.sin(a)
 
+	dx = np.ravel(x - x_0)
+	dy = np.ravel(y - y_0)
+
+	u = dx * cosine + dy * sine 	# along trail
+	v = dx * sine   + dy * cosine 	# across trail
+
 	flux_term   = flux/(L * 2 * s * (2 * np.pi)**.5)
-	exponential = np.exp( -(( (x-x_0)*sine + (y-y_0)*cosine )**2 ) / (2*s**2) )
-	erf1 = erf(( (x-x_0) * cosine + (y-y_0) * sine + L/2) / (s*2**.5)) 
-	erf2 = erf(( (x-x_0) * cosine + (y-y_0) * sine - L/2) / (s*2**.5))
-	background = b_1 
+	exponential = np.exp( -v**2 / (2*s**2) )
 
-	return flux_term * exponential * (erf1-erf2) + background
+	z1 = (u + L/2) / (s*2**.5)
+	z2 = (u - L/2) / (s*2**.5)
+	g1 = 2/np.pi**.5 * np.exp(-z1**2) # erf'(z1)
+	g2 = 2/np.pi**.5 * np.exp(-z2**2) # erf'(z2)
+	erf_diff = erf(z1) - erf(z2)
+
+	trail_term = flux_term * exponential * erf_diff
+
+	dE_dv = -exponential * v / s**2
+	dD_du = (g1 - g2) / (s*2**.5)
+
+	d_s = -trail_term/s + flux_term * ( exponential * v**2 / s**3 * erf_diff - exponential * (g1*z1 - g2*z2) / s )
+	d_L = -trail_term/L + flux_term * exponential * (g1 + g2) / (2 * s*2**.5)
+	d_a = flux_term * ( dE_dv * (dx*cosine - dy*sine) * erf_diff + exponential * dD_du * (dy*cosine - dx*sine) ) * np.pi/180
+	d_b = np.ones(u.shape)
+	d_x = flux_term * ( dE_dv * -sine   * erf_diff + exponential * dD_du * -cosine )
+	d_y = flux_term * ( dE_dv * -cosine * erf_diff + exponential * dD_du * -sine   )
+
+	return np.array([d_s, d_L, d_a, d_b, d_x, d_y]).T
 
 
 '''
@@ -651,389 +2493,1708 @@ RETURNS
 '''
 def draw_model(s, L, a, b_1, c_x, c_y):
 
-	global img_rot
+	global img_rot, flux
 
-	# dont actually know if this meshgrid business works??? come back to this first if breaks
-	# xx, yy = np.meshgrid(np.arange(0, img_rot.shape[1]), np.arange(0, img_rot.shape[0]))
-	xx, yy = np.meshgrid( np.arange(0, img_rot.shape[1]), np.arange(0, img_rot.shape[0]) )
-	model = trail_model(xx, yy, s, L, a, b_1, c_x, c_y)	#assuming this is 2FWHM wide and 2L tall
+	fitter = TrailFitter(img_rot)
+	flux   = fitter.trail_flux(s, L, c_x, c_y)
+	return fitter.draw(s, L, a, b_1, c_x, c_y)
 
-	# print(img.shape, rotate(img,-a).shape)
-	return model
-	
 '''
+padded postage stamp around a trail, sized from the trail parameters -- used for windowed trail fitting
+	the window is the bounding box of the region where trail_model() differs from the background,
+	i.e. pad*s either side of the trail and pad*s beyond either end, clipped to the image
 
-I guess this is where the shitshow begins i guess
-	this will be less well commented for a while just because i haven't had the care to.
-	so a lot of it will be ugly and inexplicable unless u ask me.
+PARAMETERS
+-----------
+shape : tuple
+	(rows, columns) of the image the trail lives in
+s     : float
+	Gaussian spread
+L     : float
+	trail length
+a     : float
+	angle from positive horizontal
+x_0   : float
+	CCD pixel column number of trail centroid
+y_0   : float
+	CCD pixel row number of trail centroid
+pad   : float
+	(optional) padding in units of s around the trail ; default = 10
 
+RETURNS
+--------
+rows : slice
+	row slice of the window into the image
+cols : slice
+	column slice of the window into the image
 '''
+def trail_window(shape, s, L, a, x_0, y_0, pad=10):
+	a      = a * np.pi/180
+	cosine = np.cos(a)
+	sine   = np.sin(a)
+	det    = cosine**2 - sine**2
 
-if __name__ == '__main__':
-	
-	for d in dir_names:
-		file_names = [d+f for f in os.listdir(d) if isfile(join(d,f))]
-		yea = False
+	# trail_model is in along-trail u = dx*cos + dy*sin and cross-trail v = dx*sin + dy*cos, invert corners of the (u, v) box
+	if np.abs(det) < 1e-3:
+		return slice(0, shape[0]), slice(0, shape[1])
 
-		if not f_name in d: continue
+	u = np.abs(L)/2 + pad*np.abs(s)
+	v = pad*np.abs(s)
+	corners = np.array([[u, v], [u, -v], [-u, v], [-u, -v]])
+	dx = (corners[:,0]*cosine - corners[:,1]*sine) / det
+	dy = (corners[:,1]*cosine - corners[:,0]*sine) / det
 
-		start_times = []
-		lightcurves = []
-		errors      = []
+	half_width  = np.max(np.abs(dx)) + 1
+	half_height = np.max(np.abs(dy)) + 1
 
-		for f in file_names:
-			# if '06o13' not in f: continue
-			try:
-				file = fits.open(f)
-				print(f)
-			except Exception as e:
-				print(f)
-				continue
+	rows = slice(int(np.clip(y_0 - half_height, 0, shape[0])), int(np.clip(y_0 + half_height + 1, 0, shape[0])))
+	cols = slice(int(np.clip(x_0 - half_width , 0, shape[1])), int(np.clip(x_0 + half_width  + 1, 0, shape[1])))
+	return rows, cols
 
-			# if  ('1938060o04.flt' not in f and '1938061o04.flt' not in f) : continue
+'''
+trail fitting on one image without the img_rot / flux globals
+	owns the image, the pixel grids of every window it has fit in and the flux normalization of every box it has summed,
+	so many trails on the same frame share that work. fit() only reads the image and adds to the caches,
+	so one TrailFitter can be used from many threads at once (or pickled to worker processes)
 
+	usage:  > fitter = TrailFitter(img_star_rotated)
+	        > param, param_cov = fitter.fit(p0)
+	        > flux = fitter.trail_flux(*param[[0,1,4,5]])
 
-			hdr = file[0].header
-			img = file[0].data
+PARAMETERS
+-----------
+img          : array
+	2d numpy array of the (rotated) image trails are fit in
+pad          : float
+	(optional) padding in units of s around the trail, see trail_window() ; default = 10
+analytic_jac : bool
+	(optional) pass trail_profile_jac() to curve_fit instead of finite differences ; default = True
+dtype        : type
+	(optional) precision the model and jacobian are evaluated in, np.float32 halves the pixel grids and temporaries ; default = np.float64
+'''
+class TrailFitter:
+
+	def __init__(self, img, pad=10, analytic_jac=True, dtype=np.float64):
+		self.img          = img
+		self.pad          = pad
+		self.analytic_jac = analytic_jac
+		self.dtype        = np.dtype(dtype)
+
+		self.n_pix      = img.size
+		self.img_sum    = None 	# whole image sums for the out-of-window residuals, filled on first use
+		self.img_sq_sum = None
+
+		self.grids      = {}	# (r_0, r_1, c_0, c_1) -> (yy, xx) of a window
+		self.flux_cache = {}	# (r_0, r_1, c_0, c_1) -> trail_flux() of a box
+
+	'''
+	whole image sum and sum of squares, computed once per image
+	'''
+	def image_sums(self):
+		if self.img_sum is None:
+			img_sq_sum      = np.sum(np.square(self.img, dtype=float))
+			self.img_sum    = np.sum(self.img, dtype=float)
+			self.img_sq_sum = img_sq_sum
+		return self.img_sum, self.img_sq_sum
+
+	'''
+	pixel coordinate grids (yy, xx) of a window, cached
+	'''
+	def grid(self, rows, cols):
+		key = (rows.start, rows.stop, cols.start, cols.stop)
+		if key not in self.grids:
+			self.grids[key] = np.mgrid[rows, cols].astype(self.dtype)
+		return self.grids[key]
+
+	'''
+	trail_flux() of the image, cached on the pixel box so it is only summed when the box actually moves
+	'''
+	def trail_flux(self, s, L, x_0, y_0):
+		key = trail_flux_box(s, L, x_0, y_0)
+		if key not in self.flux_cache:
+			self.flux_cache[key] = np.sum(self.img[key[0]:key[1], key[2]:key[3]])
+		return self.flux_cache[key]
+
+	'''
+	trail_model() evaluated at pixel coordinates x, y of this image
+	'''
+	def model(self, x, y, s, L, a, b_1, x_0, y_0):
+		return trail_profile(x, y, *self.cast(s, L, a, b_1, x_0, y_0, self.trail_flux(s, L, x_0, y_0)))
+
+	'''
+	trail_model_jac() evaluated at pixel coordinates x, y of this image
+	'''
+	def jac(self, x, y, s, L, a, b_1, x_0, y_0):
+		return trail_profile_jac(x, y, *self.cast(s, L, a, b_1, x_0, y_0, self.trail_flux(s, L, x_0, y_0)))
+
+	'''
+	parameters as self.dtype scalars, so numpy doesn't promote the model back up to float64
+	'''
+	def cast(self, *param):
+		return [self.dtype.type(p) for p in param]
+
+	'''
+	model over the whole image, same as draw_model()
+	'''
+	def draw(self, s, L, a, b_1, x_0, y_0):
+		yy, xx = self.grid(slice(0, self.img.shape[0]), slice(0, self.img.shape[1]))
+		return self.model(xx, yy, s, L, a, b_1, x_0, y_0)
+
+	'''
+	windowed replacement for curve_fit(trail_model_2d, img, img.flatten(), p0=p0)
+		only the padded postage stamp from trail_window() is modelled. outside the window the model is exactly the background b_1,
+		so the pixels out there are folded into two summary residuals (n_out * (mean_out - b)**2 and the scatter about mean_out),
+		which keeps the least squares problem -- and the covariance -- the same as the full frame fit.
+		if the fitted trail wanders out of its window, the window is moved and the fit is rerun from the last solution.
+
+	PARAMETERS
+	-----------
+	p0        : array
+		initial guess [ s , L , a , b , x_0 , y_0 ]
+	window    : bool
+		(optional) if False, the whole image is modelled every evaluation ; default = True
+	max_moves : int
+		(optional) number of times the window is allowed to follow the trail ; default = 5
+	kwargs    :
+		passed to curve_fit
+
+	RETURNS
+	--------
+	param     : array
+		best fit [ s , L , a , b , x_0 , y_0 ]
+	param_cov : array
+		covariance matrix of the best fit parameters, same normalization as the full frame fit
+	'''
+	def fit(self, p0, window=True, max_moves=5, **kwargs):
+		img   = self.img
+		n_pix = self.n_pix
+		img_sum, img_sq_sum = self.image_sums()
+
+		param = np.array(p0, dtype=float)
+
+		if window: rows, cols = trail_window(img.shape, param[0], param[1], param[2], param[4], param[5], pad=self.pad)
+		else:      rows, cols = slice(0, img.shape[0]), slice(0, img.shape[1])
+
+		for move in range(max_moves):
+			stamp  = img[rows, cols].astype(float)
+			yy, xx = self.grid(rows, cols)
+
+			n_out    = n_pix - stamp.size
+			out_mean = (img_sum - np.sum(stamp)) / max(n_out, 1)
+			out_ss   = max(img_sq_sum - np.sum(stamp**2) - n_out * out_mean**2, 0)
+
+			ydata = np.append(stamp.ravel(), [n_out**.5 * out_mean, out_ss**.5])
+
+			def windowed_model(coord, s, L, a, b, x_0, y_0):
+				model = self.model(xx, yy, s, L, a, b, x_0, y_0).ravel()
+				return np.append(model, [n_out**.5 * b, 0])
+
+			def windowed_jac(coord, *param):
+				summary = np.zeros((2, len(param)))
+				summary[0, 3] = n_out**.5
+				return np.vstack([self.jac(xx, yy, *param), summary])
+
+			fit_kwargs = dict(kwargs)
+			if self.analytic_jac:
+				fit_kwargs['jac'] = windowed_jac
+
+			param, param_cov = curve_fit(windowed_model, stamp, ydata, p0=param, **fit_kwargs)
+
+			if not window: break
+
+			new_rows, new_cols = trail_window(img.shape, param[0], param[1], param[2], param[4], param[5], pad=self.pad)
+			inside = new_rows.start >= rows.start and new_rows.stop <= rows.stop and new_cols.start >= cols.start and new_cols.stop <= cols.stop
+			if inside: break
+			rows, cols = new_rows, new_cols
+
+		# curve_fit normalizes by (n_data - n_params), the full frame has n_pix data points
+		param_cov = param_cov * (ydata.size - len(param)) / (n_pix - len(param))
+
+		return param, param_cov
+
+	'''
+	root sum squared residual of the trail model over the whole image, computed from the trail window only
+		equivalent to np.sum((trail_model_2d(0, *param) - img.flatten())**2)**.5
+		flux overrides the trail_flux() normalization, for fit_joint() results
+	'''
+	def residual(self, param, flux=None):
+		img = self.img
+		img_sum, img_sq_sum = self.image_sums()
+
+		rows, cols = trail_window(img.shape, param[0], param[1], param[2], param[4], param[5], pad=self.pad)
+		stamp  = img[rows, cols].astype(float)
+		yy, xx = self.grid(rows, cols)
+
+		if flux is None: flux = self.trail_flux(param[0], param[1], param[4], param[5])
+
+		b      = param[3]
+		in_ss  = np.sum((trail_profile(xx, yy, *self.cast(*param, flux)) - stamp)**2)
+		out_ss = img_sq_sum - 2*b*img_sum + self.n_pix*b**2 - np.sum((stamp - b)**2)
+
+		return (in_ss + max(out_ss, 0)) ** .5
+
+	'''
+	joint fit of many star trails on this image -- every star on a sidereal tracked frame has the same s, L and a,
+		so those are fit once across all the star cutouts, with [ b , x_0 , y_0 , flux ] free per star.
+		flux is a free parameter here rather than the trail_flux() box sum, and the jacobian is block sparse:
+		the shared columns are filled for every pixel, each star's 4 columns only for its own cutout.
+		cutouts are the trail_window()s of the starting guesses and don't move
+
+	PARAMETERS
+	-----------
+	p0s    : array
+		initial guesses, one row of [ s , L , a , b , x_0 , y_0 ] per star -- the shared s, L, a start from their medians
+	kwargs :
+		passed to scipy.optimize.least_squares (loss, f_scale, ...)
+
+	RETURNS
+	--------
+	param     : array
+		best fit [ s , L , a ] followed by [ b , x_0 , y_0 , flux ] for every star
+	param_cov : array
+		covariance matrix of param
+	'''
+	def fit_joint(self, p0s, **kwargs):
+		img = self.img
+		p0s = np.asarray(p0s, dtype=float).reshape(-1, 6)
+		n   = len(p0s)
+
+		s, L, a = np.median(p0s[:,:3], axis=0)
+
+		grids, stamps = [], []
+		q0 = [s, L, a]
+		for p in p0s:
+			rows, cols = trail_window(img.shape, s, L, a, p[4], p[5], pad=self.pad)
+			stamp = img[rows, cols].astype(float).ravel()
+			b     = np.median(stamp) if stamp.size else p[3]
+			grids .append(self.grid(rows, cols))
+			stamps.append(stamp)
+			q0 += [b, p[4], p[5], max(np.sum(stamp - b), 1.)]
+
+		ydata  = np.concatenate(stamps)
+		starts = np.cumsum([0] + [stamp.size for stamp in stamps])
+		if ydata.size <= len(q0):
+			raise ValueError(f'The number of func parameters={len(q0)} must not exceed the number of data points={ydata.size}')
+
+		# every row of the jacobian has the 3 shared columns then its star's 4, so the csr structure is fixed
+		indptr  = np.arange(0, 7*ydata.size + 1, 7)
+		indices = np.concatenate([np.tile([0, 1, 2, 3+4*i, 4+4*i, 5+4*i, 6+4*i], stamps[i].size) for i in range(n)])
+
+		last = {}	# least_squares asks for the jacobian where it just evaluated the residuals, reuse the model there
+
+		def models(q):
+			if 'q' not in last or not np.array_equal(last['q'], q):
+				last['q'] = q.copy()
+				last['m'] = [trail_profile(xx, yy, *self.cast(*q[:3], *q[3+4*i:7+4*i])).ravel() for i, (yy, xx) in enumerate(grids)]
+			return last['m']
+
+		def residuals(q):
+			return np.concatenate(models(q)) - ydata
+
+		def jac(q):
+			model = models(q)
+			data  = []
+			for i, (yy, xx) in enumerate(grids):
+				b, x_0, y_0, flux = q[3+4*i:7+4*i]
+				J   = trail_profile_jac(xx, yy, *self.cast(*q[:3], b, x_0, y_0, flux))
+				d_f = (model[i] - b) / flux
+				data.append(np.column_stack((J, d_f)).ravel())
+			return csr_matrix((np.concatenate(data), indices, indptr), shape=(ydata.size, len(q0)))
+
+		lower = np.full(len(q0), -np.inf)
+		lower[:2] = [.3, 1]
+		lower[6::4] = 0
+		q0 = np.maximum(q0, lower)
+
+		kwargs = {'x_scale': 'jac', **kwargs}
+		result = least_squares(residuals, q0, jac=jac, bounds=(lower, np.inf), **kwargs)
+
+		J   = result.jac.toarray()
+		dof = max(ydata.size - len(q0), 1)
+		cov = np.linalg.pinv(J.T @ J) * np.sum(result.fun**2) / dof
+
+		return result.x, cov
 
-			exp_time   = float(hdr['EXPMEAS'])
-			gain       = float(hdr['GAIN'])
-			rd_noise   = float(hdr['RDNOISE'])
-			# obs_filter = float(hdr['FILTE'])
+'''
+windowed replacement for curve_fit(trail_model_2d, img, img.flatten(), p0=p0), see TrailFitter.fit()
+	sets the globals img_rot and flux, same as the full frame fit
 
-			# object id from directory name --> string splicing
-			obj_id = f.split('_')
-			obj_id = obj_id[0][2:] + ' ' + obj_id[1]
+PARAMETERS
+-----------
+img       : array
+	2d numpy array of the (rotated) image the trail is fit in
+p0        : array
+	initial guess [ s , L , a , b , x_0 , y_0 ]
+window    : bool
+	(optional) if False, the whole image is modelled every evaluation ; default = True
+pad       : float
+	(optional) padding in units of s around the trail, see trail_window() ; default = 10
+max_moves : int
+	(optional) number of times the window is allowed to follow the trail ; default = 5
+analytic_jac : bool
+	(optional) pass trail_model_jac() to curve_fit instead of finite differences ; default = True
+kwargs    :
+	passed to curve_fit
 
-			obj_rows = input_file[np.where(input_file[:,1]==obj_id),:][0]
-			
-			try:
-				obj = obj_rows[np.where(obj_rows[:,0]==f.split('/')[-1])][0]
-				trail_start = np.array(obj[-4:-2], dtype=int)
-				trail_end	= np.array(obj[-2:], dtype=int)
-				start_time  = float(obj[6])
-			except Exception as e:
-				# print(f,obj[-4:-2],obj[-2:])
-				# plt.close()
-				continue
+RETURNS
+--------
+param     : array
+	best fit [ s , L , a , b , x_0 , y_0 ]
+param_cov : array
+	covariance matrix of the best fit parameters, same normalization as the full frame fit
+'''
+def fit_trail(img, p0, window=True, pad=10, max_moves=5, analytic_jac=True, **kwargs):
 
-			# global variable flux to capture the total flux of the trail
-			flux = 0
+	global img_rot, flux
 
-			# NEGATIVE ANGLE OF ASTEROID TRAIL WRT HOME FRAME			
-			angle       = -1*np.arctan2(trail_end[0]-trail_start[0], trail_end[1]-trail_start[1]) * 180/np.pi
-			# IMG ROTATED TO ASTEROID TRAIL IS VERTICAL
-			img_rotated = rotate(img, angle)
+	fitter = TrailFitter(img, pad=pad, analytic_jac=analytic_jac)
+	param, param_cov = fitter.fit(p0, window=window, max_moves=max_moves, **kwargs)
 
-			ast_trail_start  = np.array(point_rotation(trail_start[0], trail_start[1], angle, img, img_rotated), dtype=int)
-			ast_trail_end	 = np.array(point_rotation(trail_end  [0], trail_end  [1], angle, img, img_rotated), dtype=int)
-			ast_trail_length = ast_trail_end[1] - ast_trail_start[1]
+	# leave flux at the solution rather than wherever the last jacobian step was
+	img_rot = img
+	flux    = fitter.trail_flux(param[0], param[1], param[4], param[5])
 
-			# DOING TRAIL SPREAD TO GET FIRST APPROX FOR FWHM
-			trail_spread, trail_spread_covs, trail_width = trail_spread_function(img_rotated, ast_trail_start, ast_trail_end, display=False)
-			fwhm = int(trail_spread[0] * 2.355 + .5)
-			# correcting trail start/end
-			centroid_deviation  = trail_spread[1] - trail_width # if negative, trail is to the left, if positive, trail to right
-			ast_trail_start[0] += int(centroid_deviation+.5)
-			ast_trail_end  [0] += int(centroid_deviation+.5)
+	return param, param_cov
 
-			trail_centroid = np.array([ast_trail_start[0], np.mean([ast_trail_start[1], ast_trail_end[1]])])
+'''
+root sum squared residual of the trail model over the whole image, see TrailFitter.residual()
+	equivalent to np.sum((trail_model_2d(0, *param) - img.flatten())**2)**.5
 
-			# ASTEROID TRAIL FITTING
-			img_rot     = img_rotated
-			centroid    = trail_centroid
-			# box_x_width = 30
-			# box_y_width = ast_trail_length * 2
+PARAMETERS
+-----------
+img   : array
+	2d numpy array of the (rotated) image the trail was fit in
+param : array
+	[ s , L , a , b , x_0 , y_0 ]
+pad   : float
+	(optional) padding in units of s around the trail, see trail_window() ; default = 10
 
-			p0           = np.array([trail_spread[0], ast_trail_length, 90, 200, trail_centroid[0], trail_centroid[1]])
+RETURNS
+--------
+residual : float
+'''
+def trail_residual(img, param, pad=10):
+	return TrailFitter(img, pad=pad).residual(param)
 
-			# TRAIL FITTING ATTEMPT WITH scipy.optimize.least_squares()
-			# fit          = least_squares(residual, p0, loss='linear', ftol=0.05, xtol=0.05, gtol=0.05, bounds=param_bounds)
+'''
+worker side of fit_stars() -- attaches to the shared image once per process
+'''
+def fit_stars_init(shm_name, shape, dtype, pad, model_dtype):
+	global star_shm, star_fitter
 
-			# img_slice = img_rotated[int(centroid[1] - box_y_width/2 + .5):int(centroid[1] + box_y_width/2 + .5) , int(centroid[0] - box_x_width/2 + .5):int(centroid[0] + box_x_width/2 + .5)]
+	star_shm    = shared_memory.SharedMemory(name=shm_name)
+	img         = np.ndarray(shape, dtype=dtype, buffer=star_shm.buf)
+	star_fitter = TrailFitter(img, pad=pad, dtype=model_dtype)
 
-			# TRAIL FITTING WITH scipy.optimize.curve_fit()
-			# ast_param , ast_param_cov = curve_fit(trail_model_2d, img_rotated, img_slice.flatten(), p0=p0)	
-			#  display_streak(img_rot, 10, 300, 90, b, x_0, y_0, width=2)
+'''
+worker side of fit_stars() -- one star, returns ( param , param_cov , residual , flux ) or the exception if the fit failed
+'''
+def fit_stars_task(p0):
+	try:
+		param, param_cov = star_fitter.fit(p0)
+	except Exception as e:
+		return e
 
+	residual = star_fitter.residual(param)
+	flux     = star_fitter.trail_flux(param[0], param[1], param[4], param[5])
+	return param, param_cov, residual, flux
 
-			# img_view = trail_view( img_rot, *p0 )
+'''
+fit many star trails on the same (rotated) image across a process pool
+	the image is copied once into shared memory and every worker attaches to it, so only the p0s and results are pickled.
+	results come back in the same order as p0s no matter which worker finishes first
 
-			# img_view = 
+PARAMETERS
+-----------
+img     : array
+	2d numpy array of the (rotated) image the stars are fit in
+p0s     : array
+	initial guesses, one row of [ s , L , a , b , x_0 , y_0 ] per star
+workers : int
+	(optional) number of worker processes, None for all cores ; default = None
+pad     : float
+	(optional) padding in units of s around the trail, see trail_window() ; default = 10
+dtype   : type
+	(optional) model precision, see TrailFitter ; default = np.float64
 
+RETURNS
+--------
+results : list
+	per star ( param , param_cov , residual , flux ), or the exception raised if that star's fit failed
+'''
+def fit_stars(img, p0s, workers=None, pad=10, dtype=np.float64):
+	if workers is None: workers = os.cpu_count()
 
+	if workers <= 1 or len(p0s) <= 1:
+		fit_stars_init_local(img, pad, dtype)
+		return [fit_stars_task(p0) for p0 in p0s]
 
-			ast_param , ast_param_cov = curve_fit(trail_model_2d, img_rot, img_rot.flatten(), p0=p0)	
+	img = np.ascontiguousarray(img)
+	shm = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+	try:
+		np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)[:] = img
+		with ProcessPoolExecutor(max_workers=workers, initializer=fit_stars_init, initargs=(shm.name, img.shape, img.dtype, pad, dtype)) as pool:
+			results = list(pool.map(fit_stars_task, p0s))
+	finally:
+		shm.close()
+		shm.unlink()
 
-			ast_flux = flux
-			
-			print('asteroid p0[  s , L , a , b , x_0 , y_0 ]: '            , p0)
-			print('asteroid fit parameters [ s , L , a , b , x_0 , y_0 ]: ', ast_param)
-			print('parameter uncertainties: '                              , np.sqrt(np.diag(ast_param_cov)))
-
-			ast_fwhm			  = ast_param[0] * 2.355
-			ast_trail_length	  = ast_param[1]
-			# ast_height_correction = ast_trail_length * 0
-			ast_height_correction = - int( ast_fwhm ) - 5
-			# ast_height_correction = - ast_fwhm
-			
-			trail_centroid 		  = np.array([ast_param[4], ast_param[5]])
+	return results
 
-			ast_trail_start = np.array([trail_centroid[0] , trail_centroid[1] - ast_trail_length/2 ])
-			ast_trail_end   = np.array([trail_centroid[0] , trail_centroid[1] + ast_trail_length/2 ])
+'''
+same as fit_stars_init() without the pool, for workers=1
+'''
+def fit_stars_init_local(img, pad, model_dtype):
+	global star_fitter
+	star_fitter = TrailFitter(img, pad=pad, dtype=model_dtype)
 
-			obj_minus_sky, sigma_row, sky_row_avg = take_lightcurve(img_rotated, ast_trail_start, ast_trail_end, fwhm=ast_fwhm, b=None, height_correction=ast_height_correction, display=False, err=True, gain=gain, rd_noise=rd_noise)
-			
-			print( 'asteroid trail length: ', len(obj_minus_sky) )
+'''
+fit_stars() with one joint fit instead of one fit per star, see TrailFitter.fit_joint()
+	s, L and a come out the same for every star, flux is the fitted trail flux (not the trail_flux() box sum)
 
-			# source extractor !!
-			# sex = subprocess.run(['sex', f, '-DETECT_MINAREA', str(trail_length*fwhm), '-CATALOG_NAME', '_'.join(f.split("/")[1:])[:-4] + '.cat'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+PARAMETERS
+-----------
+img    : array
+	2d numpy array of the (rotated) image the stars are fit in
+p0s    : array
+	initial guesses, one row of [ s , L , a , b , x_0 , y_0 ] per star
+pad    : float
+	(optional) padding in units of s around the trail, see trail_window() ; default = 10
+dtype  : type
+	(optional) model precision, see TrailFitter ; default = np.float64
+kwargs :
+	passed to TrailFitter.fit_joint()
+
+RETURNS
+--------
+results : list
+	per star ( param , param_cov , residual , flux ) like fit_stars(), or the exception for every star if the joint fit failed
+'''
+def fit_stars_joint(img, p0s, pad=10, dtype=np.float64, **kwargs):
+	fitter = TrailFitter(img, pad=pad, dtype=dtype)
+	try:
+		param, param_cov = fitter.fit_joint(p0s, **kwargs)
+	except Exception as e:
+		return [e] * len(p0s)
+
+	results = []
+	for i in range(len(p0s)):
+		# [ s , L , a , b , x_0 , y_0 ] and flux of star i out of the joint parameter vector
+		idx       = [0, 1, 2, 3+4*i, 4+4*i, 5+4*i]
+		flux      = param[6+4*i]
+		str_param = param[idx]
+		results.append((str_param, param_cov[np.ix_(idx, idx)], fitter.residual(str_param, flux=flux), flux))
+	return results
+
+# version of the trail model and fitters, part of every fit cache key -- bump it when either changes what a fit returns
+fit_model_version = 1
+
+'''
+hex key of anything numpy arrays, numbers, strings and tuples of them are made of
+'''
+def fit_cache_key( *parts ):
+	sha1 = hashlib.sha1()
+	for part in parts:
+		if isinstance(part, np.ndarray): sha1.update(f'{part.dtype.str}{part.shape}'.encode() + np.ascontiguousarray(part).tobytes())
+		else:                            sha1.update(repr(part).encode())
+		sha1.update(b'|')
+	return sha1.hexdigest()
+
+"""
+content addressed cache of trail fits on disk -- replaces the <frame>_params.txt "cheat codes"
+	every fit result (the tuple fit() / fit_stars() return) is kept as an .npz under the hash of everything the fit
+	depends on, see cached_fits(). next to it the converged parameters are kept under a looser warm key (same
+	pixels, about the same place, any p0) as a starting point for fits that aren't exact repeats. the least recently
+	used entries beyond maxsize are deleted. safe to share between processes, every process keeps its own index and
+	picks up the others' entries as it meets them
+
+	usage:  > cache = FitCache('./fit_cache/')
+	        > state, entry = cache.lookup(key, warm_key)    # ('hit', result) , ('warm', param) or (None, None)
+	        > cache.store(key, warm_key, *result)
+	        > print(cache)                                  # size, evictions and hit rate
+
+PARAMETERS
+-----------
+root    : str
+	cache directory, created if missing
+maxsize : int
+	(optional) max number of entries ; default = 200000
+"""
+class FitCache:
+
+	def __init__(self, root, maxsize=200000):
+		self.root      = root
+		self.maxsize   = maxsize
+		self.index     = OrderedDict()	# key -> bytes on disk, least recently used first
+		self.hits      = 0
+		self.warm_hits = 0
+		self.misses    = 0
+		self.evictions = 0
+
+		os.makedirs(root, exist_ok=True)
+		found = []
+		for sub in os.listdir(root):
+			if not isdir(join(root, sub)): continue
+			for name in os.listdir(join(root, sub)):
+				if not name.endswith('.npz'): continue
+				stat = os.stat(join(root, sub, name))
+				found.append((stat.st_mtime, name[:-4], stat.st_size))
+		for _, key, nbytes in sorted(found):
+			self.index[key] = nbytes
+
+	def path(self, key):
+		return join(self.root, key[:2], key + '.npz')
+
+	'''
+	stored arrays of key as a tuple (0-d arrays as python numbers), None if it isn't there
+	'''
+	def get(self, key):
+		path = self.path(key)
+		if key not in self.index:
+			if not isfile(path): return None
+			self.index[key] = os.path.getsize(path)	# stored by another process
+		try:
+			with np.load(path) as stored:
+				entry = tuple(stored[f'arr_{i}'] for i in range(len(stored.files)))
+			os.utime(path)
+		except (OSError, ValueError, KeyError):
+			self.index.pop(key, None)
+			return None
+		self.index.move_to_end(key)
+		return tuple(e.item() if e.ndim == 0 else e for e in entry)
+
+	def put(self, key, *arrays):
+		path = self.path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp = f'{path[:-4]}.{os.getpid()}.tmp.npz'
+		np.savez(tmp, *arrays)
+		os.replace(tmp, path)
+		self.index[key] = os.path.getsize(path)
+		self.index.move_to_end(key)
+
+		while len(self.index) > self.maxsize:
+			old, _ = self.index.popitem(last=False)
+			self.evictions += 1
 			try:
-				se_index = [x for x in se_files if (f.split('/')[1] in x and f.split("/")[2].split(".")[0] in x)][0]
-			except Exception as e:
-				print(e)
-				continue
+				os.remove(self.path(old))
+			except FileNotFoundError:
+				pass
+
+	'''
+	('hit', stored result) for an exact repeat, ('warm', converged parameters) if only the warm key is known, else (None, None)
+	'''
+	def lookup(self, key, warm_key=None):
+		entry = self.get(key)
+		if entry is not None:
+			self.hits += 1
+			return 'hit', entry
+		entry = self.get(warm_key) if warm_key is not None else None
+		if entry is not None:
+			self.warm_hits += 1
+			return 'warm', entry[0]
+		self.misses += 1
+		return None, None
+
+	def store(self, key, warm_key, *result):
+		self.put(key, *result)
+		if warm_key is not None: self.put(warm_key, result[0])
+
+	@property
+	def nbytes(self):
+		return sum(self.index.values())
+
+	@property
+	def hit_rate(self):
+		lookups = self.hits + self.warm_hits + self.misses
+		return self.hits / lookups if lookups else 0.
+
+	def __len__(self):
+		return len(self.index)
+
+	def __str__(self):
+		return (f'fit cache {self.root}: {len(self.index)}/{self.maxsize} entries, {self.nbytes/2**20:.1f} MiB, {self.evictions} evicted, '
+		        f'{self.hits} hits, {self.warm_hits} warm starts, {self.misses} misses ({100*self.hit_rate:.0f}% hit rate)')
+
+# this process' FitCache, see open_fit_cache()
+fit_cache = None
 
-			sex_output = np.loadtxt(se_index, skiprows=9)
-			print('SExtractor found stars: ', sex_output.shape[0])
-			star_x = sex_output[:,5]
-			star_y = sex_output[:,6]
+'''
+the FitCache of fit_cache_dir, opened once per process -- None if caching is off
+'''
+def open_fit_cache():
+	global fit_cache
+	if fit_cache_dir is None: return None
+	if fit_cache is None or fit_cache.root != fit_cache_dir:
+		fit_cache = FitCache(fit_cache_dir, maxsize=fit_cache_size)
+	return fit_cache
 
-			# dist_to_asteroid = []
-			dist_to_asteroid = ( (star_x - trail_centroid[0]) ** 2 + (star_y - trail_centroid[1]) **2 ) **.5 
+"""
+fit(p0s) through a FitCache -- exact repeats aren't fit again, the rest start from a warm entry where there is one
+	a fit's key is the hash of key_parts (the frame's pixels, how they were rotated, what is being fit), its starting
+	window into the image, p0, dtype, pad and fit_model_version. the warm key drops p0 for the trail centre rounded
+	to 4 pixels. results that are exceptions aren't stored
 
-			dist_sorted = np.argsort(dist_to_asteroid)
+PARAMETERS
+-----------
+cache     : FitCache
+	cache to use, None just calls fit(p0s)
+key_parts : tuple
+	what identifies the image, e.g. (pixel hash, rotation angle, 'stars')
+p0s       : list
+	initial guesses [ s , L , a , b , x_0 , y_0 ]
+fit       : function
+	fit(p0s) -> list of result tuples (param first) or exceptions, e.g. fit_stars
+shape     : tuple
+	(rows, columns) of the image fit in
+pad       : float
+	(optional) padding in units of s, see trail_window() ; default = 10
+dtype     : type
+	(optional) model precision the fits run in ; default = np.float64
+warm      : bool
+	(optional) keep and use warm entries ; default = True
 
-			star_x      = star_x[dist_sorted]
-			star_y      = star_y[dist_sorted]
+RETURNS
+--------
+results : list
+	what fit(p0s) would have returned
+"""
+def cached_fits( cache , key_parts , p0s , fit , shape , pad=10 , dtype=np.float64 , warm=True ):
+	if cache is None: return fit(p0s)
+
+	results = [None] * len(p0s)
+	todo    = []
+	for i, p0 in enumerate(p0s):
+		p0     = np.asarray(p0, dtype=float)
+		rows, cols = trail_window(shape, p0[0], p0[1], p0[2], p0[4], p0[5], pad=pad)
+		window = (rows.start, rows.stop, cols.start, cols.stop)
+		key    = fit_cache_key(*key_parts, window, p0, np.dtype(dtype).str, pad, fit_model_version)
+		near   = fit_cache_key('warm', *key_parts, tuple(np.round(p0[[4, 5]] / 4).astype(int)), np.dtype(dtype).str, pad, fit_model_version) if warm else None
+
+		state, entry = cache.lookup(key, near)
+		if state == 'hit': results[i] = entry
+		else:              todo.append((i, key, near, entry if state == 'warm' else p0))
+
+	fitted = fit([p0 for _, _, _, p0 in todo]) if todo else []
+	for (i, key, near, _), result in zip(todo, fitted):
+		results[i] = result
+		if not isinstance(result, Exception): cache.store(key, near, *result)
+	return results
 
-			# filtering bad stars from sextractor
-			bad_stars = np.where((star_x < ast_trail_length) | (star_x > img.shape[1] - ast_trail_length) | (star_y < ast_trail_length) | (star_y > img.shape[0]-ast_trail_length)) # too close to edge
-			bad_stars = np.append(bad_stars, 0) # want to get rid of asteroid too
-			# bad_stars = np.append(bad_stars, np.where((star_x<trail_start[0]+fwhm) & (star_x>trail_start[0]-fwhm) & (star_y<trail_end[1]) & (star_y>trail_start[1]))) # want to get rid of asteroid too
-			print('filter on sextractor', len(bad_stars))
-			star_x     = np.delete(star_x, bad_stars, 0)
-			star_y     = np.delete(star_y, bad_stars, 0)
-			
-			l = float(l_from_input)
-			a = float(a_from_input)
+"""
+cached_fits() for a joint fit, e.g. fit_stars_joint() -- all stars are one fit, so they are one cache entry
+	the key is the hash of key_parts, every star's starting window and p0, dtype, pad and fit_model_version. the
+	per star results are stored stacked (params, covs, residuals, fluxes). there are no warm entries, and a failed
+	fit (the same exception for every star) isn't stored
 
-			if len(obj_minus_sky) > l: 
-				rebin = True
-			
-			cheats_on = False
+PARAMETERS
+-----------
+cache     : FitCache
+	cache to use, None just calls fit(p0s)
+key_parts : tuple
+	what identifies the image, e.g. (pixel hash, rotation angle, 'joint')
+p0s       : list
+	initial guesses [ s , L , a , b , x_0 , y_0 ], one per star
+fit       : function
+	fit(p0s) -> list of per star result tuples, or of the exception for every star
+shape     : tuple
+	(rows, columns) of the image fit in
+pad       : float
+	(optional) padding in units of s, see trail_window() ; default = 10
+dtype     : type
+	(optional) model precision the fit runs in ; default = np.float64
 
-			try:
-				# star parametsrs
-				cheat_codes = np.loadtxt(f'{f[:-4]}_params.txt')
-				cheats_on   = True
-			except Exception as e:
-				print('Invalid cheat code: ', e, cheats_on)
-			
-			stars        = []
-			trail_starts = []
-			trail_ends   = []
-			residuals    = []
-			row_errs     = []
-			row_flux     = []
-			centroids    = []
+RETURNS
+--------
+results : list
+	what fit(p0s) would have returned
+"""
+def cached_joint_fit( cache , key_parts , p0s , fit , shape , pad=10 , dtype=np.float64 ):
+	if cache is None or len(p0s) == 0: return fit(p0s)
 
-			failed_log   = []
-			norms        = []
-			dt 			 = []
+	p0s     = np.array(p0s, dtype=float)
+	windows = [trail_window(shape, p0[0], p0[1], p0[2], p0[4], p0[5], pad=pad) for p0 in p0s]
+	windows = np.array([(rows.start, rows.stop, cols.start, cols.stop) for rows, cols in windows])
+	key     = fit_cache_key(*key_parts, windows, p0s, np.dtype(dtype).str, pad, fit_model_version)
 
-			rebin = False
+	state, entry = cache.lookup(key)
+	if state == 'hit': return list(zip(*entry))
 
-			i = 0
+	results = fit(list(p0s))
+	if not isinstance(results[0], Exception): cache.store(key, None, *(np.array(column) for column in zip(*results)))
+	return results
 
-			img_star_rotated = rotate(img, a)
+# per frame container written by save_frame_lightcurves(), and the columns of star_params.dat
+lightcurve_file    = 'lightcurves.npz'
+star_param_columns = ['id', 'ra', 'dec', 's', 'L', 'A', 'b', 'x', 'y', 'a', 'flux']
 
-			output_for_bryce = f'{f[:-4]}/'
-			if not isdir(output_for_bryce):
-				os.mkdir(output_for_bryce)
+"""
+write everything one frame produces into <directory>/lightcurves.npz -- replaces the star_params.dat, one
+lightcurve_star_<i>.dat per star and lightcurve_asteroid.dat text files (still written with text_output)
+	star parameters are stored one array per column (star_ra, star_s, ... see star_param_columns), the star
+	lightcurves end to end in star_time, star_lc_flux and star_lc_err with star k's rows between star_offset[k] and
+	star_offset[k+1]. the file is replaced atomically
 
-			while True:
+PARAMETERS
+-----------
+directory          : str
+	frame output directory, e.g. './2016_GE1_2016_04_04_UTC/1917066o13/'
+star_params        : array
+	(n, 11) fitted stars, columns as star_param_columns
+star_lcs           : list
+	n (time, flux, flux error) arrays, one per star
+asteroid_lc        : tuple
+	asteroid (time, flux, flux error) arrays
+asteroid_param     : array
+	(optional) asteroid fit [ s , L , a , b , x_0 , y_0 ] ; default = None
+asteroid_param_err : array
+	(optional) its 1 sigma errors ; default = None
 
-				if i >= len(star_x) or i == 50: break
-				# if i == 3: break
+RETURNS
+--------
+path : str
+	the file written
+"""
+def save_frame_lightcurves( directory , star_params , star_lcs , asteroid_lc , asteroid_param=None , asteroid_param_err=None ):
+	star_params = np.asarray(star_params, dtype=float).reshape(-1, len(star_param_columns))
+	lengths     = [len(lc[0]) for lc in star_lcs]
+
+	columns = {f'star_{name}': star_params[:,j] for j, name in enumerate(star_param_columns)}
+	columns['star_offset']  = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+	for j, name in enumerate(['star_time', 'star_lc_flux', 'star_lc_err']):
+		columns[name] = np.concatenate([np.asarray(lc[j], dtype=float) for lc in star_lcs]) if star_lcs else np.zeros(0)
+	for j, name in enumerate(['asteroid_time', 'asteroid_flux', 'asteroid_flux_err']):
+		columns[name] = np.asarray(asteroid_lc[j], dtype=float)
+	if asteroid_param     is not None: columns['asteroid_param']     = np.asarray(asteroid_param, dtype=float)
+	if asteroid_param_err is not None: columns['asteroid_param_err'] = np.asarray(asteroid_param_err, dtype=float)
+
+	path = join(directory, lightcurve_file)
+	tmp  = f'{path[:-4]}.{os.getpid()}.tmp.npz'
+	np.savez(tmp, **columns)
+	os.replace(tmp, path)
+	return path
 
-				
-				# img_star_rotated = img
+"""
+one frame's lightcurves.npz, read a column at a time -- only the columns asked for are read off disk
 
-				# setting global variables for trail fitting
-				img_rot  = img_star_rotated 
-				# img_rot = img
-				centroid = star_x[i], star_y[i]
-				centroid = point_rotation( centroid[0] , centroid[1] , a , img , img_star_rotated )
+	usage:  > lcs = FrameLightcurves('./2016_GE1_2016_04_04_UTC/1917066o13/')
+	        > lcs['star_flux']                  # one column of every star
+	        > t, flux, err = lcs.star(3)        # star 3's lightcurve
+	        > t, flux, err = lcs.asteroid()
+	        > lcs.star_params()                 # the star_params.dat table
+	        > lcs.export_text()                 # the .dat text files, as text_output writes them
+
+PARAMETERS
+-----------
+path : str
+	frame output directory or the .npz in it
+"""
+class FrameLightcurves:
+
+	def __init__(self, path):
+		self.path    = join(path, lightcurve_file) if isdir(path) else path
+		self.npz     = np.load(self.path)
+		self.loaded  = {}	# column -> array, read on first access
+
+	@property
+	def columns(self):
+		return list(self.npz.files)
+
+	def __getitem__(self, column):
+		if column not in self.loaded: self.loaded[column] = self.npz[column]
+		return self.loaded[column]
+
+	def __contains__(self, column):
+		return column in self.npz.files
+
+	def __len__(self):
+		return len(self['star_offset']) - 1
+
+	'''
+	(time, flux, flux error) of star k
+	'''
+	def star(self, k):
+		offset = self['star_offset']
+		rows   = slice(offset[k], offset[k+1])
+		return self['star_time'][rows], self['star_lc_flux'][rows], self['star_lc_err'][rows]
+
+	def asteroid(self):
+		return self['asteroid_time'], self['asteroid_flux'], self['asteroid_flux_err']
+
+	'''
+	(n, 11) table of the fitted stars, columns as star_param_columns
+	'''
+	def star_params(self):
+		return np.column_stack([self[f'star_{name}'] for name in star_param_columns]).reshape(-1, len(star_param_columns))
+
+	'''
+	write star_params.dat, lightcurve_star_<i>.dat and lightcurve_asteroid.dat into directory (default: next to the .npz)
+	'''
+	def export_text(self, directory=None):
+		directory = os.path.dirname(self.path) if directory is None else directory
+		np.savetxt(join(directory, 'star_params.dat'), self.star_params(), header=' '.join(star_param_columns))
+		for k in range(len(self)):
+			np.savetxt(join(directory, f'lightcurve_star_{k}.dat'), np.array(self.star(k)).T, header='jd flux flux_err')
+		np.savetxt(join(directory, 'lightcurve_asteroid.dat'), np.array(self.asteroid()).T)
+
+	def close(self):
+		self.npz.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def __str__(self):
+		return f'{self.path}: {len(self)} stars, {len(self["asteroid_time"])} asteroid points, columns {", ".join(self.columns)}'
+
+'''
+fitted stars of a frame output directory (the star_params.dat table) from lightcurves.npz, or star_params.dat where
+	there is only that -- None if neither is there
+'''
+def load_star_params( directory ):
+	if isfile(join(directory, lightcurve_file)):
+		with FrameLightcurves(directory) as lcs:
+			return lcs.star_params()
+	if isfile(join(directory, 'star_params.dat')):
+		return np.loadtxt(join(directory, 'star_params.dat'), ndmin=2)
+	return None
 
-				str_p0       = np.array([3, l, 90, np.mean(sky_row_avg), centroid[0], centroid[1]])
-				param_bounds = ([1, l/2, -180, 0, 0, 0], [10, l*5, 180, 2e3, img_star_rotated.shape[1], img_star_rotated.shape[0] ])
-				
-				try:
-					str_param, star_param_cov = curve_fit(trail_model_2d, img_star_rotated, img_star_rotated.flatten(), p0=str_p0)
-				except Exception as e:
-					print(e , f' LOL star fit failed , skipping trail number {i} for filname : {f}  ')
-					failed_log.append(str_p0)
-					continue
 
-				residual = np.sum(( trail_model_2d(0, *str_param) - img_star_rotated.flatten() ) ** 2 ) ** .5
+# input.csv and the SEoutput/ catalogs of the working directory, see load_inputs()
+loaded_inputs = {}
 
-				print('star parameters: '     , str_param)
-				print('param uncertainties:, ', np.sqrt(np.diag(star_param_cov)))
-					
-				s, L, A, b, x_0, y_0 = str_param[0], str_param[1], str_param[2], str_param[3], str_param[4], str_param[5]
+'''
+(observations, se_catalogs) -- input.csv as an ObservationCatalog and the SECatalogIndex of se_dir, read on first use
+	so importing magic_star reads nothing. run_batch() loads them before its workers are forked
+'''
+def load_inputs():
+	if not loaded_inputs:
+		loaded_inputs['observations'] = load_observations('input.csv')
+		loaded_inputs['se_catalogs']  = SECatalogIndex(se_dir)
+	return loaded_inputs['observations'], loaded_inputs['se_catalogs']
 
-				x_0_ , y_0_ = reverse_rotation(x_0 , y_0 , a , img)
-				angle_from_initial = a - (A-90)
+'''
+`from magic_star import observations` (or se_catalogs) still works, through load_inputs()
+'''
+def __getattr__( name ):
+	if name in ('observations', 'se_catalogs'): return load_inputs()[name == 'se_catalogs']
+	raise AttributeError(f"module 'magic_star' has no attribute '{name}'")
 
-				# capturing that global variable after the trail fit has converged
-				str_flux = flux
+'''
+result of process_frame() -- status is 'done', 'skipped' (no trail in input.csv), 'failed' (the pipeline gave up on the
+	frame), 'error' (an exception, message has the traceback) or, from run_batch(), 'crashed' (the worker process running
+	it died). elapsed [s] is filled in by run_batch(). warm is what
+	the next frame of the object starts from (see process_frame), None unless done
+'''
+FrameResult = namedtuple('FrameResult', ['frame', 'status', 'message', 'obj_id', 'n_stars', 'ast_param', 'ast_param_err', 'output', 'elapsed', 'warm'],
+                         defaults=(None, 0, None, None, None, 0., None))
 
-				img_star_rotated = rotate(img, angle_from_initial)
-				x_0_ , y_0_ = point_rotation(x_0_ , y_0_ , angle_from_initial , img , img_star_rotated )
-				
-				# keeping it rotated to star's reference, so don't actually need to go back to asteroid 
-				# x_0, y_0 = point_rotation( x_0 , y_0 , A , img , img_star_rotated )
+'''
 
-				star_trail_start = np.array([x_0_, y_0_ - L/2 ])
-				star_trail_end   = np.array([x_0_, y_0_ + L/2 ])
+I guess this is where the shitshow begins i guess
+	this will be less well commented for a while just because i haven't had the care to.
+	so a lot of it will be ugly and inexplicable unless u ask me.
+
+'''
 
+"""
+the whole pipeline on one frame -- asteroid trail fit and lightcurve, comparison star fits and lightcurves, sky
+corrected asteroid lightcurve. writes <frame>/lightcurves.npz (see save_frame_lightcurves, text files too with text_output)
+	with warm (the warm of the previous frame's FrameResult) the asteroid fit starts from its converged s, L, a, b, the
+	star fits from its median converged s, L, A and b (scaled with the sky), and the stars it kept are fit again,
+	mapped through this frame's WCS, instead of the SExtractor ones. see warm_start for when it falls back
 
-				fwhm = s * 2.355
-				st_height_correction = int(ast_height_correction * L/ast_trail_length ) - 1
-				# st_height_correction = - int(fwhm/2) - 1
- 
-				if not rebin:  # star lightcurve longer than asteroid
-					str_minus_sky, sigma_row_star, str_sky_avg = take_lightcurve(img_star_rotated, star_trail_start, star_trail_end, fwhm=fwhm, display=False, err=True, gain=gain, rd_noise=rd_noise, height_correction=st_height_correction, binning=len(obj_minus_sky))
-				else:     # star lightcurve shorter than asteroid -- no binning step here, we will rebin the asteroid lightcurve 
-					str_minus_sky, sigma_row_star, str_sky_avg = take_lightcurve(img_star_rotated, star_trail_start, star_trail_end, fwhm=fwhm, display=False, err=True, gain=gain, rd_noise=rd_noise, height_correction=st_height_correction)
+PARAMETERS
+-----------
+f       : str
+	path of the fits frame
+l       : float
+	star trail length [pix] of the object's frames (star_parameters.csv)
+a       : float
+	star trail angle [deg] of the object's frames (star_parameters.csv)
+workers : int
+	(optional) processes for the star fits, see fit_stars() ; default = None (all cores)
+warm    : dict
+	(optional) previous frame's FrameResult.warm ; default = None (cold start)
 
-				norm = np.median(str_minus_sky)
+RETURNS
+--------
+result : FrameResult
+"""
+def process_frame( f , l , a , workers=None , warm=None ):
+	observations, se_catalogs = load_inputs()
+	try:
+		frame = Frame(f)
+		print(f)
+	except Exception as e:
+		print(f)
+		return FrameResult(f, 'error', f'could not open frame : {e}')
+
+	with frame:
+		memory = MemoryReport(enabled=memory_report)
+		memory.reset()
+
+		hdr = frame.header
+
+		exp_time   = frame.exp_time
+		gain       = frame.gain
+		rd_noise   = frame.rd_noise
+		# obs_filter = float(hdr['FILTE'])
+
+		# object id from directory name --> string splicing
+		obj_id = f.split('_')
+		obj_id = obj_id[0][2:] + ' ' + obj_id[1]
+
+		obs = observations.lookup(f.split('/')[-1], obj_id)
+		if obs is None or not obs['has_trail']: return FrameResult(f, 'skipped', 'no trail in input.csv', obj_id)
+
+		trail_start = obs['trail_start']
+		trail_end	= obs['trail_end']
+		start_time  = float(obs['jd'])
+
+		# pixels only get mapped in for frames that have a trail in input.csv
+		# read here rather than at import, so use_float32 set at run time reaches the image and every fit alike
+		compute_dtype = np.float32 if use_float32 else np.float64
+		img = frame.data
+		if use_float32: img = img.astype(np.float32)
+		memory.mark('load')
+
+		fits_cache = open_fit_cache()
+		pixel_hash = fit_cache_key(img) if fits_cache is not None else None
+
+		rotations = RotationCache(img, tol=rotation_tol, maxsize=rotation_cache_size)
+
+		# NEGATIVE ANGLE OF ASTEROID TRAIL WRT HOME FRAME			
+		angle       = -1*np.arctan2(trail_end[0]-trail_start[0], trail_end[1]-trail_start[1]) * 180/np.pi
+		# IMG ROTATED TO ASTEROID TRAIL IS VERTICAL
+		angle, img_rotated = rotations.rotate(angle)
+		memory.mark('asteroid rotation')
+
+		ast_trail_start  = np.array(point_rotation(trail_start[0], trail_start[1], angle, img, img_rotated), dtype=int)
+		ast_trail_end	 = np.array(point_rotation(trail_end  [0], trail_end  [1], angle, img, img_rotated), dtype=int)
+		ast_trail_length = ast_trail_end[1] - ast_trail_start[1]
+
+		# DOING TRAIL SPREAD TO GET FIRST APPROX FOR FWHM
+		spread_fit, trail_width = trail_spread_fast(img_rotated, ast_trail_start, ast_trail_end)
+		if not spread_fit.success:
+			print(f'trail spread fit failed for {f} : {spread_fit.message}')
+			return FrameResult(f, 'failed', f'trail spread fit failed : {spread_fit.message}', obj_id)
+		trail_spread = spread_fit.params
+		memory.mark('trail spread')
+		fwhm = int(trail_spread[0] * 2.355 + .5)
+		# correcting trail start/end
+		centroid_deviation  = trail_spread[1] - trail_width # if negative, trail is to the left, if positive, trail to right
+		ast_trail_start[0] += int(centroid_deviation+.5)
+		ast_trail_end  [0] += int(centroid_deviation+.5)
+
+		trail_centroid = np.array([ast_trail_start[0], np.mean([ast_trail_start[1], ast_trail_end[1]])])
+
+		# ASTEROID TRAIL FITTING
+		ast_fitter  = TrailFitter(img_rotated, dtype=compute_dtype)
+		# box_x_width = 30
+		# box_y_width = ast_trail_length * 2
+
+		p0           = np.array([trail_spread[0], ast_trail_length, 90, 200, trail_centroid[0], trail_centroid[1]])
+
+		# TRAIL FITTING ATTEMPT WITH scipy.optimize.least_squares()
+		# fit          = least_squares(residual, p0, loss='linear', ftol=0.05, xtol=0.05, gtol=0.05, bounds=param_bounds)
+
+		# img_slice = img_rotated[int(centroid[1] - box_y_width/2 + .5):int(centroid[1] + box_y_width/2 + .5) , int(centroid[0] - box_x_width/2 + .5):int(centroid[0] + box_x_width/2 + .5)]
+
+		# TRAIL FITTING WITH scipy.optimize.curve_fit()
+		# ast_param , ast_param_cov = curve_fit(trail_model_2d, img_rotated, img_slice.flatten(), p0=p0)	
+		#  display_streak(img_rot, 10, 300, 90, b, x_0, y_0, width=2)
+
+
+		# img_view = trail_view( img_rot, *p0 )
+
+		# img_view = 
+
+
+
+		def fit_asteroid(p0):
+			return cached_fits(fits_cache, (pixel_hash, angle, 'asteroid'), [p0], lambda p0s: [ast_fitter.fit(p) for p in p0s], img_rotated.shape, dtype=compute_dtype)[0]
+
+		# previous frame's s, L, a, b when its trail is about as long as this one
+		cold_p0 = p0
+		if warm is not None and abs(warm['ast'][1] - ast_trail_length) <= warm_start_tol * ast_trail_length:
+			p0 = np.concatenate((warm['ast'], cold_p0[4:]))
+		try:
+			ast_param , ast_param_cov = fit_asteroid(p0)
+		except Exception as e:
+			if p0 is cold_p0: raise
+			print('warm started asteroid fit failed, starting over: ', e)
+			p0 = cold_p0
+			ast_param , ast_param_cov = fit_asteroid(p0)
 
-				centroids   .append(reverse_rotation ( x_0_ , y_0_ , angle_from_initial , img ) )
-				norms       .append(norm)
-				row_flux    .append(str_minus_sky /norm)
-				row_errs    .append(sigma_row_star/norm)
-				trail_starts.append(star_trail_start)
-				trail_ends  .append(star_trail_end  )
-				residuals   .append(residual)
-				stars       .append(np.hstack((str_param, a, flux)))
+		ast_flux = ast_fitter.trail_flux(ast_param[0], ast_param[1], ast_param[4], ast_param[5])
+		memory.mark('asteroid fit')
+		
+		print('asteroid p0[  s , L , a , b , x_0 , y_0 ]: '            , p0)
+		print('asteroid fit parameters [ s , L , a , b , x_0 , y_0 ]: ', ast_param)
+		print('parameter uncertainties: '                              , np.sqrt(np.diag(ast_param_cov)))
+
+		ast_fwhm			  = ast_param[0] * 2.355
+		ast_trail_length	  = ast_param[1]
+		# ast_height_correction = ast_trail_length * 0
+		ast_height_correction = - int( ast_fwhm ) - 5
+		# ast_height_correction = - ast_fwhm
+		
+		trail_centroid 		  = np.array([ast_param[4], ast_param[5]])
 
-				dt          .append(60 * st_height_correction / L)
+		ast_trail_start = np.array([trail_centroid[0] , trail_centroid[1] - ast_trail_length/2 ])
+		ast_trail_end   = np.array([trail_centroid[0] , trail_centroid[1] + ast_trail_length/2 ])
 
-				# start_time + dt/(60*60*24) , start_time + exp_time/(60*60*24) - dt/(60*60*24) 
+		obj_minus_sky, sigma_row, sky_row_avg = take_lightcurve(img_rotated, ast_trail_start, ast_trail_end, fwhm=ast_fwhm, b=None, height_correction=ast_height_correction, display=False, err=True, gain=gain, rd_noise=rd_noise)
+		
+		print( 'asteroid trail length: ', len(obj_minus_sky) )
+		memory.mark('asteroid lightcurve')
+
+		l = float(l)
+		a = float(a)
+
+		# 50 nearest usable stars to the asteroid -- star positions are in the unrotated frame, so is the centre.
+		# not too close to the edge, clear of the asteroid trail (by half a star trail + 2 FWHM), isolated, unsaturated
+		ast_centre = reverse_rotation_batch([trail_centroid], angle, img)[0]
+		def usable(star_xy):
+			peaks = None
+			if saturation_level is not None:
+				peak_rows = np.clip(np.round(star_xy[:,1]).astype(int), 0, img.shape[0]-1)
+				peak_cols = np.clip(np.round(star_xy[:,0]).astype(int), 0, img.shape[1]-1)
+				peaks     = img[peak_rows, peak_cols]
+			return select_stars(star_xy, ast_centre, k=50, shape=img.shape, edge=ast_trail_length, trail=(trail_start, trail_end),
+			                    trail_width=l/2 + 2*ast_fwhm, isolation=star_isolation*ast_fwhm, peaks=peaks, saturation=saturation_level)
+
+		# the stars the previous frame kept, if enough of them are usable here
+		star_xy = None
+		if warm is not None and len(warm['stars']) > 0:
+			carried = np.array(warm['stars'])
+			try:
+				star_xy = np.column_stack(WCS(hdr).all_world2pix(carried[:,0], carried[:,1], 0))
+				star_xy = star_xy[usable(star_xy)]
+				print('usable stars carried over from the previous frame', len(star_xy))
+			except Exception as e:
+				print('could not carry stars over: ', e)
+				star_xy = None
+			if star_xy is not None and len(star_xy) < warm_start_min_stars: star_xy = None
 
-				# to_write = np.array ( [ np.linspace( start_time + dt/(60*60*24) , start_time + exp_time/(60*60*24) - dt/(60*60*24) , len(str_minus_sky) ) , str_minus_sky , sigma_row_star] ).T
+		if star_xy is None:
+			# source extractor !!
+			# sex = subprocess.run(['sex', f, '-DETECT_MINAREA', str(trail_length*fwhm), '-CATALOG_NAME', '_'.join(f.split("/")[1:])[:-4] + '.cat'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+			if native_detection:
+				sex_output = detect_sources(img, minarea=int(ast_trail_length * ast_fwhm))
+				memory.mark('detection')
+			else:
+				sex_output = se_catalogs.lookup(f)
+			if sex_output is None:
+				print(f'no SExtractor catalog for {f}')
+				return FrameResult(f, 'failed', 'no SExtractor catalog', obj_id)
 
-				# np.savetxt ( f'{output_for_bryce}lightcurve_star_{str(i)}.dat' , to_write )
+			print('SExtractor found stars: ', sex_output.shape[0])
+			star_xy = np.column_stack((sex_output['X_IMAGE'], sex_output['Y_IMAGE'])) - 1	# SExtractor pixels are 1-based, ours 0-based
+			star_xy = star_xy[usable(star_xy)]
+			print('usable stars from sextractor', len(star_xy))
 
-				print(' ')
-				i+=1
-				
-			row_flux = np.array(row_flux)
-			row_errs = np.array(row_errs)
+		star_x     = star_xy[:,0]
+		star_y     = star_xy[:,1]
 
-			stars 		 = np.array(stars)
-			residuals    = np.array(residuals)
-			trail_starts = np.array(trail_starts)
-			trail_ends   = np.array(trail_ends)
-			norms 		 = np.array(norms)
-			dt 			 = np.array(dt)
-			centroids    = np.array(centroids)
+		if len(obj_minus_sky) > l: 
+			rebin = True
+		
+		
+		stars        = []
+		trail_starts = []
+		trail_ends   = []
+		residuals    = []
+		row_errs     = []
+		row_flux     = []
+		centroids    = []
+
+		failed_log   = []
+		norms        = []
+		dt 			 = []
+
+		rebin = False
+
+		i = 0
+
+		a, img_star_rotated = rotations.rotate(a)
+		memory.mark('star rotation')
+
+		output_for_bryce = f'{f[:-4]}/'
+		if not isdir(output_for_bryce):
+			os.mkdir(output_for_bryce)
+
+		# STAR TRAIL FITTING -- every star is fit in the same frame rotated by a, farmed out to a process pool
+		str_centroids = point_rotation_batch(np.column_stack((star_x, star_y))[:50], a, img)
+		sky           = np.mean(sky_row_avg)
+		cold_p0s      = [np.array([3, l, 90, sky, centroid[0], centroid[1]]) for centroid in str_centroids]
+		str_p0s       = cold_p0s
+
+		# previous frame's median s, L, A and its background scaled to this frame's sky
+		warm_stars = warm is not None and abs(warm['star'][1] - l) <= warm_start_tol * l
+		if warm_stars:
+			s_w, L_w, A_w, b_w = warm['star']
+			if warm['sky'] > 0: b_w *= sky / warm['sky']
+			str_p0s = [np.array([s_w, L_w, A_w, b_w, centroid[0], centroid[1]]) for centroid in str_centroids]
+
+		def fit_all(p0s):
+			if joint_star_fit:
+				return cached_joint_fit(fits_cache, (pixel_hash, a, 'joint'), p0s, lambda p0s: fit_stars_joint(img_star_rotated, p0s, dtype=compute_dtype),
+				                        img_star_rotated.shape, dtype=compute_dtype)
+			return cached_fits(fits_cache, (pixel_hash, a, 'stars'), p0s, lambda p0s: fit_stars(img_star_rotated, p0s, workers=workers, dtype=compute_dtype),
+			                   img_star_rotated.shape, dtype=compute_dtype)
+
+		star_fits = fit_all(str_p0s)
+
+		# warm started fits that failed get another go from the usual starting point
+		retry = [i for i in range(len(star_fits)) if isinstance(star_fits[i], Exception)] if warm_stars else []
+		if retry:
+			print(f'{len(retry)} warm started star fits failed, starting over')
+			for i, result in zip(retry, fit_all([cold_p0s[i] for i in retry])):
+				star_fits[i] = result
+				str_p0s  [i] = cold_p0s[i]
+		memory.mark('star fits')
+
+		str_good, str_angles, str_rot_centroids, str_starts, str_ends, str_fwhms, str_height_corrections = [], [], [], [], [], [], []
+		for i in range(len(star_fits)):
+
+			if isinstance(star_fits[i], Exception):
+				print(star_fits[i] , f' LOL star fit failed , skipping trail number {i} for filname : {f}  ')
+				failed_log.append(str_p0s[i])
+				continue
 
-			print('initially, ', stars.shape[0])
+			str_param, star_param_cov, residual, str_flux = star_fits[i]
 
-			s_std        = np.std(stars[:,0])
-			length_std   = np.std(stars[:,1])
-			angle_std    = np.std(stars[:,2])
+			print('star parameters: '     , str_param)
+			print('param uncertainties:, ', np.sqrt(np.diag(star_param_cov)))
+				
+			s, L, A, b, x_0, y_0 = str_param[0], str_param[1], str_param[2], str_param[3], str_param[4], str_param[5]
 
-			s_mean  	 = np.mean(stars[:,0])
-			length_mean  = np.mean(stars[:,1])
-			angle_mean   = np.mean(stars[:,2])
+			x_0_ , y_0_ = reverse_rotation(x_0 , y_0 , a , img)
+			# star's own frame is never built -- take_lightcurves samples it straight off img
+			angle_from_initial = a - (A-90)
+			x_0_ , y_0_ = point_rotation(x_0_ , y_0_ , angle_from_initial , img , None )
+			
+			# keeping it rotated to star's reference, so don't actually need to go back to asteroid 
+			# x_0, y_0 = point_rotation( x_0 , y_0 , A , img , img_star_rotated )
+
+			str_good              .append(i)
+			str_angles            .append(angle_from_initial)
+			str_rot_centroids     .append([x_0_, y_0_])
+			str_starts            .append([x_0_, y_0_ - L/2 ])
+			str_ends              .append([x_0_, y_0_ + L/2 ])
+			str_fwhms             .append(s * 2.355)
+			str_height_corrections.append(int(ast_height_correction * L/ast_trail_length ) - 1)
+			# st_height_correction = - int(fwhm/2) - 1
+			print(' ')
+
+		if len(str_good) == 0:
+			return FrameResult(f, 'failed', 'no star fit succeeded', obj_id)
+
+		# STAR LIGHTCURVES -- every fitted star on the frame in one go
+		if not rebin:  # star lightcurve longer than asteroid
+			str_lcs = take_lightcurves(img, str_starts, str_ends, str_fwhms, height_corrections=str_height_corrections, angles=str_angles, gain=gain, rd_noise=rd_noise, binning=len(obj_minus_sky))
+		else:     # star lightcurve shorter than asteroid -- no binning step here, we will rebin the asteroid lightcurve 
+			str_lcs = take_lightcurves(img, str_starts, str_ends, str_fwhms, height_corrections=str_height_corrections, angles=str_angles, gain=gain, rd_noise=rd_noise)
+
+		for k in range(len(str_good)):
+			i = str_good[k]
+			str_param, star_param_cov, residual, str_flux = star_fits[i]
+			L = str_param[1]
+
+			x_0_ , y_0_          = str_rot_centroids[k]
+			angle_from_initial   = str_angles[k]
+			star_trail_start     = np.array(str_starts[k])
+			star_trail_end       = np.array(str_ends  [k])
+			st_height_correction = str_height_corrections[k]
+
+			# unbinned lightcurves of different lengths come back nan padded
+			keep           = ~np.isnan(str_lcs[0][k])
+			str_minus_sky  = str_lcs[0][k][keep]
+			sigma_row_star = str_lcs[1][k][keep]
+
+			norm = np.median(str_minus_sky)
+
+			centroids   .append(reverse_rotation ( x_0_ , y_0_ , angle_from_initial , img ) )
+			norms       .append(norm)
+			row_flux    .append(str_minus_sky /norm)
+			row_errs    .append(sigma_row_star/norm)
+			trail_starts.append(star_trail_start)
+			trail_ends  .append(star_trail_end  )
+			residuals   .append(residual)
+			stars       .append(np.hstack((str_param, a, str_flux)))
+
+			dt          .append(60 * st_height_correction / L)
+
+			# start_time + dt/(60*60*24) , start_time + exp_time/(60*60*24) - dt/(60*60*24) 
+
+			# to_write = np.array ( [ np.linspace( start_time + dt/(60*60*24) , start_time + exp_time/(60*60*24) - dt/(60*60*24) , len(str_minus_sky) ) , str_minus_sky , sigma_row_star] ).T
+
+			# np.savetxt ( f'{output_for_bryce}lightcurve_star_{str(i)}.dat' , to_write )
+			
+		memory.mark('star lightcurves')
+
+		print(rotations)
+		if fits_cache is not None: print(fits_cache)
+		if memory_report: print(memory)
+
+		row_flux = np.array(row_flux)
+		row_errs = np.array(row_errs)
+
+		stars 		 = np.array(stars)
+		residuals    = np.array(residuals)
+		trail_starts = np.array(trail_starts)
+		trail_ends   = np.array(trail_ends)
+		norms 		 = np.array(norms)
+		dt 			 = np.array(dt)
+		centroids    = np.array(centroids)
+
+		print('initially, ', stars.shape[0])
+
+		s_std        = np.std(stars[:,0])
+		length_std   = np.std(stars[:,1])
+		angle_std    = np.std(stars[:,2])
+
+		s_mean  	 = np.mean(stars[:,0])
+		length_mean  = np.mean(stars[:,1])
+		angle_mean   = np.mean(stars[:,2])
+
+		# throwing away outliers, ig. 
+		# TODO: fit more stars and increase threshold? 
+		threshold = 2 # sigmas
+
+		star_filter  = np.where( (stars[:,0]<=s_mean+threshold*s_std) & (stars[:,0]>=s_mean-threshold*s_std) & (stars[:,1]<=length_mean+threshold*length_std) & (stars[:,1]>=length_mean-threshold*length_std) & (stars[:,2]<=angle_mean+threshold*angle_std) & (stars[:,2]>=angle_mean-threshold*angle_std) )
+		# s, L, A are shared in the joint fit, nothing to clip on
+		if joint_star_fit: star_filter = np.arange(len(stars))
+		stars        = stars       [star_filter]
+		trail_starts = trail_starts[star_filter]
+		trail_ends   = trail_ends  [star_filter]
+		residuals    = residuals   [star_filter]
+		# total_flux   = total_flux  [star_filter]
+		norms        = norms 	   [star_filter]
+		centroids    = centroids   [star_filter]
+
+		row_flux = row_flux[star_filter]
+		row_errs = row_errs[star_filter]
+		dt 		 = dt 	   [star_filter]
+
+		print('filtering: ', stars.shape[0])
+
+		star_lcs = []
+		for ii in range( len(row_flux) ):
+			n       = norms[ii]
+			lc_flux = row_flux[ii] * n
+			lc_errs = row_errs[ii] * n
+
+			dT = dt[ii]
+			T  = np.linspace( start_time + dT/(60*60*24) , start_time + exp_time/(60*60*24) - dT/(60*60*24) , len(lc_flux))
+			star_lcs.append((T , lc_flux , lc_errs))
+
+		# sorting by residuals from biiiig fit
+		# res_filter   = np.argsort(residuals)
+		# residuals    = residuals   [res_filter]
+		# stars        = stars       [res_filter]
+		# trail_starts = trail_starts[res_filter]
+		# trail_ends   = trail_ends  [res_filter]
+		# total_flux   = total_flux  [res_filter]
+
+		w = WCS ( hdr )
+
+		ra_dec = utils.pixel_to_skycoord ( centroids[:,0] , centroids[:,1] , w )
+		star_params = np.hstack([ np.array([np.arange(len(centroids)) , ra_dec.ra.deg , ra_dec.dec.deg]).T , stars ])
+		print(star_params.shape)
+
+		# row_flux = row_flux[res_filter][:10]
+		row_flux = row_flux[:10]
+
+		print('row_sums_smooth shape: ', row_flux.shape)
+
+		row_avgs = np.nanmean(row_flux, axis=0)
+
+		avgs_err = np.sum(row_errs ** 2, axis=0) ** .5 * .1
+	
+		# norm = np.nanmean(row_avgs)
+		# row_avgs/=norm
 
-			# throwing away outliers, ig. 
-			# TODO: fit more stars and increase threshold? 
-			threshold = 2 # sigmas
+		#sky_corrected_lightcurve = obj_minus_sky[ast_start:ast_end] / row_avgs_smooth # this is the actual sky correction 
 
-			star_filter  = np.where( (stars[:,0]<=s_mean+threshold*s_std) & (stars[:,0]>=s_mean-threshold*s_std) & (stars[:,1]<=length_mean+threshold*length_std) & (stars[:,1]>=length_mean-threshold*length_std) & (stars[:,2]<=angle_mean+threshold*angle_std) & (stars[:,2]>=angle_mean-threshold*angle_std) )
-			stars        = stars       [star_filter]
-			trail_starts = trail_starts[star_filter]
-			trail_ends   = trail_ends  [star_filter]
-			residuals    = residuals   [star_filter]
-			# total_flux   = total_flux  [star_filter]
-			norms        = norms 	   [star_filter]
-			centroids    = centroids   [star_filter]
+		if rebin:
+			obj_minus_sky, sigma_row, sky_row_avg = take_lightcurve(img_rotated, ast_trail_start, ast_trail_end, fwhm=ast_fwhm, b=None, height_correction=ast_height_correction, display=False, err=True, gain=gain, rd_noise=rd_noise) 
 
-			row_flux = row_flux[star_filter]
-			row_errs = row_errs[star_filter]
-			dt 		 = dt 	   [star_filter]
 
-			print('filtering: ', stars.shape[0])
+		sky_corrected_lightcurve = obj_minus_sky / row_avgs
 
-			for ii in range( len(row_flux) ):
-				n       = norms[ii]
-				lc_flux = row_flux[ii] * n
-				lc_errs = row_errs[ii] * n
+		sky_corrected_errs = (sigma_row / row_avgs) ** 2 + (avgs_err * obj_minus_sky / row_avgs**2) ** 2
+		sky_corrected_errs = sky_corrected_errs ** .5
 
-				dT = dt[ii]
-				T  = np.linspace( start_time + dT/(60*60*24) , start_time + exp_time/(60*60*24) - dT/(60*60*24) , len(lc_flux))
-				to_write = np.array ( [T , lc_flux , lc_errs ] ).T
+		dt = 60 * ast_height_correction / ast_trail_length
 
-				np.savetxt ( f'{output_for_bryce}lightcurve_star_{str(i)}.dat' , to_write , header='jd flux flux_err' )
+		x = np.linspace(start_time + dt/(60*60*24) , start_time + exp_time/(60*60*24) - dt/(60*60*24) , len(sky_corrected_lightcurve))
 
-			# sorting by residuals from biiiig fit
-			# res_filter   = np.argsort(residuals)
-			# residuals    = residuals   [res_filter]
-			# stars        = stars       [res_filter]
-			# trail_starts = trail_starts[res_filter]
-			# trail_ends   = trail_ends  [res_filter]
-			# total_flux   = total_flux  [res_filter]
+		# if write_output == 'True':
+			# np.savetxt(f'{f[:-4]}_params.txt'    , stars )
+			# np.savetxt(f'{f[:-4]}_lightcurve.txt', np.array([ x , sky_corrected_lightcurve , sky_corrected_errs ]).T )
+		save_frame_lightcurves(output_for_bryce, star_params, star_lcs, (x , sky_corrected_lightcurve , sky_corrected_errs),
+		                       asteroid_param=ast_param, asteroid_param_err=np.sqrt(np.diag(ast_param_cov)))
+		if text_output:
+			with FrameLightcurves(output_for_bryce) as lcs:
+				lcs.export_text()
 
-			w = WCS ( hdr )
 
-			ra_dec = utils.pixel_to_skycoord ( centroids[:,0] , centroids[:,1] , w )
-			to_write = np.hstack([ np.array([np.arange(len(centroids)) , ra_dec.ra.deg , ra_dec.dec.deg]).T , stars ])
-			print(to_write.shape)
-			header = 'id ra dec s L A b x y a flux'
-			np.savetxt(f'{output_for_bryce}star_params.dat' , to_write , header=header)
+		print()
 
-			# row_flux = row_flux[res_filter][:10]
-			row_flux = row_flux[:10]
+		# what the next frame of this object starts from
+		next_warm = {'ast': [float(p) for p in ast_param[:4]], 'star': np.median(stars[:,:4], axis=0).tolist(), 'sky': float(sky),
+		             'stars': np.column_stack((ra_dec.ra.deg, ra_dec.dec.deg)).tolist()}
 
-			print('row_sums_smooth shape: ', row_flux.shape)
+		return FrameResult(f, 'done', '', obj_id, len(stars), ast_param, np.sqrt(np.diag(ast_param_cov)), output_for_bryce, warm=next_warm)
 
-			row_avgs = np.nanmean(row_flux, axis=0)
+'''
+fits frames in every object directory whose name contains obj -- the same match magic_star.py <obj> does
+'''
+def object_frames( obj ):
+	dir_names = [directory+f+'/' for f in os.listdir(directory) if isdir(join(directory,f))]
+	frames    = []
+	for d in dir_names:
+		if obj not in d: continue
+		frames += sorted(d+f for f in os.listdir(d) if isfile(join(d,f)) and is_fits_frame(d+f))
+	return frames
 
-			avgs_err = np.sum(row_errs ** 2, axis=0) ** .5 * .1
-		
-			# norm = np.nanmean(row_avgs)
-			# row_avgs/=norm
+'''
+one run_batch() task -- process_frame() with exceptions turned into 'error' results, timed, stdout dropped if quiet
+'''
+def run_batch_task( task ):
+	f, l, a, workers, quiet, warm = task
+	start = time.perf_counter()
+	with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null if quiet else sys.stdout):
+		try:
+			result = process_frame(f, l, a, workers=workers, warm=warm)
+		except Exception as e:
+			result = FrameResult(f, 'error', traceback.format_exc())
+	return result._replace(elapsed=time.perf_counter() - start)
+
+'''
+name -> value of every setting in setting_names, as this process has them
+'''
+def pipeline_settings():
+	return {name: globals()[name] for name in setting_names}
 
-			#sky_corrected_lightcurve = obj_minus_sky[ast_start:ast_end] / row_avgs_smooth # this is the actual sky correction 
+'''
+take over settings from pipeline_settings() -- run_batch()'s pool initializer
+'''
+def apply_settings( settings ):
+	globals().update({name: value for name, value in settings.items() if name in setting_names})
+
+"""
+frame level job manifest, kept as json -- status, inputs, attempts and timing of every frame run_batch() has seen
+	a frame's inputs are the hashes of its fits file and SExtractor catalog, its input.csv row, the star trail l, a it
+	was run with, the pipeline settings and, with warm starts, the frame and warm it started from. a frame that finished ('done' or 'skipped', and 'failed' or 'error' too --
+	those don't go away by running again) with the same inputs is not run again; 'crashed' and 'running' frames (the
+	worker or the whole run died), 'failed' and 'error' ones with retry_failed, and anything whose inputs changed, are.
+	file hashes are only recomputed when a
+	file's size or mtime changes. the manifest is rewritten (atomically) after every frame, so an interrupted run
+	picks up where it stopped
+
+	usage:  > manifest = FrameManifest('batch_manifest.json')
+	        > results  = run_batch(objects, manifest=manifest, retries=2)
+	        > print(manifest)                     # frames per status
 
-			if rebin:
-				obj_minus_sky, sigma_row, sky_row_avg = take_lightcurve(img_rotated, ast_trail_start, ast_trail_end, fwhm=ast_fwhm, b=None, height_correction=ast_height_correction, display=False, err=True, gain=gain, rd_noise=rd_noise) 
+PARAMETERS
+-----------
+path : str
+	(optional) manifest file, created if missing ; default = 'batch_manifest.json'
+"""
+class FrameManifest:
+
+	def __init__(self, path='batch_manifest.json'):
+		self.path   = path
+		self.frames = {}	# frame path -> entry
+		self.hashes = {}	# file path -> [size, mtime_ns, sha1]
+		if isfile(path):
+			with open(path) as fh:
+				stored = json.load(fh)
+			self.frames = stored.get('frames', {})
+			self.hashes = stored.get('hashes', {})
+
+	'''
+	sha1 of a file, reused while its size and mtime stay the same. None for missing files
+	'''
+	def file_hash(self, path):
+		if path is None or not isfile(path): return None
+		stat = os.stat(path)
+		known = self.hashes.get(path)
+		if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns: return known[2]
+
+		sha1 = hashlib.sha1()
+		with open(path, 'rb') as fh:
+			for block in iter(lambda: fh.read(1 << 22), b''):
+				sha1.update(block)
+		self.hashes[path] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+		return self.hashes[path][2]
+
+	'''
+	everything the result of process_frame(f, l, a) depends on -- seed is the [frame, warm] it starts from (warm_seed())
+	'''
+	def inputs(self, f, l, a, seed=None):
+		observations, se_catalogs = load_inputs()
+		obs = observations.lookup(f.split('/')[-1])
+		return {
+			'frame'       : self.file_hash(f),
+			'catalog'     : None if native_detection else self.file_hash(se_catalogs.path(f)),
+			'observation' : None if obs is None else hashlib.sha1(obs.tobytes()).hexdigest(),
+			'l'           : float(l),
+			'a'           : float(a),
+			'settings'    : [use_float32, joint_star_fit, native_detection, star_isolation, saturation_level, warm_start, text_output,
+			                 fit_cache_dir, warm_start_tol, warm_start_min_stars],
+			'seed'        : seed,
+		}
+
+	'''
+	True if f finished with exactly these inputs -- successfully, or also as 'failed' / 'error' unless retry_failed
+	'''
+	def complete(self, f, inputs, retry_failed=False):
+		entry = self.frames.get(f)
+		final = ('done', 'skipped') if retry_failed else ('done', 'skipped', 'failed', 'error')
+		return entry is not None and entry['status'] in final and entry['inputs'] == inputs
+
+	def start(self, f, inputs):
+		entry = self.frames.get(f)
+		attempts = entry['attempts'] if entry is not None and entry['inputs'] == inputs else 0
+		self.frames[f] = {'status': 'running', 'message': '', 'inputs': inputs, 'attempts': attempts + 1,
+		                  'started': time.time(), 'finished': None, 'elapsed': None, 'result': None}
+
+	'''
+	record how f ended -- inputs, if given, replace the ones start() had (the warm seed is only known once f is submitted)
+	'''
+	def finish(self, result, inputs=None):
+		entry = self.frames[result.frame]
+		if inputs is not None: entry['inputs'] = inputs
+		entry['status']   = result.status
+		entry['message']  = result.message
+		entry['finished'] = time.time()
+		entry['elapsed']  = result.elapsed
+		entry['result']   = {'obj_id': result.obj_id, 'n_stars': int(result.n_stars), 'output': result.output,
+		                     'ast_param'    : None if result.ast_param     is None else [float(p) for p in result.ast_param],
+		                     'ast_param_err': None if result.ast_param_err is None else [float(p) for p in result.ast_param_err],
+		                     'warm'         : result.warm}
+
+	'''
+	the FrameResult recorded for f, with the fit parameters as arrays again
+	'''
+	def result(self, f):
+		entry = self.frames[f]
+		r = entry['result'] or {}
+		ast_param, ast_param_err = r.get('ast_param'), r.get('ast_param_err')
+		return FrameResult(f, entry['status'], entry['message'], r.get('obj_id'), r.get('n_stars', 0),
+		                   None if ast_param is None else np.array(ast_param), None if ast_param_err is None else np.array(ast_param_err),
+		                   r.get('output'), 0., r.get('warm'))
+
+	def save(self):
+		tmp = self.path + '.tmp'
+		with open(tmp, 'w') as fh:
+			json.dump({'frames': self.frames, 'hashes': self.hashes}, fh, indent=1)
+		os.replace(tmp, self.path)
+
+	def __len__(self):
+		return len(self.frames)
+
+	def __str__(self):
+		counts = {}
+		for entry in self.frames.values():
+			counts[entry['status']] = counts.get(entry['status'], 0) + 1
+		return f'frame manifest {self.path}: ' + ', '.join(f'{n} {status}' for status, n in sorted(counts.items()))
 
+'''
+[frame, warm] that frame f starts from with warm starts -- the latest earlier frame in order (all frames of f's object,
+	in order) that has a warm in warms (frame -> warm). None without warm_start or such a frame
+'''
+def warm_seed( order , f , warms ):
+	if not warm_start: return None
+	earlier = order[:order.index(f)]
+	return next(([g, warms[g]] for g in reversed(earlier) if g in warms), None)
 
-			sky_corrected_lightcurve = obj_minus_sky / row_avgs
+'''
+one run_batch() round over pending (obj, f, l, a) tasks, yielding results as they finish. with warm starts an object's
+	frames run one after another in frame order (objects still side by side), each starting from the warm of the
+	latest earlier frame of the object that was fitted -- in this round, an earlier one or the manifest. warms
+	(frame -> warm) is updated as frames finish, frames is obj -> all its frames in order, seeds (frame -> warm_seed())
+	gets what each frame started from
+'''
+def run_batch_round( pending , warms , frames , pool , star_workers , quiet , seeds ):
+	def seed(obj, f):
+		seeds[f] = warm_seed(frames[obj], f, warms)
+		return None if seeds[f] is None else seeds[f][1]
+
+	if pool is None:
+		for obj, f, l, a in pending:
+			result = run_batch_task((f, l, a, star_workers, quiet, seed(obj, f)))
+			if result.warm is not None: warms[f] = result.warm
+			yield result
+		return
+
+	queued  = OrderedDict()	# obj -> tasks not submitted yet
+	running = {}			# future -> (obj, f)
+	lost    = []			# 'crashed' results of tasks a broken pool wouldn't take
+
+	def submit(obj):
+		batch = queued[obj]
+		if warm_start:
+			if obj in [o for o, _ in running.values()]: return
+			batch = batch[:1]
+		queued[obj] = queued[obj][len(batch):]
+		for _, f, l, a in batch:
+			try:
+				running[pool.submit(run_batch_task, (f, l, a, star_workers, quiet, seed(obj, f)))] = (obj, f)
+			except BrokenProcessPool:
+				lost.append(FrameResult(f, 'crashed', traceback.format_exc()))
+
+	for task in pending: queued.setdefault(task[0], []).append(task)
+	for obj in queued: submit(obj)
+	while running or lost:
+		while lost: yield lost.pop(0)
+		if not running: break
+		done, _ = wait(running, return_when=FIRST_COMPLETED)
+		for future in done:
+			obj, f = running.pop(future)
+			try:
+				result = future.result()
+			except BrokenProcessPool:
+				result = FrameResult(f, 'crashed', traceback.format_exc())
+			if result.warm is not None: warms[f] = result.warm
+			if queued[obj]: submit(obj)
+			yield result
 
-			sky_corrected_errs = (sigma_row / row_avgs) ** 2 + (avgs_err * obj_minus_sky / row_avgs**2) ** 2
-			sky_corrected_errs = sky_corrected_errs ** .5
+"""
+runs process_frame() on every frame of many objects in this process and a pool of workers -- replaces starting
+python3 magic_star.py once per object
+	input.csv, the SExtractor catalog index and the imports are loaded once and shared with the workers, every frame
+	is its own task so objects with many frames don't hold up the rest. with a FrameManifest, frames already done
+	with unchanged inputs are not run again. frames whose worker died ('crashed') are retried up to retries times in
+	a fresh pool, waiting backoff, 2*backoff, 4*backoff, ... seconds before each round. 'failed' and 'error' frames
+	fail the same way every time, so they are only retried (and rerun from the manifest) with retry_failed. with
+	warm_start an object's frames run in order, each starting from the latest earlier frame that was fitted, and
+	once one frame of an object runs again the object's later frames (whose start it may change) run again too
+
+	usage:  > results = run_batch([('GE1', 240, 51.4), ('TG24', 366, -77.6)], workers=8)
+	        > failed  = [r for r in results if r.status == 'error']
 
-			dt = 60 * ast_height_correction / ast_trail_length
+PARAMETERS
+-----------
+objects      : list
+	(obj, l, a) per object -- directory name match, star trail length [pix] and angle [deg] (star_parameters.csv)
+workers      : int
+	(optional) frames processed at once ; default = None (all cores)
+star_workers : int
+	(optional) processes for the star fits within a frame, see fit_stars() ; default = 1
+quiet        : bool
+	(optional) drop the pipeline's printing ; default = True
+callback     : function
+	(optional) called with each FrameResult as it finishes ; default = None
+manifest     : FrameManifest
+	(optional) job manifest to skip finished frames and record this run in ; default = None
+retries      : int
+	(optional) extra attempts for 'crashed' frames ; default = 0
+backoff      : float
+	(optional) wait before the first retry round [s], doubling every round ; default = 5
+retry_failed : bool
+	(optional) also retry 'failed' and 'error' frames, and rerun the ones the manifest has ; default = False
 
-			x = np.linspace(start_time + dt/(60*60*24) , start_time + exp_time/(60*60*24) - dt/(60*60*24) , len(sky_corrected_lightcurve))
+RETURNS
+--------
+results : list
+	FrameResult per frame, in the order of objects and frames. frames the manifest had as finished come back as
+	recorded, done and skipped ones with message 'up to date'
+"""
+def run_batch( objects , workers=None , star_workers=1 , quiet=True , callback=None , manifest=None , retries=0 , backoff=5 , retry_failed=False ):
+	tasks = [(obj, f, l, a) for obj, l, a in objects for f in object_frames(obj)]
+	if workers is None: workers = os.cpu_count()
+
+	results = {}
+	inputs  = {}
+	warms   = {}	# frame -> its warm, see process_frame()
+	seeds   = {}	# frame -> what it started from, see warm_seed()
+	frames  = {}	# obj -> its frames in order
+	for obj, f, l, a in tasks: frames.setdefault(obj, []).append(f)
+	if manifest is not None:
+		rerun = set()	# objects with a frame to run again
+		for obj, f, l, a in tasks:
+			inputs[f] = manifest.inputs(f, l, a, warm_seed(frames[obj], f, warms))
+			if not (warm_start and obj in rerun) and manifest.complete(f, inputs[f], retry_failed=retry_failed):
+				results[f] = manifest.result(f)
+				if results[f].status in ('done', 'skipped'): results[f] = results[f]._replace(message='up to date')
+				if results[f].warm is not None: warms[f] = results[f].warm
+				if callback is not None: callback(results[f])
+			else:
+				rerun.add(obj)
+		manifest.save()
+
+	pending = [task for task in tasks if task[1] not in results]
+	load_inputs()	# once here; forked workers inherit it, spawned ones load it on first use
+	retry   = ('crashed', 'failed', 'error') if retry_failed else ('crashed',)
+	pool    = None
+	try:
+		for attempt in range(retries + 1):
+			if attempt > 0: time.sleep(backoff * 2**(attempt-1))
+			if pool is None and workers > 1 and len(pending) > 1:
+				pool = ProcessPoolExecutor(max_workers=min(workers, len(pending)), initializer=apply_settings, initargs=(pipeline_settings(),))
+			if manifest is not None:
+				for task in pending: manifest.start(task[1], inputs[task[1]])
+				manifest.save()
+
+			for result in run_batch_round(pending, warms, frames, pool, star_workers, quiet, seeds):
+				results[result.frame] = result
+				if manifest is not None:
+					obj, f, l, a = next(task for task in pending if task[1] == result.frame)
+					manifest.finish(result, manifest.inputs(f, l, a, seeds.get(f)))
+					manifest.save()
+				if callback is not None: callback(result)
+
+			# a dead worker breaks the whole pool, the next round gets a new one
+			if pool is not None and any(results[task[1]].status == 'crashed' for task in pending):
+				pool.shutdown(wait=False)
+				pool = None
+
+			pending = [task for task in pending if results[task[1]].status in retry]
+			if not pending: break
+	finally:
+		if pool is not None: pool.shutdown()
+
+	return [results[task[1]] for task in tasks]
 
-			directory_name = d.split('/')[1]
+if __name__ == '__main__':
+	try:
+		f_name 		 = sys.argv[1]
+		l_from_input = sys.argv[2]
+		a_from_input = sys.argv[3]
+		write_output = sys.argv[4]
+	except Exception as e:
+		print(e)
+
+	# number of processes for the star fits, all cores unless given
+	try:
+		n_workers = int(sys.argv[5])
+	except Exception as e:
+		n_workers = None
+
+	dir_names = [directory+f+'/' for f in os.listdir(directory) if isdir(join(directory,f))]
+	for d in dir_names:
+		file_names = sorted(d+f for f in os.listdir(d) if isfile(join(d,f)))
+		yea = False
 
-			# if write_output == 'True':
-				# np.savetxt(f'{f[:-4]}_params.txt'    , stars )
-				# np.savetxt(f'{f[:-4]}_lightcurve.txt', np.array([ x , sky_corrected_lightcurve , sky_corrected_errs ]).T )
-			np.savetxt(f'{output_for_bryce}lightcurve_asteroid.dat', np.array([ x , sky_corrected_lightcurve , sky_corrected_errs ]).T )
+		if not f_name in d: continue
 
+		start_times = []
+		lightcurves = []
+		errors      = []
+		warm        = None
 
-			print()
-			file.close()
+		for f in file_names:
+			# if '06o13' not in f: continue
+			if not is_fits_frame(f): continue
+			result = process_frame(f, l_from_input, a_from_input, workers=n_workers, warm=warm if warm_start else None)
+			if result.warm is not None: warm = result.warm
 			# if True: break
 
 			# ax[0].legend()
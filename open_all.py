@@ -5,7 +5,7 @@ from matplotlib import colors
 from astropy.io import fits
 from scipy.ndimage import rotate
 from astropy.wcs import WCS
-from magic_star import point_rotation
+from magic_star import point_rotation, is_fits_frame, Frame, observations
 # to get absolute mag and orbital information
 from astroquery.jplhorizons import Horizons
 
@@ -19,7 +19,6 @@ dir_names = [directory+f+'/' for f in os.listdir(directory) if isdir(join(direct
 
 # output = open('output_rates.csv', 'w+')
 
-input_file = np.loadtxt('input.csv', dtype=object, skiprows=1, usecols=(i for i in range(25)), delimiter=',')
 i=0
 mins = {'g':100, 'r': 150, 'i': 250}
 start_times = []
@@ -28,13 +27,14 @@ for d in dir_names:
 	if not 'LT1_2016_06_07' in d: continue
 
 	for f in file_names:
+		if not is_fits_frame(f): continue
 		try:
-			file = fits.open(f)
+			frame = Frame(f)
 		except Exception as e:
 			print(f)
 			continue
-		hdr = file[0].header
-		img = file[0].data
+		hdr = frame.header
+		img = frame.data
 
 		# for experimenting, lol
 		start_times.append(float(hdr['MJDATE']))
@@ -52,12 +52,11 @@ for d in dir_names:
 		plt.title(f)
 		plt.imshow(img, cmap='gray', norm=colors.LogNorm(vmin=mins[hdr['FILTER'][0]]))
 
-		obj_rows = input_file[np.where(input_file[:,1]==obj_id),:][0]
+		obj = observations.lookup(f.split('/')[-1], obj_id)
 
 		# try:
-		# 	obj = obj_rows[np.where(obj_rows[:,0]==f.split('/')[-1])][0]
-		# 	trail_start = np.array(obj[-4:-2], dtype=int)
-		# 	trail_end	= np.array(obj[-2:], dtype=int)
+		# 	trail_start = obj['trail_start']
+		# 	trail_end	= obj['trail_end']
 		# except Exception as e:
 		# 	print(f,'skipped')
 		# 	plt.close()
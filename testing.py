@@ -12,6 +12,7 @@ import matplotlib.pyplot as plt
 from astropy.io import fits
 from scipy.ndimage import rotate
 from scipy.special import erf
+from magic_star import point_rotation_batch, bin_lightcurve, is_fits_frame, Frame, observations, se_catalogs
 from astropy.wcs import WCS
 from astropy.wcs import utils
 from astropy.coordinates import SkyCoord
@@ -35,10 +36,7 @@ from os.path import isdir, isfile, join
 directory = './'	
 dir_names = [directory+f+'/' for f in os.listdir(directory) if isdir(join(directory,f))] 
 
-input_file = np.loadtxt('input.csv', dtype=object, skiprows=1, usecols=(i for i in range(25)), delimiter=',')
 
-se_dir   = './SEoutput/'
-se_files = [se_dir+f for f in os.listdir(se_dir) if isfile(join(se_dir,f))]
 
 mins = {'g':100, 'r': 150, 'i': 250}
 
@@ -134,37 +132,7 @@ def bin_lightcurve_bad(lightcurve, trail_length, method):
 	smoothed = np.array(smoothed)
 	return smoothed
 
-'''
-another attempt at binning - this time looking at fractional pixel fluxes.
-
-returns array (shape 1xtrail_length) of same dtype as lc. 
-	takes fractional pixel fluxes and reorganizes the bins
-
-lc 			 [array(dtype=float)]: original lightcurve to be rebinned
-trail_length [int]				 : length we want our output lightcurve
-
-'''
-def bin_lightcurve(lc, trail_length):
-	L = len(lc)
-	length_ratio = L/trail_length
-
-	binned = []
-	c = 0
-	for i in range(int(trail_length)):
-		j = (i+1) * length_ratio
-		N = j - c # fractional pixels in lc to go into one binned pixel
-		# n = N % 1 
-		s = np.sum( lc[ int(c+1) : int(j) ]) + lc[int(c)] * (1-c%1) + lc[int(j+1)] * (j%1)
-		# print(int(c+1), int(j), s, lc[int(c)] * (1-c%1), lc[int(j+1)] * (j%1))
-
-		c = j 
-		binned.append(s)
-
-	return np.array(binned)
-
-
-
-
+# bin_lightcurve lives in magic_star -- this copy indexed lc[int(j+1)] and ran off the end of the trail
 
 '''
 folding lightcurves on dominant period w/ stropy timeseries
@@ -414,18 +382,19 @@ if __name__ == '__main__':
 		for f in file_names:
 
 			# if '68o13' not in f: continue
+			if not is_fits_frame(f): continue
 			try:
-				file = fits.open(f)
+				frame = Frame(f)
 				print(f)
 			except Exception as e:
 				print(f)
 				continue
-			hdr = file[0].header
-			img = file[0].data
+			hdr = frame.header
+			img = frame.data
 
-			exp_time   = float(hdr['EXPMEAS'])
-			gain       = float(hdr['GAIN'])
-			rd_noise   = float(hdr['RDNOISE'])
+			exp_time   = frame.exp_time
+			gain       = frame.gain
+			rd_noise   = frame.rd_noise
 
 			# obs_filter = float(hdr['FILTE'])
 
@@ -433,17 +402,12 @@ if __name__ == '__main__':
 			obj_id = f.split('_')
 			obj_id = obj_id[0][2:] + ' ' + obj_id[1]
 
-			obj_rows = input_file[np.where(input_file[:,1]==obj_id),:][0]
-			
-			try:
-				obj = obj_rows[np.where(obj_rows[:,0]==f.split('/')[-1])][0]
-				trail_start = np.array(obj[-4:-2], dtype=int)
-				trail_end	= np.array(obj[-2:], dtype=int)
-				start_time  = float(obj[6])
-			except Exception as e:
-				# print(f,obj[-4:-2],obj[-2:])
-				# plt.close()
-				continue
+			obj = observations.lookup(f.split('/')[-1], obj_id)
+			if obj is None or not obj['has_trail']: continue
+
+			trail_start = obj['trail_start']
+			trail_end	= obj['trail_end']
+			start_time  = float(obj['jd'])
 
 			# global variable flux to capture the total flux of the trail
 			flux = 0
@@ -545,38 +509,32 @@ if __name__ == '__main__':
 
 			# WCS stuff
 			w = WCS(hdr)
-			c = SkyCoord(f'{obj[7]} {obj[8]}', unit=(u.deg, u.deg))
+			c = SkyCoord(f'{obj["ra"]} {obj["dec"]}', unit=(u.deg, u.deg))
 			target_x, target_y = np.round(utils.skycoord_to_pixel(c, w))
 			
 			# source extractor !!
 			# sex = subprocess.run(['sex', f, '-DETECT_MINAREA', str(trail_length*fwhm), '-CATALOG_NAME', '_'.join(f.split("/")[1:])[:-4] + '.cat'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-			try:
-				se_index = [x for x in se_files if (f.split('/')[1] in x and f.split("/")[2].split(".")[0] in x)][0]
-			except Exception as e:
-				print(e)
+			sex_output = se_catalogs.lookup(f)
+			if sex_output is None:
+				print(f'no SExtractor catalog for {f}')
 				continue
 
-
-			sex_output = np.loadtxt(se_index, skiprows=9)
 			print('SExtractor found stars: ',sex_output.shape[0])
-			star_x = sex_output[:,5]
-			star_y = sex_output[:,6]
+			star_x = sex_output['X_IMAGE']
+			star_y = sex_output['Y_IMAGE']
 			# plt.plot(star_x, sta)
 
-			star_x_min = sex_output[:,1]
-			star_y_min = sex_output[:,2]
-			star_x_max = sex_output[:,3]
-			star_y_max = sex_output[:,4]
-
-			dist_to_asteroid = []
+			star_x_min = sex_output['XMIN_IMAGE']
+			star_y_min = sex_output['YMIN_IMAGE']
+			star_x_max = sex_output['XMAX_IMAGE']
+			star_y_max = sex_output['YMAX_IMAGE']
 
 			# to rotate to asteroid's reference -- SExtractor works with raw fits file data
-			for i in range(len(star_x)):
-				star_x[i], star_y[i] = point_rotation(star_x[i], star_y[i], angle, img, img_rotated)
-				star_x_min[i], star_y_min[i] = point_rotation(star_x_min[i] , star_y_min[i] , angle, img, img_rotated)
-				star_x_max[i], star_y_max[i] = point_rotation(star_x_max[i] , star_y_max[i] , angle, img, img_rotated)
+			star_x    , star_y     = point_rotation_batch(np.column_stack((star_x    , star_y    )), angle, img).T
+			star_x_min, star_y_min = point_rotation_batch(np.column_stack((star_x_min, star_y_min)), angle, img).T
+			star_x_max, star_y_max = point_rotation_batch(np.column_stack((star_x_max, star_y_max)), angle, img).T
 
-				dist_to_asteroid.append((star_x[i] - trail_centroid[0])**2 + (star_y[i] - trail_centroid[1])**2)
+			dist_to_asteroid = (star_x - trail_centroid[0])**2 + (star_y - trail_centroid[1])**2
 
 			ax_img.scatter(star_x, star_y, label='SExtractor')
 				
@@ -887,7 +845,7 @@ if __name__ == '__main__':
 			plt.xlim((0,100))
 
 			print()
-			file.close()
+			frame.close()
 
 			# ax[0].legend()
 
@@ -11,7 +11,7 @@ from astropy.timeseries import LombScargle
 from astropy.coordinates import SkyCoord
 from scipy.ndimage import rotate
 from scipy.optimize import curve_fit
-from magic_star import take_lightcurve, point_rotation, reverse_rotation
+from magic_star import take_lightcurve, point_rotation, reverse_rotation_batch, RefcatReader, PixelMatcher
 from debugging import display_streak
 
 
@@ -25,6 +25,9 @@ directory  = './'
 dir_names = [directory+f+'/' for f in os.listdir(directory) if isdir(join(directory,f))] 
 mins = {'g':100, 'r': 150, 'i': 250}
 
+refcat_reader = RefcatReader('00_m_16/')
+matcher       = PixelMatcher(refcat_reader)
+
 for d in dir_names:
 	if 'GE1' not in d: continue
 	file_names = [d+f for f in os.listdir(d) if isfile(join(d,f))]
@@ -59,16 +62,7 @@ for d in dir_names:
 		hdr 	 = fits_img[0].header
 		img 	 = fits_img[0].data
 
-		cen_x_r , cen_y_r  = [] , []
-
-		for i in range(len(centroid_y)):
-			c_x = centroid_x[i]
-			c_y = centroid_y[i]
-			c_x_r , c_y_r = reverse_rotation(c_x, c_y, star_angle, img)
-			cen_x_r.append(c_x_r)
-			cen_y_r.append(c_y_r)
-		cen_x_r = np.array(cen_x_r)
-		cen_y_r = np.array(cen_y_r)
+		cen_x_r , cen_y_r  = reverse_rotation_batch(np.column_stack((centroid_x, centroid_y)), star_angle, img).T
 
 
 		inst_mag = -2.5 * np.log10(star_flux)
@@ -82,8 +76,6 @@ for d in dir_names:
 
 
 		w = WCS(hdr)
-		c = SkyCoord(f'{hdr["CRVAL1"]} {hdr["CRVAL2"]}', unit=(u.deg, u.deg))
-		fit_ra_dec = utils.pixel_to_skycoord(cen_x_r , cen_y_r , w )
 
 		img_star_rotated = rotate(img, star_angle)
 
@@ -107,33 +99,11 @@ for d in dir_names:
 		ax.scatter(np.arange(binning), sum_lc/np.median(sum_lc))
 
 		
-		# args_str = f'./refcat {c.ra.deg} {c.dec.deg} -rad 0.5 -dir 00_m_16/'
-		args_str = f'./refcat {c.ra.deg} {c.dec.deg} -rect 0.25,0.25 -dir 00_m_16/'
-
-		# RA, Dec, g, r, i, z, J, cyan, orange.
-		ref_stars = np.array(os.popen(args_str).read().split('\n')[:-1])
-		refcat = []
-		for i in ref_stars:
-			refcat.append(np.array(i.split(), dtype=float))
-		refcat = np.array(refcat)
-
-		ref_mag = []
-
 		img_filter = hdr['FILTER'][0]
-		
-		if   img_filter == 'g': ref_mag = refcat[:,2]
-		elif img_filter == 'r': ref_mag = refcat[:,3]
-		elif img_filter == 'i': ref_mag = refcat[:,4]
-
-		refcat_ra_dec      = SkyCoord(ra=refcat[:,0]*u.degree, dec=refcat[:,1]*u.degree, frame='fk5')
-		refcat_x, refcat_y = utils.skycoord_to_pixel(refcat_ra_dec, w)
 
-		# constraining to image dimensions
-		image_dim     = np.where((refcat_x > 0) & (refcat_x < img.shape[1]) & (refcat_y > 0) & (refcat_y < img.shape[0]) )
-		refcat_x      = refcat_x[image_dim] #0, img.shape[1]
-		refcat_y      = refcat_y[image_dim]
-		refcat_ra_dec = refcat_ra_dec[image_dim]
-		ref_mag       = ref_mag[image_dim]
+		# refcat projected onto the frame once, fitted stars matched to it in pixel space
+		refcat, refcat_x, refcat_y, _ = matcher.project(w, img.shape)
+		ref_mag = refcat[img_filter]
 
 
 		fig_unr, ax_unr = plt.subplots()
@@ -142,30 +112,27 @@ for d in dir_names:
 		ax_unr.set_xlim((0, img.shape[1]))
 		ax_unr.set_ylim((img.shape[0], 0))
 		
-		# idx, d2d, d3d = fit_ra_dec.match_to_catalog_sky(refcat_ra_dec, nthneighbor=1)
-		idx, d2d, d3d = refcat_ra_dec.match_to_catalog_sky(fit_ra_dec, nthneighbor=1)
-		print(d2d.arcsec)
+		_, idx, sep = matcher.match(w, img.shape, cen_x_r, cen_y_r, max_sep=75)
+		print(sep)
+		print(matcher.last)
 
-		dist_filter = np.where(d2d.arcsec < 75)
-		# idx = idx[dist_filter]
-		# fit_ra_dec = fit_ra_dec[dist_filter]
+		dist_filter = np.where(idx >= 0)
 		
 		ax_unr.scatter(refcat_x     , refcat_y     , label='refcat')
-		ax_unr.scatter(cen_x_r[idx[dist_filter]] , cen_y_r[idx[dist_filter]] , label='fitted')
+		ax_unr.scatter(cen_x_r[dist_filter] , cen_y_r[dist_filter] , label='fitted')
 		ax_unr.legend()
 
 
 		fig_mag, ax_mag = plt.subplots()
-		# ax_mag.scatter(inst_mag[dist_filter], ref_mag[idx[dist_filter]])
-		ax_mag.scatter(inst_mag[idx], ref_mag)
+		ax_mag.scatter(inst_mag[dist_filter], ref_mag[idx[dist_filter]])
 
 		# print(ref_mag[idx[dist_filter]] )
 
-		cal_fit, cal_fit_cov = curve_fit ( line_slope_one , inst_mag[idx[dist_filter]] , ref_mag[dist_filter] )
+		cal_fit, cal_fit_cov = curve_fit ( line_slope_one , inst_mag[dist_filter] , ref_mag[idx[dist_filter]] )
 		# line_label = f'M = {cal_fit[0]}*m + {cal_fit[1]}'
 		# line_label = f'M = m + {cal_fit[0]}'
 		print(cal_fit) 
-		ax_mag.plot( inst_mag[idx[dist_filter]] , line_slope_one( inst_mag[idx[dist_filter]] , *cal_fit )  )
+		ax_mag.plot( inst_mag[dist_filter] , line_slope_one( inst_mag[dist_filter] , *cal_fit )  )
 		# ax_mag.legend()
 		# print(cal_fit)
 		# print('fit (1 sigma) errors : ' , np.diag(cal_fit_cov) **.5)
@@ -180,4 +147,5 @@ for d in dir_names:
 
 
 	
+	print(matcher)
 	plt.show()
\ No newline at end of file
@@ -0,0 +1,24 @@
+import os, sys
+from os.path import isdir, join
+import numpy as np
+from magic_star import calibrate_night, RefcatReader
+
+# usage: python zeropoints.py [object directory substring]
+# writes <frame>_zeropoint.txt for every frame with a lightcurves.npz (or star_params.dat), one pass per object directory
+
+directory  = './'
+dir_names = [directory+f+'/' for f in os.listdir(directory) if isdir(join(directory,f))]
+obj_match = sys.argv[1] if len(sys.argv) > 1 else ''
+
+refcat_reader = RefcatReader('00_m_16/')
+
+for d in sorted(dir_names):
+	if obj_match not in d: continue
+	results = calibrate_night(d, refcat_reader)
+	if len(results) == 0: continue
+
+	print(d)
+	for frame_id, (band, zp, zp_err, n, k, k_err) in sorted(results.items()):
+		print(f'  {frame_id}  {band}  ZP = {zp:.4f} +/- {zp_err:.4f}  ({n} stars)  colour term = {k:.4f} +/- {k_err:.4f}')
+
+print(refcat_reader)